@@ -18,13 +18,12 @@ This Python script converts ROI_PAC or GAMMA format input interferograms
 into geotiff format files
 """
 # -*- coding: utf-8 -*-
-import os
 from typing import Tuple, List
 from joblib import Parallel, delayed
 import numpy as np
 
-from pyrate.core.prepifg_helper import PreprocessError
-from pyrate.core import shared, mpiops, config as cf, gamma, roipac
+from pyrate.core.prepifg_helper import PreprocessError, header_index
+from pyrate.core import shared, mpiops, config as cf, gamma, roipac, ifgconstants as ifc, instrument, checkpoint
 from pyrate.core.logger import pyratelogger as log
 from pyrate.configuration import MultiplePaths
 from pyrate.core.shared import mpi_vs_multiprocess_logging
@@ -52,6 +51,7 @@ def main(params):
         return
 
     mpi_vs_multiprocess_logging("conv2tif", params)
+    params[cf.HEADER_INDEX] = mpiops.run_once(header_index, params)
 
     base_ifg_paths = params[cf.INTERFEROGRAM_FILES]
 
@@ -94,17 +94,25 @@ def _geotiff_multiprocessing(unw_path: MultiplePaths, params: dict) -> Tuple[str
     dest = unw_path.converted_path
     processor = params[cf.PROCESSOR]  # roipac or gamma
 
-    # Create full-res geotiff if not already on disk
-    if not os.path.exists(dest):
-        if processor == GAMMA:
-            header = gamma.gamma_header(unw_path.unwrapped_path, params)
-        elif processor == ROIPAC:
-            log.info("Warning: ROI_PAC support will be deprecated in a future PyRate release")
-            header = roipac.roipac_header(unw_path.unwrapped_path, params)
-        else:
-            raise PreprocessError('Processor must be ROI_PAC (0) or GAMMA (1)')
-        shared.write_fullres_geotiff(header, unw_path.unwrapped_path, dest, nodata=params[cf.NO_DATA_VALUE])
-        return dest, True
+    if processor == GAMMA:
+        header = gamma.gamma_header(unw_path.unwrapped_path, params)
+    elif processor == ROIPAC:
+        log.info("Warning: ROI_PAC support will be deprecated in a future PyRate release")
+        header = roipac.roipac_header(unw_path.unwrapped_path, params)
     else:
-        log.warning(f"Full-res geotiff already exists in {dest}! Returning existing geotiff!")
+        raise PreprocessError('Processor must be ROI_PAC (0) or GAMMA (1)')
+
+    # Create full-res geotiff unless already on disk from the same inputs
+    fingerprint = checkpoint.output_fingerprint([unw_path.unwrapped_path], params, checkpoint.CONV2TIF_PARAMS,
+                                                header)
+    if checkpoint.up_to_date(params, dest, fingerprint):
+        log.info(f"Skipped: full-res geotiff {dest} is up to date")
         return dest, False
+    checkpoint.invalidate(params, dest)
+    if params[cf.CONV2VRT]:
+        shared.write_fullres_vrt(header, unw_path.unwrapped_path, dest, nodata=params[cf.NO_DATA_VALUE])
+    else:
+        shared.write_fullres_geotiff(header, unw_path.unwrapped_path, dest, nodata=params[cf.NO_DATA_VALUE])
+    checkpoint.record_fingerprint(params, dest, fingerprint)
+    instrument.add_pixels(header[ifc.PYRATE_NCOLS] * header[ifc.PYRATE_NROWS])
+    return dest, True
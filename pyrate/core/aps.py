@@ -28,7 +28,7 @@ from numpy import isnan
 from scipy.fftpack import fft2, ifft2, fftshift, ifftshift
 from scipy.interpolate import griddata
 
-from pyrate.core import shared, ifgconstants as ifc, mpiops, config as cf
+from pyrate.core import shared, ifgconstants as ifc, mpiops, config as cf, instrument
 from pyrate.core.covariance import cvd_from_phase, RDist
 from pyrate.core.algorithm import get_epochs
 from pyrate.core.shared import Ifg
@@ -38,6 +38,7 @@ from pyrate.merge import _assemble_tiles
 log = logging.getLogger(__name__)
 
 
+@instrument.timed('aps')
 def wrap_spatio_temporal_filter(ifg_paths, params, tiles, preread_ifgs):
     """
     A wrapper for the spatio-temporal filter so it can be tested.
@@ -100,20 +101,24 @@ def _calc_svd_time_series(ifg_paths, params, preread_ifgs, tiles):
     new_params = deepcopy(params)
     new_params[cf.TIME_SERIES_METHOD] = 2  # use SVD method
 
-    process_tiles = mpiops.array_split(tiles)
+    counter = mpiops.SharedCounter()
+    process_tiles = mpiops.dynamic_split(tiles, shared.tile_costs(tiles, preread_ifgs), counter)
     output_dir = params[cf.TMPDIR]
 
     nvels = None
     for t in process_tiles:
-        log.debug('Calculating time series for tile {} during APS '
-                 'correction'.format(t.index))
-        ifg_parts = [shared.IfgPart(p, t, preread_ifgs, params) for p in ifg_paths]
-        mst_tile = np.load(os.path.join(output_dir, 'mst_mat_{}.npy'.format(t.index)))
-        tsincr = time_series(ifg_parts, new_params, vcmt=None, mst=mst_tile)[0]
+        with instrument.tile_counters(t.index):
+            log.debug('Calculating time series for tile {} during APS '
+                     'correction'.format(t.index))
+            ifg_parts = [shared.IfgPart(p, t, preread_ifgs, params) for p in ifg_paths]
+            mst_tile = np.load(os.path.join(output_dir, 'mst_mat_{}.npy'.format(t.index)))
+            tsincr = time_series(ifg_parts, new_params, vcmt=None, mst=mst_tile)[0]
         np.save(file=os.path.join(output_dir, 'tsincr_aps_{}.npy'.format(t.index)), arr=tsincr)
         nvels = tsincr.shape[2]
+    counter.free()
 
-    nvels = mpiops.comm.bcast(nvels, root=0)
+    # tiles are scheduled dynamically, so any process may have the result
+    nvels = max(n for n in mpiops.comm.allgather(nvels) if n is not None)
     mpiops.comm.barrier()
     # need to assemble tsincr from all processes
     tsincr_g = mpiops.run_once(_assemble_tsincr, ifg_paths, params, preread_ifgs, tiles, nvels)
@@ -164,7 +169,7 @@ def _save_aps_corrected_phase(ifg_path, phase):
     ifg.open(readonly=False)
     ifg.phase_data[~np.isnan(ifg.phase_data)] = phase[~np.isnan(ifg.phase_data)]
     # set aps tags after aps error correction
-    ifg.dataset.SetMetadataItem(ifc.PYRATE_APS_ERROR, ifc.APS_REMOVED)
+    ifg.meta_data[ifc.PYRATE_APS_ERROR] = ifc.APS_REMOVED
     ifg.write_modified_phase()
     ifg.close()
 
@@ -297,7 +302,9 @@ def temporal_low_pass_filter(tsincr, epochlist, params):
     else:
         func = mean_filter
 
-    _tlpfilter(cols, cutoff, nanmat, rows, span, threshold, tsfilt_incr, tsincr, func)
+    # the filter is not tiled, its counters are reported as a single tile
+    with instrument.stage('tlpf'), instrument.tile_counters(0):
+        _tlpfilter(cols, cutoff, nanmat, rows, span, threshold, tsfilt_incr, tsincr, func)
     log.debug("Finished applying temporal low pass filter")
     return tsfilt_incr
 
@@ -321,10 +328,14 @@ def _tlpfilter(cols, cutoff, nanmat, rows, span, threshold, tsfilt_incr, tsincr,
     """
     Wrapper function for temporal low pass filter
     """
+    counters = instrument.counters()
     for i in range(rows):
         for j in range(cols):
             sel = np.nonzero(nanmat[i, j, :])[0]  # don't select if nan
             m = len(sel)
+            if counters is not None:
+                counters.add('tlpf.pixels')
+                counters.add('tlpf.filtered' if m >= threshold else 'tlpf.skipped')
             if m >= threshold:
                 for k in range(m):
                     yr = span[sel] - span[sel[k]]
@@ -0,0 +1,404 @@
+#   This Python module is part of the PyRate software package.
+#
+#   Copyright 2020 Geoscience Australia
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+This Python module contains the run manifest and tile journals used to skip
+completed stages and tiles of the PyRate process workflow on rerun, and the
+output fingerprints used to skip up to date outputs of conv2tif and prepifg
+"""
+import glob
+import hashlib
+import json
+import os
+import zlib
+from os.path import join, exists, basename
+
+import numpy as np
+
+from pyrate.core import config as cf, mpiops
+from pyrate.core.shared import Ifg, ifg_signature, CorrectionStatusError
+from pyrate.core.logger import pyratelogger as log
+
+MANIFEST_FILE = 'run_manifest.json'
+FINGERPRINT_DIR = 'fingerprints'
+# stage modifying the interferograms
+CORRECTIONS = 'corrections'
+
+# configuration parameters the result of each stage depends on
+REF_PIXEL_PARAMS = [cf.NO_DATA_VALUE, cf.NAN_CONVERSION, cf.REFX, cf.REFY, cf.REFNX, cf.REFNY,
+                    cf.REF_CHIP_SIZE, cf.REF_MIN_FRAC, cf.REF_SEARCH_LOOKS]
+CORRECTION_PARAMS = [cf.ORBITAL_FIT, cf.ORBITAL_FIT_METHOD, cf.ORBITAL_FIT_DEGREE,
+                     cf.ORBITAL_FIT_LOOKS_X, cf.ORBITAL_FIT_LOOKS_Y, cf.REF_EST_METHOD,
+                     cf.APSEST, cf.TLPF_METHOD, cf.TLPF_CUTOFF, cf.TLPF_PTHR, cf.SLPF_METHOD,
+                     cf.SLPF_CUTOFF, cf.SLPF_ORDER, cf.SLPF_NANFILL, cf.SLPF_NANFILL_METHOD]
+TILE_PARAMS = [cf.TIME_SERIES_CAL, cf.TIME_SERIES_METHOD, cf.TIME_SERIES_PTHRESH,
+               cf.TIME_SERIES_SM_FACTOR, cf.TIME_SERIES_SM_ORDER, cf.LR_NSIG, cf.LR_MAXSIG,
+               cf.LR_PTHRESH]
+CONV2TIF_PARAMS = [cf.PROCESSOR, cf.NO_DATA_VALUE]
+PREPIFG_PARAMS = [cf.PROCESSOR, cf.NO_DATA_VALUE, cf.NO_DATA_AVERAGING_THRESHOLD, cf.IFG_LKSX, cf.IFG_LKSY,
+                  cf.IFG_CROP_OPT, cf.COH_MASK, cf.COH_THRESH]
+
+
+def stage_key(previous, params, names, *extra):
+    """
+    Hash identifying the inputs of a stage: the key of the previous stage,
+    the values of the relevant configuration parameters and any other
+    values the stage depends on.
+
+    :param str previous: Key of the previous stage
+    :param dict params: Dictionary of configuration parameters
+    :param list names: Names of the relevant configuration parameters
+    :param extra: Other JSON serialisable values (optional)
+
+    :return: key: hexadecimal digest
+    :rtype: str
+    """
+    values = [previous, [[n, params.get(n)] for n in names], list(extra)]
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _ifgs_key(ifg_paths):
+    """
+    Hash of the signatures of the interferogram files.
+    """
+    signatures = []
+    for path in ifg_paths:
+        ifg = Ifg(path)
+        ifg.open(readonly=True)
+        signatures.append([path, ifg_signature(ifg)])
+        ifg.close()
+    return stage_key(None, {}, [], signatures)
+
+
+class Manifest:
+    """
+    Record of the completed stages of a run, saved as JSON in the temporary
+    directory. For each stage the manifest holds a key, see stage_key, the
+    paths of the files it saved and other small outputs. A stage is complete
+    if its key matches and its files still exist.
+
+    The corrections modify the interferograms in place, so the manifest also
+    records the signature of the interferograms after correction. A rerun on
+    these corrected interferograms continues from the key of the original
+    inputs.
+    """
+    def __init__(self, params):
+        self.path = join(params[cf.TMPDIR], MANIFEST_FILE)
+        self.stages = mpiops.run_once(self._load)
+        self.corrected_inputs = False
+
+    def _load(self):
+        if not exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning('Ignoring unreadable run manifest {}'.format(self.path))
+            return {}
+
+    def _save(self):
+        if mpiops.rank == 0:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.stages, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    def inputs_key(self, ifg_paths):
+        """
+        Key of the input interferograms of the run.
+
+        :param list ifg_paths: List of interferogram paths
+
+        :return: key: hexadecimal digest
+        :rtype: str
+        """
+        current = mpiops.run_once(_ifgs_key, ifg_paths)
+        inputs = self.stages.get('inputs', {})
+        if inputs.get('corrected') == current:
+            log.info('Interferograms were corrected by a previous run')
+            self.corrected_inputs = True
+            return inputs['key']
+        if inputs.get('key') == current:
+            # uncorrected inputs of a previous run, corrections are redone
+            self.stages.pop(CORRECTIONS, None)
+            inputs.pop('corrected', None)
+        else:
+            self.stages = {'inputs': {'key': current}}
+        self._save()
+        return current
+
+    def corrected(self, ifg_paths):
+        """
+        Record the signature of the interferograms after correction.
+
+        :param list ifg_paths: List of interferogram paths
+        """
+        self.stages['inputs']['corrected'] = mpiops.run_once(_ifgs_key, ifg_paths)
+        self._save()
+
+    def check_corrections(self, key):
+        """
+        Check that interferograms corrected by a previous run were corrected
+        with the same inputs to the corrections stage. Corrections already
+        applied to the interferograms are not applied again, so changed
+        correction parameters would otherwise be silently ignored.
+
+        :param str key: Key of the corrections stage inputs
+        """
+        record = self.stages.get(CORRECTIONS)
+        if self.corrected_inputs and record is not None and record['key'] != key:
+            msg = 'Interferograms were corrected by a previous run with different ' \
+                  'correction parameters. Run prepifg again to restore the ' \
+                  'uncorrected interferograms before changing the corrections.'
+            log.error(msg)
+            raise CorrectionStatusError(msg)
+
+    def complete(self, stage, key):
+        """
+        True if the stage has completed with the same key.
+
+        :param str stage: Name of the stage
+        :param str key: Key of the stage inputs
+
+        :return: True if the stage can be skipped
+        :rtype: bool
+        """
+        record = self.stages.get(stage)
+        if record is None or record['key'] != key:
+            return False
+        if not all(exists(f) for f in record['files']):
+            log.info('Output files of stage {} missing'.format(stage))
+            return False
+        log.info('Skipped: stage {} completed by a previous run'.format(stage))
+        return True
+
+    def outputs(self, stage):
+        """
+        Outputs recorded for a completed stage.
+
+        :param str stage: Name of the stage
+
+        :return: outputs
+        :rtype: dict
+        """
+        return self.stages[stage]['outputs']
+
+    def record(self, stage, key, files=(), **outputs):
+        """
+        Record the completion of a stage.
+
+        :param str stage: Name of the stage
+        :param str key: Key of the stage inputs
+        :param list files: Paths of the files saved by the stage
+        :param outputs: Other JSON serialisable outputs of the stage
+        """
+        self.stages[stage] = {'key': key, 'files': list(files), 'outputs': outputs}
+        self._save()
+
+
+def checksum(path):
+    """
+    CRC32 checksum of a file.
+
+    :param str path: Path of the file
+
+    :return: checksum as hexadecimal string
+    :rtype: str
+    """
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            crc = zlib.crc32(chunk, crc)
+    return '{:08x}'.format(crc)
+
+
+def save_atomic(path, arr):
+    """
+    Save a numpy array such that the file at path is either complete or
+    absent: the array is written to a temporary file which is then renamed.
+
+    :param str path: Path of the .npy file
+    :param ndarray arr: Array to save
+
+    :return: checksum of the saved file
+    :rtype: str
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, arr)
+        f.flush()
+        os.fsync(f.fileno())
+    crc = checksum(tmp)
+    os.replace(tmp, path)
+    return crc
+
+
+class TileJournal:
+    """
+    Journal of the tiles completed by a tile stage. Each process appends a
+    line with the tile index, stage key and checksums of the tile files to
+    its own journal file once all files of the tile are saved. On rerun the
+    journals of all processes of previous runs are read, so the tiles that
+    are still missing can be computed with any number of processes. Tiles
+    with a different key, missing files or bad checksums are computed again.
+    """
+    def __init__(self, params, stage, key):
+        self.stage = stage
+        self.key = key
+        self.dir = params[cf.TMPDIR]
+        self.path = join(self.dir, 'journal_{}_{}.jsonl'.format(stage, mpiops.rank))
+        self.done = mpiops.run_once(self._recover)
+
+    def _recover(self):
+        """
+        Collect the valid entries of all journal files of the stage into a
+        single journal file and return the indices of the completed tiles.
+        """
+        entries = {}
+        paths = glob.glob(join(self.dir, 'journal_{}_*.jsonl'.format(self.stage)))
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # interrupted write
+                        continue
+                    if entry['key'] == self.key and all(
+                            exists(p) and checksum(p) == c for p, c in entry['files'].items()):
+                        entries[entry['tile']] = entry
+        tmp = join(self.dir, 'journal_{}.tmp'.format(self.stage))
+        with open(tmp, 'w') as f:
+            for entry in entries.values():
+                f.write(json.dumps(entry) + '\n')
+        for path in paths:
+            os.remove(path)
+        os.replace(tmp, join(self.dir, 'journal_{}_0.jsonl'.format(self.stage)))
+        if entries:
+            log.info('Skipped: {} tiles of stage {} completed by a previous run'.format(
+                len(entries), self.stage))
+        return set(entries)
+
+    def remaining(self, tiles):
+        """
+        Tiles not completed yet.
+
+        :param list tiles: List of Tile instances
+
+        :return: tiles: List of the Tile instances still to be computed
+        :rtype: list
+        """
+        return [t for t in tiles if t.index not in self.done]
+
+    def save(self, tile, arrays):
+        """
+        Save the output arrays of a tile and record its completion.
+
+        :param Tile tile: Tile instance
+        :param dict arrays: Dictionary of arrays keyed by .npy file path
+        """
+        files = {path: save_atomic(path, arr) for path, arr in arrays.items()}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'key': self.key, 'tile': int(tile.index), 'files': files}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.add(tile.index)
+
+
+def file_signature(path):
+    """
+    Size and modification time of a file.
+
+    :param str path: Path of the file
+
+    :return: signature
+    :rtype: list
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def output_fingerprint(inputs, params, names, *extra):
+    """
+    Fingerprint of an output file of conv2tif or prepifg: the signatures of
+    its input files, the values of the relevant configuration parameters
+    and any other values it depends on, e.g. the header or extents.
+
+    :param list inputs: Paths of the input files
+    :param dict params: Dictionary of configuration parameters
+    :param list names: Names of the relevant configuration parameters
+    :param extra: Other JSON serialisable values (optional)
+
+    :return: fingerprint: hexadecimal digest
+    :rtype: str
+    """
+    signatures = [[str(p), file_signature(p)] for p in inputs]
+    return stage_key(None, params, names, signatures, *extra)
+
+
+def _fingerprint_path(params, output):
+    return join(params[cf.TMPDIR], FINGERPRINT_DIR, basename(output) + '.json')
+
+
+def up_to_date(params, output, fingerprint):
+    """
+    True if the output file exists, unchanged since it was written from
+    inputs with the same fingerprint.
+
+    :param dict params: Dictionary of configuration parameters
+    :param str output: Path of the output file
+    :param str fingerprint: Fingerprint of the current inputs
+
+    :return: True if the output can be reused
+    :rtype: bool
+    """
+    path = _fingerprint_path(params, output)
+    if not (exists(output) and exists(path)):
+        return False
+    try:
+        with open(path) as f:
+            record = json.load(f)
+    except ValueError:
+        return False
+    return record['fingerprint'] == fingerprint and record['output'] == file_signature(output)
+
+
+def invalidate(params, output):
+    """
+    Discard the fingerprint of an output file before it is written again,
+    so an interrupted write is never taken as up to date.
+
+    :param dict params: Dictionary of configuration parameters
+    :param str output: Path of the output file
+    """
+    path = _fingerprint_path(params, output)
+    if exists(path):
+        os.remove(path)
+
+
+def record_fingerprint(params, output, fingerprint):
+    """
+    Record the fingerprint of the inputs of an output file once written.
+
+    :param dict params: Dictionary of configuration parameters
+    :param str output: Path of the output file
+    :param str fingerprint: Fingerprint of its inputs
+    """
+    path = _fingerprint_path(params, output)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'output': file_signature(output)}, f)
+    os.replace(tmp, path)
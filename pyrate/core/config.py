@@ -67,6 +67,8 @@ INTERFEROGRAM_FILES = 'interferogram_files'
 HEADER_FILE_PATHS = 'header_file_paths'
 COHERENCE_FILE_PATHS = 'coherence_file_paths'
 DEM_FILE_PATH = 'dem_file'
+# parsed headers of the run, see prepifg_helper.header_index
+HEADER_INDEX = 'header_index'
 
 # STR; The projection of the input interferograms.
 # TODO: only used in tests; deprecate?
@@ -111,6 +113,8 @@ REF_CHIP_SIZE = 'refchipsize'
 REF_MIN_FRAC = 'refminfrac'
 #: BOOL (1/2); Reference phase estimation method (1: median of the whole interferogram, 2: median within the window surrounding the reference pixel)
 REF_EST_METHOD = 'refest'
+#: INT; Multilook factor for a coarse-to-fine reference pixel search (1: fixed grid search only)
+REF_SEARCH_LOOKS = 'refsearchlks'
 
 # coherence masking parameters
 #: BOOL (0/1); Perform coherence masking (1: yes, 0: no)
@@ -195,7 +199,13 @@ TIME_SERIES_SM_FACTOR = 'smfactor'
 PARALLEL = 'parallel'
 #: INT; Number of processes for multi-threading
 PROCESSES = 'processes'
+#: INT; Memory budget per process in megabytes for choosing the tiling automatically (0: use rows and cols)
+TILE_MEMORY = 'tilemem'
+#: BOOL (0/1); Count the work of the per-pixel kernels of each tile in the run report
+KERNEL_COUNTERS = 'kernelcounters'
 LARGE_TIFS = 'largetifs'
+#: BOOL (0/1); Write GDAL VRTs reading the raw GAMMA/ROI_PAC files in conv2tif instead of GeoTIFF copies
+CONV2VRT = 'conv2vrt'
 # Orbital error correction constants for conversion to readable strings
 INDEPENDENT_METHOD = 1
 NETWORK_METHOD = 2
@@ -237,6 +247,7 @@ PARAM_CONVERSION = {
     REF_CHIP_SIZE: (int, 21),
     REF_MIN_FRAC: (float, 0.5),
     REF_EST_METHOD: (int, 1),  # default to average of whole image
+    REF_SEARCH_LOOKS: (int, 1),  # default to fixed grid search
 
     ORBITAL_FIT: (int, 0),
     ORBITAL_FIT_METHOD: (int, NETWORK_METHOD),
@@ -271,6 +282,9 @@ PARAM_CONVERSION = {
 
     PARALLEL: (int, 0),
     PROCESSES: (int, 8),
+    TILE_MEMORY: (int, 0),  # default to rows and cols
+    KERNEL_COUNTERS: (int, 0),
+    CONV2VRT: (int, 0),
     PROCESSOR: (int, None),
     NAN_CONVERSION: (int, 0),
     NO_DATA_AVERAGING_THRESHOLD: (float, 0.0),
@@ -669,6 +683,18 @@ _PARAM_VALIDATION = {
         lambda a: a >= 1,
         f"'{PROCESSES}': must be >= 1."
     ),
+    TILE_MEMORY: (
+        lambda a: a >= 0,
+        f"'{TILE_MEMORY}': must be >= 0."
+    ),
+    KERNEL_COUNTERS: (
+        lambda a: a in (0, 1),
+        f"'{KERNEL_COUNTERS}': must select option 0 or 1."
+    ),
+    CONV2VRT: (
+        lambda a: a in (0, 1),
+        f"'{CONV2VRT}': must select option 0 or 1."
+    ),
     PROCESSOR: (
         lambda a: a in (0, 1, 2),
         f"'{PROCESSOR}': must select option 0 or 1."
@@ -817,6 +843,10 @@ _REFERENCE_PIXEL_VALIDATION = {
         lambda a: a in (1, 2),
         f"'{REF_EST_METHOD}': must select option 1 or 2."
     ),
+    REF_SEARCH_LOOKS: (
+        lambda a: a >= 1,
+        f"'{REF_SEARCH_LOOKS}': must be >= 1."
+    ),
 }
 """dict: basic validation functions for reference pixel search parameters."""
 
@@ -119,6 +119,7 @@ def _add_metadata(ifg, maxvar, alpha):
     md = ifg.meta_data
     md[ifc.PYRATE_MAXVAR] = str(maxvar)
     md[ifc.PYRATE_ALPHA] = str(alpha)
+    # also saves the nan and millimetre converted phase
     ifg.write_modified_phase()
 
 
@@ -235,6 +235,45 @@ def get_header_paths(input_file, slc_file_list):
     return matches
 
 
+class HeaderIndex:
+    """
+    Parsed GAMMA headers of a run: the epoch headers of the header file list
+    by epoch, and the DEM header. Built once per run and passed to workers
+    in the parameters, see prepifg_helper.header_index, so gamma_header
+    looks up the headers of a file instead of parsing them again. Raises
+    GammaException if the list has several header files for an epoch.
+    """
+    def __init__(self, params):
+        self.dem_header = parse_dem_header(params[cf.DEM_HEADER_FILE])
+        self.epoch_headers = {}
+        paths = {}
+        for header_path in cf.parse_namelist(params[cf.HDR_FILE_LIST]):
+            header = parse_epoch_header(header_path)
+            for epoch in extract_epochs_from_filename(Path(header_path).name):
+                if paths.setdefault(epoch, header_path) != header_path:
+                    raise GammaException('Header files {} and {} are both for epoch {}'.format(
+                        paths[epoch], header_path, epoch))
+                self.epoch_headers[epoch] = header
+
+    def combined_header(self, input_file):
+        """
+        Combined header of an image file, as manage_headers.
+
+        :param str input_file: input GAMMA image file
+
+        :return: combined_header: Combined metadata dictionary
+        :rtype: dict
+        """
+        epochs = extract_epochs_from_filename(Path(input_file).name)
+        headers = [self.epoch_headers[e] for e in epochs if e in self.epoch_headers]
+        if len(headers) == 2:
+            return combine_headers(headers[0], headers[1], self.dem_header)
+        # probably have DEM or incidence file
+        combined_header = dict(self.dem_header)
+        combined_header[ifc.DATA_TYPE] = ifc.DEM
+        return combined_header
+
+
 def gamma_header(ifg_file_path, params):
     """
     Function to obtain combined Gamma headers for image file
@@ -247,9 +286,13 @@ def gamma_header(ifg_file_path, params):
         A combined header dictionary containing metadata from matching
         gamma headers and DEM header.   
     """
-    dem_hdr_path = params[cf.DEM_HEADER_FILE]
-    header_paths = get_header_paths(ifg_file_path, params[cf.HDR_FILE_LIST])
-    combined_headers = manage_headers(dem_hdr_path, header_paths)
+    index = params.get(cf.HEADER_INDEX)
+    if index is not None:
+        combined_headers = index.combined_header(ifg_file_path)
+    else:
+        dem_hdr_path = params[cf.DEM_HEADER_FILE]
+        header_paths = get_header_paths(ifg_file_path, params[cf.HDR_FILE_LIST])
+        combined_headers = manage_headers(dem_hdr_path, header_paths)
     if os.path.basename(ifg_file_path).split('.')[1] == \
             (params[cf.APS_INCIDENCE_EXT] or params[cf.APS_ELEVATION_EXT]):
         # TODO: implement incidence class here
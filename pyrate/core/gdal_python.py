@@ -30,6 +30,10 @@ from pyrate.core.logger import pyratelogger as log
 gdal.SetCacheMax(2**15)
 GDAL_WARP_MEMORY_LIMIT = 2**10
 LOW_FLOAT32 = np.finfo(np.float32).min*1e-10
+# approximate number of source cells held in memory at a time when streaming
+BAND_CELLS = 2 ** 24
+# creation options of the tiled geotiffs written by stream_crop_resample_average
+TILED_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'compress=packbits']
 
 
 def coherence_masking(input_gdal_dataset: Dataset,
@@ -43,24 +47,44 @@ def coherence_masking(input_gdal_dataset: Dataset,
      --outfile=test_v1.tif --calc="B*(A>=0.8)-999*(A<0.8)"
      --NoDataValue=-999
 
+    The raster is masked in bands of rows of about BAND_CELLS cells.
     """
 
     coherence_ds = gdal.Open(coherence_file_path, gdalconst.GA_ReadOnly)
     coherence_band = coherence_ds.GetRasterBand(1)
     src_band = input_gdal_dataset.GetRasterBand(1)
     ndv = np.nan
-    coherence = coherence_band.ReadAsArray()
-    src = src_band.ReadAsArray()
-    var = {"coh": coherence, "src": src, "t": coherence_thresh, "ndv": ndv}
-    formula = "where(coh>=t, src, ndv)"
-    res = ne.evaluate(formula, local_dict=var)
-    src_band.WriteArray(res)
+    band_rows = max(1, BAND_CELLS // max(1, src_band.XSize))
+    for top in range(0, src_band.YSize, band_rows):
+        rows = min(band_rows, src_band.YSize - top)
+        src = src_band.ReadAsArray(0, top, src_band.XSize, rows)
+        coherence = coherence_band.ReadAsArray(0, top, src_band.XSize, rows)
+        src_band.WriteArray(mask_coherence(src, coherence, coherence_thresh, ndv), 0, top)
     # update metadata
     input_gdal_dataset.GetRasterBand(1).SetNoDataValue(ndv)
     input_gdal_dataset.FlushCache()  # write on the disc
     log.info(f"Applied coherence masking using coh file {coherence_file_path}")
 
 
+def mask_coherence(src, coherence, coherence_thresh, ndv=np.nan):
+    """
+    Mask the cells of a block of data where the coherence is below the
+    threshold or NaN, in place, using the numexpr threads set by
+    shared.set_numexpr_threads.
+
+    :param ndarray src: Block of data, floating point
+    :param ndarray coherence: Coherence of the same block
+    :param float coherence_thresh: Coherence threshold
+    :param float ndv: Value of the masked cells
+
+    :return: src: masked data
+    :rtype: ndarray
+    """
+    var = {"coh": coherence, "src": src, "t": coherence_thresh, "ndv": ndv}
+    formula = "where(coh>=t, src, ndv)"
+    return ne.evaluate(formula, local_dict=var, out=src, casting='same_kind')
+
+
 def world_to_pixel(geo_transform, x, y):
     """
     Uses a gdal geomatrix (gdal.GetGeoTransform()) to calculate
@@ -278,10 +302,14 @@ def _gdalwarp_width_and_height(max_x, max_y, min_x, min_y, geo_trans):
 def crop_resample_average(
         input_tif, extents: Union[List, Tuple], new_res, output_file, thresh,
         out_driver_type='GTiff',
-        match_pyrate=False, hdr=None, coherence_path=None, coherence_thresh=None):
+        match_pyrate=False, hdr=None, coherence_path=None, coherence_thresh=None, band_rows=None):
     """
     Crop, resample, and average a geotiff image.
 
+    The source is read in bands of rows, a multiple of the looks high, so
+    only one band of it is held in memory at a time, and the averages of
+    each band are written to the output as they are computed.
+
     :param str input_tif: Path to input geotiff to resample/crop
     :param tuple extents: Cropping extents (xfirst, yfirst, xlast, ylast)
     :param list new_res: [xres, yres] resolution of output image
@@ -290,46 +318,93 @@ def crop_resample_average(
     :param str out_driver_type: The output driver; `MEM` or `GTiff` (optional)
     :param bool match_pyrate: Match Legacy output (optional)
     :param dict hdr: dictionary of metadata
+    :param int band_rows: Number of output rows per band (optional)
 
     :return: resampled_average: output cropped and resampled image
     :rtype: ndarray
     :return: out_ds: destination gdal dataset object
     :rtype: gdal.Dataset
     """
-    dst_ds, _, _, _ = _crop_resample_setup(extents, input_tif, new_res, output_file,
-                                           out_bands=2, dst_driver_type='MEM')
+    src_ds = gdal.Open(input_tif, gdalconst.GA_ReadOnly)
+    xlooks, ylooks, gt, nrows, ncols = _multilook_grid(src_ds, extents, new_res)
+    md = _multilooked_metadata(src_ds.GetMetadata(), hdr, coherence_path)
 
-    # make a temporary copy of the dst_ds for PyRate style prepifg
-    tmp_ds = gdal.GetDriverByName('MEM').CreateCopy('', dst_ds) if (match_pyrate and new_res[0]) else None
+    # In-memory GDAL driver doesn't support compression so turn it off.
+    creation_opts = ['compress=packbits'] if out_driver_type != 'MEM' else []
+    out_ds = shared.gdal_dataset(output_file, ncols, nrows,
+                                 driver=out_driver_type, bands=1, dtype=src_ds.GetRasterBand(1).DataType,
+                                 metadata=md, crs=src_ds.GetProjection(),
+                                 geotransform=gt, creation_opts=creation_opts)
+    if out_driver_type != 'MEM':
+        out_ds.GetRasterBand(1).SetNoDataValue(np.nan)
 
-    src_ds, src_ds_mem = _setup_source(input_tif)
+    # required to match Legacy output
+    legacy = _legacy_cells(src_ds, xlooks, ylooks, nrows, ncols) if (match_pyrate and new_res[0]) else None
+
+    resampled_average = np.empty((nrows, ncols), dtype=np.float32)
+    bands = _multilook_bands(input_tif, src_ds, extents, xlooks, ylooks, ncols, nrows, thresh,
+                             coherence_path, coherence_thresh, band_rows, nearest=legacy is not None)
+    for top, average, nearest in bands:
+        if legacy is not None:
+            cells = legacy[top:top + average.shape[0]]
+            average[cells] = nearest[cells]
+        resampled_average[top:top + average.shape[0]] = average
+        if out_driver_type != 'MEM':
+            out_ds.GetRasterBand(1).WriteArray(average, 0, top)
 
-    if coherence_path and coherence_thresh:
-        coherence_masking(src_ds_mem, coherence_path, coherence_thresh)
+    if out_driver_type != 'MEM':
+        out_ds.FlushCache()
+        log.info(f"Writing geotiff: {output_file}")
+    return resampled_average, out_ds
 
-    elif coherence_path and not coherence_thresh:
-        raise ValueError(f"Coherence file provided without a coherence "
-                         f"threshold. Please ensure you provide 'cohthresh' "
-                         f"in your config if coherence masking is enabled.")
 
-    resampled_average, src_ds_mem = gdal_average(dst_ds, src_ds, src_ds_mem, thresh)
-    src_ds = None
-    src_dtype = src_ds_mem.GetRasterBand(1).DataType
-    src_gt = src_ds_mem.GetGeoTransform()
+def stream_crop_resample_average(
+        input_tif, extents: Union[List, Tuple], new_res, output_file, thresh,
+        hdr=None, coherence_path=None, coherence_thresh=None, band_rows=None):
+    """
+    Crop, resample, and average a geotiff image as crop_resample_average,
+    writing each multilooked band of rows straight into a tiled geotiff
+    without keeping the output in memory either, so this is suited to
+    large interferograms.
 
-    # required to match Legacy output
-    if tmp_ds:
-        _alignment(input_tif, new_res, resampled_average, src_ds_mem, src_gt, tmp_ds)
+    :param str input_tif: Path to input geotiff to resample/crop
+    :param tuple extents: Cropping extents (xfirst, yfirst, xlast, ylast)
+    :param list new_res: [xres, yres] resolution of output image
+    :param str output_file: Path to output resampled/cropped geotiff
+    :param float thresh: NaN fraction threshold
+    :param dict hdr: dictionary of metadata
+    :param str coherence_path: Path to coherence geotiff for masking (optional)
+    :param float coherence_thresh: Coherence threshold (optional)
+    :param int band_rows: Number of output rows per band (optional)
+
+    :return: None, file saved to disk
+    """
+    src_ds = gdal.Open(input_tif, gdalconst.GA_ReadOnly)
+    xlooks, ylooks, gt, nrows, ncols = _multilook_grid(src_ds, extents, new_res)
+    md = _multilooked_metadata(src_ds.GetMetadata(), hdr, coherence_path)
+    out_ds = shared.gdal_dataset(output_file, ncols, nrows, driver='GTiff', bands=1,
+                                 dtype=src_ds.GetRasterBand(1).DataType, metadata=md, crs=src_ds.GetProjection(),
+                                 geotransform=gt, creation_opts=TILED_OPTIONS)
+    out_band = out_ds.GetRasterBand(1)
+    out_band.SetNoDataValue(np.nan)
+
+    for top, average, _ in _multilook_bands(input_tif, src_ds, extents, xlooks, ylooks, ncols, nrows, thresh,
+                                            coherence_path, coherence_thresh, band_rows):
+        out_band.WriteArray(average, 0, top)
+
+    out_ds.FlushCache()
+    out_ds = None
+    log.info(f"Writing geotiff: {output_file}")
 
-    # grab metadata from existing geotiff
-    gt = dst_ds.GetGeoTransform()
-    wkt = dst_ds.GetProjection()
 
+def _multilooked_metadata(md, hdr, coherence_path):
+    """
+    Metadata of a multilooked/cropped output from the metadata of its
+    source, with the data type updated
+    """
     # TEST HERE IF EXISTING FILE HAS PYRATE METADATA. IF NOT ADD HERE
-    if ifc.DATA_TYPE not in dst_ds.GetMetadata() and hdr is not None:
+    if ifc.DATA_TYPE not in md and hdr is not None:
         md = shared.collate_metadata(hdr)
-    else:
-        md = dst_ds.GetMetadata()
 
     # update metadata for output
 
@@ -353,94 +428,107 @@ def crop_resample_average(
                 pass
             else:
                 raise TypeError(f'Data Type metadata {v} not recognised')
+    return md
 
-    # In-memory GDAL driver doesn't support compression so turn it off.
-    creation_opts = ['compress=packbits'] if out_driver_type != 'MEM' else []
-    out_ds = shared.gdal_dataset(output_file, dst_ds.RasterXSize, dst_ds.RasterYSize,
-                                 driver=out_driver_type, bands=1, dtype=src_dtype, metadata=md, crs=wkt,
-                                 geotransform=gt, creation_opts=creation_opts)
 
-    if out_driver_type != 'MEM':
-        shared.write_geotiff(resampled_average, out_ds, np.nan)
-        log.info(f"Writing geotiff: {output_file}")
-    return resampled_average, out_ds
+def _multilook_grid(src_ds, extents, new_res):
+    """
+    Looks, geotransform and size (rows, columns) of the cropped and
+    multilooked grid of a source dataset
+    """
+    src_gt = src_ds.GetGeoTransform()
+    min_x, min_y, max_x, max_y = extents
+    if new_res[0]:  # if new_res is not None, it can't be zero either
+        xlooks, ylooks = int(round(new_res[0] / src_gt[1])), int(round(new_res[1] / src_gt[5]))
+    else:
+        xlooks = ylooks = 1
+    gt = [min_x, xlooks * src_gt[1], src_gt[2], max_y, src_gt[4], ylooks * src_gt[5]]
+    nrows, ncols = _gdalwarp_width_and_height(max_x, max_y, min_x, min_y, gt)
+    return xlooks, ylooks, gt, nrows, ncols
 
 
-def _alignment(input_tif, new_res, resampled_average, src_ds_mem,
-                      src_gt, tmp_ds):
+def _legacy_cells(src_ds, xlooks, ylooks, nrows, ncols):
     """
-    Correction step to match python multi-look/crop output to match that of
-    Legacy data. Modifies the resampled_average array in place.
+    Mask of the output cells beyond the Legacy output size, which take the
+    nearest neighbour of the source instead of the average to match Legacy
+    output
     """
-    src_ds = gdal.Open(input_tif)
-    data = src_ds.GetRasterBand(1).ReadAsArray()
-    xlooks = ylooks = int(new_res[0] / src_gt[1])
-    xres, yres = _get_resampled_data_size(xlooks, ylooks, data)
-    nrows, ncols = resampled_average.shape
-    # Legacy nearest neighbor resampling for the last
-    # [yres:nrows, xres:ncols] cells without nan_conversion
-    # turn off nan-conversion
-    src_ds_mem.GetRasterBand(1).SetNoDataValue(LOW_FLOAT32)
-    # nearest neighbor resapling
-    gdal.ReprojectImage(src_ds_mem, tmp_ds, '', '', gdal.GRA_NearestNeighbour)
-    # only take the [yres:nrows, xres:ncols] slice
+    xres, yres = int(src_ds.RasterXSize / xlooks), int(src_ds.RasterYSize / ylooks)
+    cells = np.zeros((nrows, ncols), dtype=bool)
     if nrows > yres or ncols > xres:
-        resampled_nearest_neighbor = tmp_ds.GetRasterBand(1).ReadAsArray()
-        resampled_average[yres - nrows:, xres - ncols:] = \
-            resampled_nearest_neighbor[yres - nrows:, xres - ncols:]
+        cells[yres - nrows:, xres - ncols:] = True
+    return cells
 
 
-def gdal_average(dst_ds, src_ds, src_ds_mem, thresh):
+def _multilook_bands(input_tif, src_ds, extents, xlooks, ylooks, ncols, nrows, thresh,
+                     coherence_path=None, coherence_thresh=None, band_rows=None, nearest=False):
     """
-    Perform subsampling of an image by averaging values
+    Generator of the multilooked output in bands of rows. The source is
+    read one band at a time, phase nodata converted to NaN, coherence masked
+    and block averaged, see _nan_fraction_average.
 
-    :param gdal.Dataset dst_ds: Destination gdal dataset object
-    :param str input_tif: Input geotif
-    :param float thresh: NaN fraction threshold
+    :return: row offset of the band, averages, and the nearest neighbour
+        source values if nearest, else None
+    """
+    if coherence_path and not coherence_thresh:
+        raise ValueError(f"Coherence file provided without a coherence "
+                         f"threshold. Please ensure you provide 'cohthresh' "
+                         f"in your config if coherence masking is enabled.")
 
-    :return resampled_average: resampled image data
-    :rtype: ndarray
-    :return src_ds_mem: Modified in memory src_ds with nan_fraction in Band2. The nan_fraction
-        is computed efficiently here in gdal in the same step as the that of
-        the resampled average (band 1). This results is huge memory and
-        computational efficiency
-    :rtype: gdal.Dataset
+    src_band = src_ds.GetRasterBand(1)
+    coh_band = gdal.Open(coherence_path, gdalconst.GA_ReadOnly).GetRasterBand(1) if coherence_path else None
+    is_ifg = isinstance(shared.dem_or_ifg(data_path=input_tif), shared.Ifg)
+    # source pixel of the upper left corner of the output, may be outside the source
+    col0, row0 = world_to_pixel(src_ds.GetGeoTransform(), extents[0], extents[3])
+
+    if band_rows is None:
+        band_rows = max(1, BAND_CELLS // max(1, ncols * xlooks * ylooks))
+    for top in range(0, nrows, band_rows):
+        rows = min(band_rows, nrows - top)
+        window = (col0, row0 + top * ylooks, ncols * xlooks, rows * ylooks)
+        data, inside = _read_window(src_band, *window)
+        if is_ifg:
+            data[np.isclose(data, 0, atol=1e-6)] = np.nan  # nan conversion of phase data
+        if coh_band is not None:
+            coherence, _ = _read_window(coh_band, *window)
+            mask_coherence(data, coherence, coherence_thresh)
+        average = _nan_fraction_average(data, inside, xlooks, ylooks, thresh).astype(np.float32)
+        # the source pixel containing the centre of each output cell, zero outside the source
+        centre = np.s_[ylooks // 2::ylooks, xlooks // 2::xlooks]
+        yield top, average, np.where(inside[centre], data[centre], 0) if nearest else None
+
+
+def _read_window(band, xoff, yoff, xsize, ysize):
     """
-    src_gt = src_ds.GetGeoTransform()
-    src_ds_mem.SetGeoTransform(src_gt)
-    data = src_ds_mem.GetRasterBand(1).ReadAsArray()
-    # update nan_matrix
-    # if data==nan, then 1, else 0
-    nan_matrix = np.isnan(data)  # all nans due to phase data + coh masking if used
-    src_ds_mem.GetRasterBand(2).WriteArray(nan_matrix)
-    gdal.ReprojectImage(src_ds_mem, dst_ds, '', '', gdal.GRA_Average)
-    # dst_ds band2 average is our nan_fraction matrix
-    nan_frac = dst_ds.GetRasterBand(2).ReadAsArray()
-    resampled_average = dst_ds.GetRasterBand(1).ReadAsArray()
-    resampled_average[nan_frac >= thresh] = np.nan
-    return resampled_average, src_ds_mem
-
-
-def _setup_source(input_tif):
-    """convenience setup function for gdal_average"""
-    src_ds = gdal.Open(input_tif)
-    data = src_ds.GetRasterBand(1).ReadAsArray()
-    src_dtype = src_ds.GetRasterBand(1).DataType
-    mem_driver = gdal.GetDriverByName('MEM')
-    src_ds_mem = mem_driver.Create('', src_ds.RasterXSize, src_ds.RasterYSize, 2, src_dtype)
-    if isinstance(shared.dem_or_ifg(data_path=input_tif), shared.Ifg):
-        data[np.isclose(data, 0, atol=1e-6)] = np.nan   # nan conversion of phase data
-    src_ds_mem.GetRasterBand(1).WriteArray(data)
-    src_ds_mem.GetRasterBand(1).SetNoDataValue(np.nan)
-    src_ds_mem.GetRasterBand(2).SetNoDataValue(np.nan)
-    src_ds_mem.SetGeoTransform(src_ds.GetGeoTransform())
-    return src_ds, src_ds_mem
-
-
-def _get_resampled_data_size(xscale, yscale, data):
-    """convenience function mimicking the Legacy output size"""
-    xscale = int(xscale)
-    yscale = int(yscale)
-    ysize, xsize = data.shape
-    xres, yres = int(xsize / xscale), int(ysize / yscale)
-    return xres, yres
+    Read a window of a raster band which may extend outside the raster.
+    Returns the data as float64, NaN outside the raster, and a mask of the
+    cells inside the raster.
+    """
+    data = np.full((ysize, xsize), np.nan)
+    inside = np.zeros((ysize, xsize), dtype=bool)
+    x0, y0 = max(xoff, 0), max(yoff, 0)
+    x1, y1 = min(xoff + xsize, band.XSize), min(yoff + ysize, band.YSize)
+    if x1 > x0 and y1 > y0:
+        data[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        inside[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = True
+    return data, inside
+
+
+def _nan_fraction_average(data, inside, xlooks, ylooks, thresh):
+    """
+    Block average of the non-NaN cells of data, with the blocks where the
+    fraction of NaN cells among the cells inside the source raster is at
+    least thresh set to NaN. This is the GDAL average resampling of the
+    data and of its NaN mask on grids aligned with the source.
+    """
+    rows, cols = data.shape[0] // ylooks, data.shape[1] // xlooks
+    shape = (rows, ylooks, cols, xlooks)
+    nans = np.isnan(data)
+    valid = np.count_nonzero((inside & ~nans).reshape(shape), axis=(1, 3))
+    existing = np.count_nonzero(inside.reshape(shape), axis=(1, 3))
+    total = np.where(nans, 0, data).reshape(shape).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        nan_frac = 1 - valid / existing
+        average = total / valid
+    average[~(nan_frac < thresh) | (valid == 0)] = np.nan
+    return average
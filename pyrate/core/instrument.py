@@ -0,0 +1,407 @@
+#   This Python module is part of the PyRate software package.
+#
+#   Copyright 2020 Geoscience Australia
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+This Python module contains the instrumentation of PyRate stages: wall and
+CPU time, peak memory, bytes read and written and pixels processed per stage
+and MPI process, and optional counters of the per-pixel kernels per tile,
+written as a JSON report for each run
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import join, dirname
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+import numpy as np
+
+from pyrate.core import mpiops
+from pyrate.core.logger import pyratelogger as log
+
+# measurements of this process, by stage name
+_stages = OrderedDict()
+# names of the enclosing stages
+_current = []
+# peak resident set size of each enclosing stage so far, None if not measured
+_peaks = []
+# kernel counters by stage name and tile index
+_tiles = OrderedDict()
+# kernel counters of the current tile, None if not counting
+_counters = None
+_counting = False
+
+FIELDS = ['calls', 'wall', 'cpu', 'peak_rss', 'process_peak_rss', 'read_bytes', 'write_bytes', 'pixels']
+# registers of the distinct pattern estimate, with a standard error of
+# 1.04 / sqrt(PATTERN_REGISTERS)
+PATTERN_BITS = 12
+PATTERN_REGISTERS = 2 ** PATTERN_BITS
+
+
+def _process_peak_rss():
+    """
+    Peak resident set size of this process in bytes, since it started.
+    """
+    if resource is None:  # pragma: no cover
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _rss_high_water_mark():
+    """
+    Peak resident set size of this process in bytes since the last
+    _reset_rss_high_water_mark, where the operating system provides it
+    (Linux).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_rss_high_water_mark():
+    """
+    Reset the peak resident set size of this process to the current
+    resident set size, where the operating system allows it (Linux 4.0 and
+    later).
+
+    :return: True if reset
+    :rtype: bool
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _io_bytes():
+    """
+    Bytes read from and written to storage by this process, where the
+    operating system provides them (Linux).
+    """
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io['read_bytes']), int(io['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _diff(end, start):
+    return None if end is None or start is None else end - start
+
+
+def _add(a, b):
+    return b if a is None else (a if b is None else a + b)
+
+
+def _max(a, b):
+    return b if a is None else (a if b is None else max(a, b))
+
+
+@contextmanager
+def stage(name):
+    """
+    Context manager measuring a stage. Nested stages are recorded under the
+    names of the enclosing stages joined with '/'. A stage entered several
+    times accumulates its measurements, and peak_rss is the largest peak of
+    its calls.
+
+    The peak resident set size of the stage is measured by resetting the
+    peak of the process when the stage is entered, where the operating
+    system allows it, otherwise it is None. The peak of the process since it
+    started is recorded as process_peak_rss.
+
+    :param str name: Name of the stage
+    """
+    # the peak so far belongs to the enclosing stage
+    if _peaks and _peaks[-1] is not None:
+        _peaks[-1] = _max(_peaks[-1], _rss_high_water_mark())
+    _peaks.append(0 if _reset_rss_high_water_mark() else None)
+    _current.append(name)
+    path = '/'.join(_current)
+    wall, cpu = time.perf_counter(), time.process_time()
+    read, write = _io_bytes()
+    try:
+        yield
+    finally:
+        end_read, end_write = _io_bytes()
+        peak = _peaks.pop()
+        if peak is not None:
+            peak = _max(peak, _rss_high_water_mark())
+            if _peaks and _peaks[-1] is not None:
+                _peaks[-1] = max(_peaks[-1], peak)
+        record = _stages.setdefault(path, dict.fromkeys(FIELDS))
+        record['calls'] = _add(record['calls'], 1)
+        record['wall'] = _add(record['wall'], time.perf_counter() - wall)
+        record['cpu'] = _add(record['cpu'], time.process_time() - cpu)
+        record['peak_rss'] = _max(record['peak_rss'], peak)
+        record['process_peak_rss'] = _process_peak_rss()
+        record['read_bytes'] = _add(record['read_bytes'], _diff(end_read, read))
+        record['write_bytes'] = _add(record['write_bytes'], _diff(end_write, write))
+        _current.pop()
+
+
+def timed(name):
+    """
+    Decorator measuring each call of a function as a stage.
+
+    :param str name: Name of the stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_pixels(n):
+    """
+    Add to the number of pixels processed by the current stage.
+
+    :param int n: Number of pixels
+    """
+    if not _current:
+        return
+    record = _stages.setdefault('/'.join(_current), dict.fromkeys(FIELDS))
+    record['pixels'] = _add(record['pixels'], int(n))
+
+
+class KernelCounters:
+    """
+    Counters of the per-pixel kernels of a tile, e.g. pixels visited,
+    pixels skipped as all NaN or iterations. Distinct observation patterns
+    are counted approximately, in fixed memory per counter, with a
+    HyperLogLog sketch of the hashed indices of the observations used.
+    """
+    def __init__(self):
+        self.counts = Counter()
+        self.patterns = {}
+
+    def add(self, name, n=1):
+        """
+        Increment a counter.
+
+        :param str name: Name of the counter
+        :param int n: Increment
+        """
+        self.counts[name] += n
+
+    def pattern(self, name, ind):
+        """
+        Record the observation pattern of a pixel.
+
+        :param str name: Name of the counter
+        :param ndarray ind: Indices or mask of the observations used
+        """
+        registers = self.patterns.get(name)
+        if registers is None:
+            registers = self.patterns[name] = np.zeros(PATTERN_REGISTERS, dtype=np.uint8)
+        h = int.from_bytes(hashlib.blake2b(ind.tobytes(), digest_size=8).digest(), 'little')
+        j, w = h & (PATTERN_REGISTERS - 1), h >> PATTERN_BITS
+        # position of the first set bit of the remaining hash bits
+        rank = 64 - PATTERN_BITS - w.bit_length() + 1
+        if rank > registers[j]:
+            registers[j] = rank
+
+    def result(self):
+        """
+        :return: counts, with the estimated number of distinct patterns
+        :rtype: dict
+        """
+        result = {k: int(v) for k, v in self.counts.items()}
+        result.update({k: _distinct(v) for k, v in self.patterns.items()})
+        return result
+
+
+def _distinct(registers):
+    """
+    HyperLogLog estimate of the number of distinct values, using linear
+    counting of the empty registers for small numbers.
+    """
+    m = len(registers)
+    zeros = np.count_nonzero(registers == 0)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(2.0 ** -registers.astype(np.float64))
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * np.log(m / zeros)
+    return int(round(estimate))
+
+
+def enable_counters(enabled=True):
+    """
+    Enable or disable the kernel counters, see tile_counters.
+
+    :param bool enabled: True to count
+    """
+    global _counting
+    _counting = bool(enabled)
+
+
+def counters():
+    """
+    Kernel counters of the current tile.
+
+    :return: counters, or None if not counting
+    :rtype: KernelCounters
+    """
+    return _counters
+
+
+@contextmanager
+def tile_counters(index):
+    """
+    Context manager collecting the kernel counters of a tile, if enabled,
+    for the report of the current stage. Counters of a tile entered several
+    times are accumulated. Kernels only count when called by this process,
+    not by joblib workers.
+
+    :param int index: Tile index
+    """
+    global _counters
+    if not _counting:
+        yield
+        return
+    tiles = _tiles.setdefault('/'.join(_current), OrderedDict())
+    _counters = tiles.setdefault(int(index), KernelCounters())
+    try:
+        yield
+    finally:
+        _counters = None
+
+
+def _summary(records):
+    """
+    Aggregate the measurements of a stage over MPI processes.
+    """
+    def values(k):
+        return [r[k] for r in records if r is not None and r[k] is not None]
+
+    walls = values('wall')
+    summary = OrderedDict()
+    summary['processes'] = len(values('calls'))
+    summary['wall_max'] = max(walls) if walls else None
+    summary['wall_mean'] = sum(walls) / len(walls) if walls else None
+    # ratio of the slowest process to the mean, 1 if perfectly balanced
+    summary['imbalance'] = summary['wall_max'] / summary['wall_mean'] if walls and summary['wall_mean'] else None
+    summary['cpu'] = sum(values('cpu')) if values('cpu') else None
+    summary['peak_rss_max'] = max(values('peak_rss')) if values('peak_rss') else None
+    summary['process_peak_rss_max'] = max(values('process_peak_rss')) if values('process_peak_rss') else None
+    for k in ['read_bytes', 'write_bytes', 'pixels']:
+        summary[k] = sum(values(k)) if values(k) else None
+    return summary
+
+
+def report():
+    """
+    Measurements of all stages from all MPI processes, with a summary per
+    stage. Must be called by all processes.
+
+    :return: report on the master process, None on other processes
+    :rtype: dict
+    """
+    tiles = {n: {i: c.result() for i, c in t.items()} for n, t in _tiles.items()}
+    patterns = {n: _merge_patterns(c.patterns for c in t.values()) for n, t in _tiles.items()}
+    gathered = mpiops.comm.gather((dict(_stages), tiles, patterns), root=0)
+    if mpiops.rank != 0:
+        return None
+    names = []
+    for stages, _, _ in gathered:
+        names += [n for n in stages if n not in names]
+    result = OrderedDict()
+    for n in names:
+        records = [stages.get(n) for stages, _, _ in gathered]
+        result[n] = OrderedDict([('summary', _summary(records)), ('processes', records)])
+        tiles = OrderedDict(sorted((i, c) for _, t, _ in gathered for i, c in t.get(n, {}).items()))
+        if tiles:
+            # patterns recurring in several tiles are counted once
+            merged = _merge_patterns(p.get(n, {}) for _, _, p in gathered)
+            total = Counter()
+            for c in tiles.values():
+                total.update({k: v for k, v in c.items() if k not in merged})
+            total.update({k: _distinct(r) for k, r in merged.items()})
+            result[n]['summary']['counters'] = dict(total)
+            result[n]['tiles'] = tiles
+    return result
+
+
+def _merge_patterns(patterns):
+    """
+    Merge the distinct pattern registers of several tiles or processes, by
+    name, into the registers of the union of their patterns.
+    """
+    merged = {}
+    for p in patterns:
+        for k, registers in p.items():
+            merged[k] = registers.copy() if k not in merged else np.maximum(merged[k], registers)
+    return merged
+
+
+def _log_dir():
+    """
+    Directory of the PyRate log file, or the working directory if there is
+    no log file.
+    """
+    for handler in log.handlers:
+        if isinstance(handler, logging.FileHandler):
+            return dirname(handler.baseFilename)
+    return os.getcwd()
+
+
+def write_report(step_name):
+    """
+    Write the report of a run as JSON next to the log file of the step.
+
+    :param str step_name: Name of the PyRate step, e.g. process
+
+    :return: path of the report on the master process
+    :rtype: str
+    """
+    stages = report()
+    if mpiops.rank != 0:
+        return None
+    path = join(_log_dir(), 'pyrate.report.{}.{}.json'.format(step_name, datetime.now().strftime('%Y%m%dT%H%M%S')))
+    with open(path, 'w') as f:
+        json.dump(OrderedDict([('command', step_name), ('processes', mpiops.size), ('stages', stages)]), f, indent=2)
+    log.info('Wrote run report {}'.format(path))
+    return path
+
+
+def reset():
+    """
+    Discard all measurements.
+    """
+    _stages.clear()
+    _tiles.clear()
+    del _current[:]
+    del _peaks[:]
@@ -74,6 +74,100 @@ def array_split(arr: Iterable, process: int = None) -> np.ndarray:
     return np.array_split(arr, size)[r]
 
 
+class SharedCounter:
+    """
+    Counter shared by all MPI processes through a one-sided MPI window on
+    rank 0. Creating and freeing the counter are collective operations:
+    all processes must create it, and all must call free once they have
+    finished with it, outside of any loop that may end early.
+    """
+    def __init__(self):
+        self._win = None
+        self._value = 0
+        if size > 1:
+            self._counter = np.zeros(1, dtype=np.int64)
+            self._win = MPI.Win.Create(self._counter if rank == 0 else None, comm=comm)
+
+    def next(self) -> int:
+        """
+        Atomically increment the counter.
+
+        :return: value of the counter before the increment
+        :rtype: int
+        """
+        if self._win is None:
+            self._value += 1
+            return self._value - 1
+        one = np.ones(1, dtype=np.int64)
+        n = np.empty(1, dtype=np.int64)
+        self._win.Lock(0)
+        self._win.Fetch_and_op(one, n, 0, 0, MPI.SUM)
+        self._win.Unlock(0)
+        return int(n[0])
+
+    def free(self):
+        """
+        Free the MPI window. Must be called by all processes.
+        """
+        if self._win is not None:
+            self._win.Free()
+            self._win = None
+
+
+def dynamic_split(arr: Iterable, costs: Iterable = None, counter: SharedCounter = None) -> Iterable:
+    """
+    Generator distributing array elements across MPI processes on demand.
+    Unlike array_split, elements are not assigned in advance: each process
+    takes the next unprocessed element from a SharedCounter whenever it is
+    ready, so processes with cheap elements take more of them. Elements are
+    handed out in order of decreasing cost. The counter is created and
+    freed by the caller on all processes, e.g.
+
+        counter = mpiops.SharedCounter()
+        for t in mpiops.dynamic_split(tiles, costs, counter):
+            ...
+        counter.free()
+
+    :param list arr: Elements to distribute, e.g. tiles
+    :param list costs: Estimated cost of each element (optional)
+    :param SharedCounter counter: Counter shared by all processes, starting
+        at zero. Only optional with a single process.
+
+    :return Generator of the elements processed by this process
+    :rtype: generator
+    """
+    arr = list(arr)
+    if costs is None:
+        order = range(len(arr))
+    else:
+        order = np.argsort(-np.asarray(costs), kind='stable')
+    if counter is None:
+        if size > 1:
+            raise ValueError('dynamic_split requires a SharedCounter with more than one process')
+        counter = SharedCounter()
+    while True:
+        n = counter.next()
+        if n >= len(arr):
+            return
+        yield arr[order[n]]
+
+
+def mask_or(mask: np.ndarray) -> np.ndarray:
+    """
+    Combine a boolean mask from all MPI processes with a logical OR. The mask
+    is packed to one bit per element and reduced in place using MPI buffer
+    operations, so no pickling of full size arrays is required.
+
+    :param ndarray mask: Boolean mask of the same shape in every process
+
+    :return: Mask that is True where the mask of any process is True
+    :rtype: ndarray
+    """
+    packed = np.packbits(mask)
+    comm.Allreduce(MPI.IN_PLACE, packed, op=MPI.BOR)
+    return np.unpackbits(packed, count=mask.size).reshape(mask.shape).astype(bool)
+
+
 def sum_axis_0(x, y, dtype):
     s = np.sum([x, y], axis=0)
     return s
@@ -19,6 +19,7 @@ This Python module implements the minimum spanning tree
 functionality for selecting interferometric observations.
 """
 # pylint: disable=invalid-name
+from copy import copy
 from itertools import product
 from numpy import array, nan, isnan, float32, empty, sum as nsum
 import numpy as np
@@ -28,8 +29,8 @@ from joblib import Parallel, delayed
 
 from pyrate.core.algorithm import ifg_date_lookup
 from pyrate.core.algorithm import ifg_date_index_lookup
-from pyrate.core import config as cf
-from pyrate.core.shared import IfgPart, create_tiles
+from pyrate.core import config as cf, instrument
+from pyrate.core.shared import IfgPart, PrereadIfg, create_tiles
 from pyrate.core.shared import joblib_log_level
 from pyrate.core.logger import pyratelogger as log
 
@@ -86,21 +87,22 @@ def mst_parallel(ifgs, params):
     ncpus = params[cf.PROCESSES]
     no_ifgs = len(ifgs)
     no_y, no_x = ifgs[0].phase_data.shape
-    tiles = create_tiles(ifgs[0].shape)
+    tiles = create_tiles(ifgs[0].shape, block_shape=ifgs[0].block_shape)
     no_tiles = len(tiles)
     # need to break up the ifg class as multiprocessing does not allow pickling
     # don't read in all the phase data at once
     # use data paths and locally read in each core/process,
-    # gdal read is very fast
+    # gdal windowed read of each tile is very fast
     ifg_paths = [i.data_path for i in ifgs]
+    headers = {i.data_path: _header(i) for i in ifgs}
     result = empty(shape=(no_ifgs, no_y, no_x), dtype=np.bool)
 
     if params[cf.PARALLEL]:
         log.info('Calculating MST using {} tiles in parallel using {} ' \
                  'processes'.format(no_tiles, ncpus))
-        t_msts = Parallel(n_jobs=params[cf.PROCESSES], 
+        t_msts = Parallel(n_jobs=params[cf.PROCESSES], batch_size=1,
                           verbose=joblib_log_level(cf.LOG_LEVEL))(
-            delayed(mst_multiprocessing)(t, ifg_paths, params=params)
+            delayed(mst_multiprocessing)(t, ifg_paths, headers, params)
             for t in tiles)
         for k, tile in enumerate(tiles):
             result[:, tile.top_left_y:tile.bottom_right_y,
@@ -110,11 +112,23 @@ def mst_parallel(ifgs, params):
         for k, tile in enumerate(tiles):
             result[:, tile.top_left_y:tile.bottom_right_y,
                    tile.top_left_x: tile.bottom_right_x] = \
-                mst_multiprocessing(tile, ifg_paths, params=params)
+                mst_multiprocessing(tile, ifg_paths, headers, params)
 
     return result
 
 
+def _header(ifg):
+    """
+    Header of an ifg for tile reads; without a phase store index each tile
+    is read from the geotiff. The ifg is not modified.
+    """
+    if ifg.nodata_value is None:
+        ifg = copy(ifg)
+        ifg.nodata_value = 0
+    return PrereadIfg(ifg.data_path, ifg.nan_fraction, ifg.master, ifg.slave,
+                      ifg.time_span, ifg.nrows, ifg.ncols, ifg.meta_data)
+
+
 def mst_multiprocessing(tile, ifgs_or_paths, preread_ifgs=None, params=None):
     """
     Wrapper function for calculating MST matrix for a tile
@@ -234,19 +248,30 @@ def mst_matrix_networkx(ifgs):
 
     # create MSTs for each pixel in the ifg data stack
     nifgs = len(ifgs)
+    counters = instrument.counters()
 
     for y, x in product(range(ifgs[0].nrows), range(ifgs[0].ncols)):
         values = data_stack[:, y, x]  # vertical stack of ifg values for a pixel
         nan_count = nsum(isnan(values))
+        if counters is not None:
+            counters.add('mst.pixels')
 
         # optimisations: use pre-created results for all nans/no nans
         if nan_count == 0:
+            if counters is not None:
+                counters.add('mst.no_nan')
             yield y, x, edges
             continue
         elif nan_count == nifgs:
+            if counters is not None:
+                counters.add('mst.all_nan')
             yield y, x, nan
             continue
 
+        if counters is not None:
+            counters.add('mst.graphs')
+            counters.pattern('mst.patterns', isnan(values))
+
         # dynamically modify graph to reuse a single graph: this should avoid
         # repeatedly creating new graph objs & reduce RAM use
         ebunch_add = []
@@ -305,7 +305,7 @@ def _save_orbital_error_corrected_phase(ifg):
     orbital fit correction
     """
     # set orbfit tags after orbital error correction
-    ifg.dataset.SetMetadataItem(ifc.PYRATE_ORBITAL_ERROR, ifc.ORB_REMOVED)
+    ifg.meta_data[ifc.PYRATE_ORBITAL_ERROR] = ifc.ORB_REMOVED
     ifg.write_modified_phase()
     ifg.close()
 
@@ -25,11 +25,12 @@ from math import modf
 from numbers import Number
 from decimal import Decimal
 
-from numpy import array, nan, isnan, nanmean, float32, zeros, sum as nsum
+import numpy as np
+from numpy import array, nan, isnan, float32
 from osgeo import gdal
 
-from pyrate.core.gdal_python import crop_resample_average
-from pyrate.core import config as cf
+from pyrate.core.gdal_python import crop_resample_average, stream_crop_resample_average
+from pyrate.core import config as cf, instrument, gamma, roipac
 from pyrate.core.shared import output_tiff_filename, dem_or_ifg
 
 CustomExts = namedtuple('CustExtents', ['xfirst', 'yfirst', 'xlast', 'ylast'])
@@ -43,6 +44,8 @@ ALREADY_SAME_SIZE = 4
 CROP_OPTIONS = [MINIMUM_CROP, MAXIMUM_CROP, CUSTOM_CROP, ALREADY_SAME_SIZE]
 
 GRID_TOL = 1e-6
+# maximum number of source cells resampled at once
+RESAMPLE_BAND_CELLS = 2 ** 24
 
 
 def get_analysis_extent(crop_opt, rasters, xlooks, ylooks, user_exts):
@@ -144,8 +147,27 @@ def _get_extents(ifgs, crop_opt, user_exts=None):
     return extents
 
 
+def header_index(params):
+    """
+    Parse the headers of a run once, for gamma_header or roipac_header to
+    look up the header of each file. The index is picklable, so it can be
+    stored in the parameters passed to the worker processes.
+
+    :param dict params: Dictionary of configuration parameters
+
+    :return: index: header index of the processor
+    :rtype: gamma.HeaderIndex or roipac.HeaderIndex
+    """
+    processor = params[cf.PROCESSOR]  # roipac, gamma or geotif
+    if processor in (1, 2):
+        return gamma.HeaderIndex(params)
+    elif processor == 0:
+        return roipac.HeaderIndex(params)
+    raise PreprocessError('Processor must be ROI_PAC (0) or GAMMA (1)')
+
+
 def prepare_ifg(raster_path, xlooks, ylooks, exts, thresh, crop_opt, write_to_disk=True, out_path=None, header=None,
-                coherence_path=None, coherence_thresh=None):
+                coherence_path=None, coherence_thresh=None, stream=False):
     """
     Open, resample, crop and optionally save to disk an interferogram or DEM.
     Returns are only given if write_to_disk=False
@@ -161,6 +183,8 @@ def prepare_ifg(raster_path, xlooks, ylooks, exts, thresh, crop_opt, write_to_di
     :param bool write_to_disk: Write new data to disk
     :param str out_path: Path for output file
     :param dict header: dictionary of metadata from header file
+    :param bool stream: Stream the raster in bands of rows into a tiled
+        geotiff on disk, for large rasters; nothing is returned
 
     :return: resampled_data: output cropped and resampled image
     :rtype: ndarray
@@ -173,6 +197,7 @@ def prepare_ifg(raster_path, xlooks, ylooks, exts, thresh, crop_opt, write_to_di
     raster = dem_or_ifg(raster_path)
     if not raster.is_open:
         raster.open()
+    instrument.add_pixels(raster.num_cells)
     if do_multilook:
         resolution = [xlooks * raster.x_step, ylooks * raster.y_step]
 
@@ -192,6 +217,13 @@ def prepare_ifg(raster_path, xlooks, ylooks, exts, thresh, crop_opt, write_to_di
     #         # TODO: push out to workflow
     #         #if params.has_key(REPROJECTION_FLAG):
     #         #    reproject()
+    if stream:
+        stream_crop_resample_average(
+            input_tif=raster.data_path, extents=exts, new_res=resolution, output_file=looks_path, thresh=thresh,
+            hdr=header, coherence_path=coherence_path, coherence_thresh=coherence_thresh
+        )
+        return None
+
     driver_type = 'GTiff' if write_to_disk else 'MEM'
     resampled_data, out_ds = crop_resample_average(
         input_tif=raster.data_path, extents=exts, new_res=resolution, output_file=looks_path, thresh=thresh,
@@ -232,20 +264,24 @@ def prepare_ifgs(raster_data_paths, crop_opt, xlooks, ylooks, thresh=0.5, user_e
     return [prepare_ifg(d, xlooks, ylooks, exts, thresh, crop_opt, write_to_disc, out_path) for d in raster_data_paths]
 
 
-# TODO: Not being used. Remove in future?
-def _resample(data, xscale, yscale, thresh):
+def _resample(data, xscale, yscale, thresh, band_rows=None):
     """
     Resamples/averages 'data' to return an array from the averaging of blocks
     of several tiles in 'data'. NB: Assumes incoherent cells are NaNs.
 
+    The blocks are averaged in bands of output rows, so 'data' may also be a
+    memory mapped array or any array-like object returning numpy arrays when
+    sliced, and only one band of it is held in memory at a time.
+
     :param data: source array to resample to different size
     :param xscale: number of cells to average along X axis
     :param yscale: number of Y axis cells to average
     :param thresh: minimum allowable
         proportion of NaN cells (range from 0.0-1.0), eg. 0.25 = 1/4 or
         more as NaNs results in a NaN value for the output cell.
+    :param band_rows: [optional] number of output rows averaged at once;
+        by default bands of about RESAMPLE_BAND_CELLS source cells
     """
-    # TODO: make more efficient
     if thresh < 0 or thresh > 1:
         raise ValueError("threshold must be >= 0 and <= 1")
 
@@ -253,20 +289,35 @@ def _resample(data, xscale, yscale, thresh):
     yscale = int(yscale)
     ysize, xsize = data.shape
     xres, yres = int(xsize / xscale), int(ysize / yscale)
-    dest = zeros((yres, xres), dtype=float32) * nan
-    tile_cell_count = xscale * yscale
-
-    # calc mean without nans (fractional threshold ignores tiles
-    # with excess NaNs)
-    for x in range(xres):
-        for y in range(yres):
-            tile = data[y * yscale: (y+1) * yscale, x * xscale: (x+1) * xscale]
-            nan_fraction = nsum(isnan(tile)) / float(tile_cell_count)
-            if nan_fraction < thresh or (nan_fraction == 0 and thresh == 0):
-                dest[y, x] = nanmean(tile)
+    dest = np.empty((yres, xres), dtype=float32)
+    if band_rows is None:
+        band_rows = max(1, RESAMPLE_BAND_CELLS // max(1, xres * xscale * yscale))
+
+    for top in range(0, yres, band_rows):
+        bottom = min(top + band_rows, yres)
+        band = data[top * yscale: bottom * yscale, :xres * xscale]
+        dest[top:bottom] = _block_mean(band, xscale, yscale, thresh)
     return dest
 
 
+def _block_mean(band, xscale, yscale, thresh):
+    """
+    Mean of the non-NaN cells of each yscale by xscale block of 'band',
+    accumulated in float64. Blocks with a NaN fraction not less than thresh
+    (or with any NaNs if thresh is 0) are NaN.
+    """
+    rows, cols = band.shape[0] // yscale, band.shape[1] // xscale
+    blocks = np.asarray(band, dtype=np.float64).reshape(rows, yscale, cols, xscale)
+    nans = isnan(blocks)
+    nan_count = nans.sum(axis=(1, 3))
+    total = np.where(nans, 0, blocks).sum(axis=(1, 3))
+    nan_fraction = nan_count / float(xscale * yscale)
+    keep = (nan_fraction < thresh) | ((nan_fraction == 0) & (thresh == 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / (xscale * yscale - nan_count)
+    return np.where(keep, mean, nan)
+
+
 def _min_bounds(ifgs):
     """
     Returns bounds for overlapping area of the given interferograms.
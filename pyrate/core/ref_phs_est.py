@@ -113,41 +113,18 @@ def est_ref_phase_method1(ifg_paths, params):
     :rtype: ndarray
     :return: ifgs: Reference phase data is removed interferograms in place
     """
-    def _process_phase_sum(ifg_paths):
-        if isinstance(ifg_paths[0], Ifg):
-            proc_ifgs = ifg_paths
-        else:
-            proc_ifgs = [Ifg(ifg_path) for ifg_path in ifg_paths]
-
-        for ifg in proc_ifgs:
-            if not ifg.is_open:
-                ifg.open(readonly=False)
-
-        ifg_phase_data_sum = np.zeros(proc_ifgs[0].shape, dtype=np.float32)
-
+    def _invalid_mask(proc_ifgs, shape):
+        invalid = np.zeros(shape, dtype=bool)
         for ifg in proc_ifgs:
-            ifg_phase_data_sum += ifg.phase_data
-
-        return ifg_phase_data_sum
-
-    def _inner(proc_ifgs, phase_data_sum):
-        if isinstance(proc_ifgs[0], Ifg):
-            proc_ifgs = proc_ifgs
-        else:
-            proc_ifgs = [Ifg(ifg_path) for ifg_path in proc_ifgs]
-
-        for ifg in proc_ifgs:
-            if not ifg.is_open:
-                ifg.open(readonly=False)
-
-        comp = np.isnan(phase_data_sum)
-        comp = np.ravel(comp, order='F')
+            invalid |= np.isnan(ifg.phase_data)
+        return invalid
 
+    def _inner(proc_ifgs, invalid):
         if params[cf.PARALLEL]:
             phase_data = [i.phase_data for i in proc_ifgs]
             log.info("Calculating ref phase using multiprocessing")
             ref_phs = Parallel(n_jobs=params[cf.PROCESSES], verbose=joblib_log_level(cf.LOG_LEVEL))(
-                delayed(_est_ref_phs_method1)(p, comp) for p in phase_data
+                delayed(_est_ref_phs_method1)(p, invalid) for p in phase_data
             )
             for n, ifg in enumerate(proc_ifgs):
                 ifg.phase_data -= ref_phs[n]
@@ -155,7 +132,7 @@ def est_ref_phase_method1(ifg_paths, params):
             log.info("Calculating ref phase")
             ref_phs = np.zeros(len(proc_ifgs))
             for n, ifg in enumerate(proc_ifgs):
-                ref_phs[n] = _est_ref_phs_method1(ifg.phase_data, comp)
+                ref_phs[n] = _est_ref_phs_method1(ifg.phase_data, invalid)
                 ifg.phase_data -= ref_phs[n]
 
         for ifg in proc_ifgs:
@@ -164,9 +141,24 @@ def est_ref_phase_method1(ifg_paths, params):
 
         return ref_phs
 
-    process_ifg_paths = mpiops.array_split(ifg_paths)
-    ifg_phase_data_sum = mpiops.comm.allreduce(_process_phase_sum(process_ifg_paths), mpiops.sum0_op)
-    ref_phs = _inner(process_ifg_paths, ifg_phase_data_sum)
+    # open each ifg once; phase data read for the mask is reused for the median
+    if isinstance(ifg_paths[0], Ifg):
+        shape = ifg_paths[0].shape
+        proc_ifgs = mpiops.array_split(ifg_paths)
+    else:
+        head = Ifg(ifg_paths[0])
+        head.open(readonly=True)
+        shape = head.shape
+        head.close()
+        proc_ifgs = [Ifg(ifg_path) for ifg_path in mpiops.array_split(ifg_paths)]
+
+    for ifg in proc_ifgs:
+        if not ifg.is_open:
+            ifg.open(readonly=False)
+
+    # pixels that are nan in any ifg are excluded from all medians
+    invalid = mpiops.mask_or(_invalid_mask(proc_ifgs, shape))
+    ref_phs = _inner(proc_ifgs, invalid)
 
     return ref_phs
 
@@ -175,9 +167,7 @@ def _est_ref_phs_method1(phase_data, comp):
     """
     Convenience function for ref phs estimate method 1 parallelisation
     """
-    ifgv = np.ravel(phase_data, order='F')
-    ifgv[comp == 1] = np.nan
-    return nanmedian(ifgv)
+    return nanmedian(phase_data[~comp])
 
 
 def _update_phase_metadata(ifg):
@@ -17,8 +17,6 @@
 This Python module implements an algorithm to search for the location
 of the interferometric reference pixel
 """
-import os
-from os.path import join
 from itertools import product
 
 import numpy as np
@@ -26,10 +24,15 @@ from numpy import isnan, std, mean, sum as nsum
 from joblib import Parallel, delayed
 
 import pyrate.core.config as cf
+from pyrate.core import mpiops
 from pyrate.core.shared import Ifg
 from pyrate.core.shared import joblib_log_level
+from pyrate.core.prepifg_helper import _resample
 from pyrate.core.logger import pyratelogger as log
 
+# number of best scoring coarse regions refined at full resolution
+REFINE_REGIONS = 5
+
 
 # TODO: move error checking to config step (for fail fast)
 # TODO: this function is not used. Plan removal
@@ -99,8 +102,7 @@ def find_min_mean(mean_sds, grid):
 
 def ref_pixel_setup(ifgs_or_paths, params):
     """
-    Sets up the grid for reference pixel computation and saves numpy files
-    to disk for later use during ref pixel computation.
+    Sets up the grid for reference pixel computation.
         
     :param list ifgs_or_paths: List of interferogram filenames or Ifg objects
     :param dict params: Dictionary of configuration parameters
@@ -144,70 +146,231 @@ def ref_pixel_setup(ifgs_or_paths, params):
     return half_patch_size, thresh, list(product(ysteps, xsteps))
 
 
-def save_ref_pixel_blocks(grid, half_patch_size, ifg_paths, params):
+def ref_pixel_mean_sds(ifg_paths, grid, half_patch_size, thresh, params):
     """
-    Save reference pixel grid blocks to numpy array files on disk
-
+    Calculate the mean standard deviation of the phase data in the chips
+    centred on each reference pixel candidate. Windowed statistics for all
+    candidates are derived from cumulative-sum (integral) images of each
+    interferogram, so the phase data is read only once and no temporary
+    files are written. Interferograms are split between MPI processes and
+    the per-candidate statistics are reduced across all processes.
+
+    :param list ifg_paths: List of interferogram paths
     :param list grid: List of tuples (y, x) corresponding to ref pixel grids
     :param int half_patch_size: patch size in pixels
-    :param list ifg_paths: list of interferogram paths
+    :param float thresh: minimum number of valid pixels required in a chip
     :param dict params: Dictionary of configuration parameters
 
-    :return: None, file saved to disk
+    :return: mean_sds: mean standard deviation for each candidate; nan if
+        one or more interferograms has too few valid pixels in the chip
+    :rtype: ndarray
     """
-    log.debug('Saving ref pixel blocks')
-    outdir = params[cf.TMPDIR]
-    for pth in ifg_paths:
+    log.debug('Calculating ref pixel statistics')
+    # row 0: sum over ifgs of chip standard deviations
+    # row 1: number of ifgs with too many incoherent cells in the chip
+    stats = np.zeros((2, len(grid)), dtype=np.float64)
+    for pth in mpiops.array_split(ifg_paths):
         ifg = Ifg(pth)
         ifg.open(readonly=True)
         ifg.nodata_value = params[cf.NO_DATA_VALUE]
         ifg.convert_to_nans()
         ifg.convert_to_mm()
-        for y, x in grid:
-            data = ifg.phase_data[y - half_patch_size:y + half_patch_size + 1,
-                                  x - half_patch_size:x + half_patch_size + 1]
+        _add_chip_stats(stats, ifg.phase_data, grid, half_patch_size, thresh)
+        ifg.close()
+    mean_sds = _reduce_mean_sds(stats, len(ifg_paths))
+    log.debug('Finished ref pixel statistics')
+    return mean_sds
+
+
+def ref_pixel_coarse_to_fine(ifg_paths, params):
+    """
+    Hierarchical reference pixel search. Candidates are first scored on a
+    multilooked stack over a dense coarse grid, then the best scoring
+    regions are refined at full resolution on a local grid with a step of
+    one pixel. The fixed grid candidates from ref_pixel_setup are scored
+    alongside the coarse grid, so the selected reference pixel is never
+    worse than the result of the fixed grid search. Each interferogram is
+    read once in full, and once per refined region in a window.
+
+    :param list ifg_paths: List of interferogram paths
+    :param dict params: Dictionary of configuration parameters
 
-            data_file = join(outdir, 'ref_phase_data_{b}_{y}_{x}.npy'.format(
-                    b=os.path.basename(pth).split('.')[0], y=y, x=x))
-            np.save(file=data_file, arr=data)
+    :return: Tuple of (refy, refx) with minimum mean, or the ValueError
+        returned by find_min_mean if all candidates are nan
+    :rtype: tuple
+    """
+    half_patch_size, thresh, grid = ref_pixel_setup(ifg_paths, params)
+    looks = params[cf.REF_SEARCH_LOOKS]
+    head = Ifg(ifg_paths[0])
+    head.open(readonly=True)
+    shape = head.shape
+    head.close()
+
+    log.debug('Coarse ref pixel search with {} looks'.format(looks))
+    grid_sds, regions = _coarse_search(ifg_paths, shape, grid, half_patch_size, thresh, looks, params)
+    windows = []
+    for cy, cx in regions:
+        rows = (max(half_patch_size, cy * looks - looks // 2),
+                min(shape[0] - half_patch_size, (cy + 1) * looks + looks // 2))
+        cols = (max(half_patch_size, cx * looks - looks // 2),
+                min(shape[1] - half_patch_size, (cx + 1) * looks + looks // 2))
+        if rows[0] < rows[1] and cols[0] < cols[1]:
+            windows.append((rows, cols))
+
+    log.debug('Refining ref pixel search in {} windows'.format(len(windows)))
+    candidates = [list(product(range(*r), range(*c))) for r, c in windows]
+    stats = [np.zeros((2, len(c)), dtype=np.float64) for c in candidates]
+    for pth in mpiops.array_split(ifg_paths):
+        ifg = Ifg(pth)
+        ifg.open(readonly=True)
+        for (rows, cols), cands, stat in zip(windows, candidates, stats):
+            top, left = rows[0] - half_patch_size, cols[0] - half_patch_size
+            data = _phase_window(ifg, params, top, rows[1] + half_patch_size,
+                                 left, cols[1] + half_patch_size)
+            local = [(y - top, x - left) for y, x in cands]
+            _add_chip_stats(stat, data, local, half_patch_size, thresh)
         ifg.close()
-    log.debug('Saved ref pixel blocks')
+    refined_sds = _reduce_mean_sds(np.hstack([np.zeros((2, 0))] + stats), len(ifg_paths))
+    return find_min_mean(np.concatenate([grid_sds, refined_sds]),
+                         grid + [g for c in candidates for g in c])
 
 
-def _ref_pixel_mpi(process_grid, half_patch_size, ifgs, thresh, params):
+def _coarse_search(ifg_paths, shape, grid, half_patch_size, thresh, looks, params):
     """
-    Convenience function for MPI-enabled ref pixel calculation
+    Score the fixed grid candidates at full resolution and every candidate
+    of the multilooked interferogram stack, reading each interferogram once.
+
+    :return: grid_sds: mean standard deviation of each fixed grid candidate
+    :rtype: ndarray
+    :return: regions: coarse (y, x) coordinates of the best separated
+        regions of the multilooked stack
+    :rtype: list
+    """
+    min_frac = params[cf.REF_MIN_FRAC]
+    half = max(1, half_patch_size // looks)
+    coarse_grid = list(product(range(half, shape[0] // looks - half),
+                               range(half, shape[1] // looks - half)))
+    grid_stats = np.zeros((2, len(grid)), dtype=np.float64)
+    coarse_stats = np.zeros((2, len(coarse_grid)), dtype=np.float64)
+    for pth in mpiops.array_split(ifg_paths):
+        ifg = Ifg(pth)
+        ifg.open(readonly=True)
+        ifg.nodata_value = params[cf.NO_DATA_VALUE]
+        ifg.convert_to_nans()
+        ifg.convert_to_mm()
+        _add_chip_stats(grid_stats, ifg.phase_data, grid, half_patch_size, thresh)
+        data = _resample(ifg.phase_data, looks, looks, 1 - min_frac)
+        ifg.close()
+        _add_chip_stats(coarse_stats, data, coarse_grid, half, min_frac * (2 * half + 1) ** 2)
+    grid_sds = _reduce_mean_sds(grid_stats, len(ifg_paths))
+    mean_sds = _reduce_mean_sds(coarse_stats, len(ifg_paths))
+
+    regions = []
+    for i in np.argsort(mean_sds):
+        if isnan(mean_sds[i]) or len(regions) == REFINE_REGIONS:
+            break
+        cy, cx = coarse_grid[i]
+        if all(abs(cy - y) > half or abs(cx - x) > half for y, x in regions):
+            regions.append((cy, cx))
+    return grid_sds, regions
+
+
+def _add_chip_stats(stats, data, grid, half_patch_size, thresh):
     """
-    log.debug('Ref pixel calculation started')
-    mean_sds = []
-    for g in process_grid:
-        mean_sds.append(_ref_pixel_multi(g, half_patch_size, ifgs, thresh, params))
+    Add the chip standard deviations of an interferogram to the sums in
+    row 0 of stats, and count chips with too few valid pixels in row 1.
+    """
+    sd, valid = _chip_std(data, grid, half_patch_size, thresh)
+    stats[0] += np.where(valid, sd, 0)
+    stats[1] += ~valid
+
+
+def _reduce_mean_sds(stats, nifgs):
+    """
+    Reduce the chip statistics of all processes to the mean standard
+    deviation of each candidate, nan where any chip has too few valid pixels.
+    """
+    stats = mpiops.comm.allreduce(stats, mpiops.sum0_op)
+    mean_sds = stats[0] / nifgs
+    mean_sds[stats[1] > 0] = np.nan
     return mean_sds
 
 
-def _ref_pixel_multi(g, half_patch_size, phase_data_or_ifg_paths,
-                    thresh, params):
+def _phase_window(ifg, params, top, bottom, left, right):
+    """
+    Read a window of the phase band, converted to nans and millimetres.
+    """
+    ifg.initialize()
+    ifg.mm_converted = False
+    ifg.phase_data = None
+    ifg.phase_data = ifg.read_phase_window(top, bottom, left, right)
+    ifg.nodata_value = params[cf.NO_DATA_VALUE]
+    ifg.convert_to_nans()
+    ifg.convert_to_mm()
+    return ifg.phase_data
+
+
+def _chip_std(data, grid, half_patch_size, thresh):
+    """
+    Standard deviation of the valid pixels in the chip around each candidate
+    of the grid, using windowed counts, sums and sums of squares.
+
+    :param ndarray data: phase data of a single interferogram
+    :param list grid: List of tuples (y, x) corresponding to ref pixel grids
+    :param int half_patch_size: patch size in pixels
+    :param float thresh: minimum number of valid pixels required in a chip
+
+    :return: sd: standard deviation of each chip
+    :rtype: ndarray
+    :return: valid: True where the chip has more than thresh valid pixels
+    :rtype: ndarray
+    """
+    valid = ~isnan(data)
+    # centre on the mean to limit cancellation in the sum of squares
+    offset = np.nanmean(data) if valid.any() else 0
+    centred = np.where(valid, data.astype(np.float64) - offset, 0)
+    ys, xs = np.array(grid, dtype=int).reshape(-1, 2).T
+    count = _window_sum(_integral_image(valid), ys, xs, half_patch_size)
+    total = _window_sum(_integral_image(centred), ys, xs, half_patch_size)
+    sumsq = _window_sum(_integral_image(centred ** 2), ys, xs, half_patch_size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_ = total / count
+        var = np.maximum(sumsq / count - mean_ ** 2, 0)
+    return np.sqrt(var), count > thresh
+
+
+def _integral_image(data):
+    """
+    Cumulative sum image padded with a leading row and column of zeros so
+    that the sum over any window is found from four of its values.
+    """
+    integral = np.zeros((data.shape[0] + 1, data.shape[1] + 1), dtype=np.float64)
+    np.cumsum(data, axis=0, dtype=np.float64, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return integral
+
+
+def _window_sum(integral, ys, xs, radius):
+    """
+    Sum of the square windows of the given radius centred on (ys, xs)
+    using an integral image from _integral_image.
+    """
+    top, bottom = ys - radius, ys + radius + 1
+    left, right = xs - radius, xs + radius + 1
+    return integral[bottom, right] - integral[top, right] - \
+        integral[bottom, left] + integral[top, left]
+
+
+def _ref_pixel_multi(g, half_patch_size, phase_data, thresh, params):
     """
     Convenience function for ref pixel optimisation
     """
     # pylint: disable=invalid-name
-    # phase_data_or_ifg is list of ifgs
+    # phase_data is list of phase data arrays
     y, x, = g
-    if isinstance(phase_data_or_ifg_paths[0], str):
-        # this consumes a lot less memory
-        # one ifg.phase_data in memory at any time
-        data = []
-        output_dir = params[cf.TMPDIR]
-        for p in phase_data_or_ifg_paths:
-            data_file = os.path.join(output_dir,
-                                     'ref_phase_data_{b}_{y}_{x}.npy'.format(
-                                         b=os.path.basename(p).split('.')[0],
-                                         y=y, x=x))
-            data.append(np.load(file=data_file))
-    else:  # phase_data_or_ifg is phase_data list
-        data = [p[y - half_patch_size:y + half_patch_size + 1,
-                  x - half_patch_size:x + half_patch_size + 1]
-                for p in phase_data_or_ifg_paths]
+    data = [p[y - half_patch_size:y + half_patch_size + 1,
+              x - half_patch_size:x + half_patch_size + 1]
+            for p in phase_data]
     valid = [nsum(~isnan(d)) > thresh for d in data]
     if all(valid):  # ignore if 1+ ifgs have too many incoherent cells
         sd = [std(i[~isnan(i)]) for i in data]
@@ -200,20 +200,75 @@ def manage_header(header_file, projection):
     return header
 
 
+class HeaderIndex:
+    """
+    Parsed ROI_PAC headers of a run: the interferogram headers of the header
+    file list by epochs, and the DEM header. Built once per run and passed
+    to workers in the parameters, see prepifg_helper.header_index, so
+    roipac_header looks up the header of a file instead of parsing it again.
+    Raises RoipacException if there are several header files for the epochs
+    of an interferogram.
+    """
+    def __init__(self, params):
+        rsc_file = params[cf.DEM_HEADER_FILE]
+        if rsc_file is None:
+            raise RoipacException('No DEM resource/header file is provided')
+        self.projection = parse_header(rsc_file)[ifc.PYRATE_DATUM]
+        self.dem_header = manage_header(rsc_file, self.projection)
+        # headers by header file path and by epochs
+        self.header_files = {os.path.abspath(rsc_file): self.dem_header}
+        self.ifg_headers = {}
+        paths = {}
+        for header_path in params[cf.HEADER_FILE_PATHS]:
+            path = os.path.abspath(header_path.unwrapped_path)
+            header = manage_header(path, self.projection)
+            self.header_files[path] = header
+            epochs = frozenset(extract_epochs_from_filename(Path(path).name))
+            if paths.setdefault(epochs, path) != path:
+                raise RoipacException('Header files {} and {} are both for epochs {}'.format(
+                    paths[epochs], path, ', '.join(sorted(epochs))))
+            self.ifg_headers[epochs] = header
+
+    def header(self, file_path):
+        """
+        Header of an interferogram file or converted geotiff, as
+        roipac_header.
+
+        :param str file_path: interferogram or DEM file path
+
+        :return: header: metadata dictionary
+        :rtype: dict
+        """
+        if file_path.endswith(('dem.tif', 'dem.vrt')):
+            return dict(self.dem_header)
+        elif file_path.endswith(('unw.tif', 'unw.vrt')):
+            epochs = frozenset(extract_epochs_from_filename(Path(file_path).name))
+            if epochs not in self.ifg_headers:
+                raise RoipacException('No header file found for {}'.format(file_path))
+            return dict(self.ifg_headers[epochs])
+        header_file = "%s%s" % (file_path, ROI_PAC_HEADER_FILE_EXT)
+        if os.path.abspath(header_file) in self.header_files:
+            return dict(self.header_files[os.path.abspath(header_file)])
+        return manage_header(header_file, self.projection)
+
+
 def roipac_header(file_path, params):
     """
     Function to obtain a header for roipac interferogram file or converted
     geotiff.
     """
+    index = params.get(cf.HEADER_INDEX)
+    if index is not None:
+        return index.header(file_path)
     rsc_file = params[cf.DEM_HEADER_FILE]
     p = Path(file_path)
     if rsc_file is not None:
         projection = parse_header(rsc_file)[ifc.PYRATE_DATUM]
     else:
         raise RoipacException('No DEM resource/header file is provided')
-    if file_path.endswith('dem.tif'):
+    if file_path.endswith(('dem.tif', 'dem.vrt')):
         header_file = os.path.join(params[cf.DEM_HEADER_FILE])
-    elif file_path.endswith('unw.tif'):
+    elif file_path.endswith(('unw.tif', 'unw.vrt')):
         # TODO: improve this
         interferogram_epoches = extract_epochs_from_filename(p.name)
         for header_path in params[cf.HEADER_FILE_PATHS]:
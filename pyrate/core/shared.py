@@ -23,17 +23,19 @@ import re
 from typing import List, Union
 
 import errno
+import json
 import math
 from math import floor
 import os
 from os.path import basename, join
 import struct
+from contextlib import contextmanager
 from datetime import date
 from itertools import product
 import numpy as np
+import numexpr as ne
 from numpy import where, nan, isnan, sum as nsum, isclose
 import pyproj
-import pkg_resources
 try:
     from osgeo import osr, gdal
     from osgeo.gdalconst import GA_Update, GA_ReadOnly
@@ -55,6 +57,18 @@ MILLIMETRES = 'MILLIMETRES'
 GAMMA = 'GAMMA'
 ROIPAC = 'ROIPAC'
 
+# number of cells converted at a time by write_fullres_geotiff
+CONVERSION_BLOCK_CELLS = 2 ** 24
+
+# source of a VRT band converting the data type of another VRT on read
+VRT_SIMPLE_SOURCE = '<SimpleSource><SourceFilename relativeToVRT="0">{}</SourceFilename>' \
+                    '<SourceBand>1</SourceBand></SimpleSource>'
+
+# minimum number of automatically chosen tiles per MPI process
+TILES_PER_PROCESS = 4
+# automatically chosen tile layout of a run, saved in the temporary directory
+TILE_LAYOUT_FILE = 'tile_layout.json'
+
 # GDAL projection list
 GDAL_X_CELLSIZE = 1
 GDAL_Y_CELLSIZE = 5
@@ -102,7 +116,8 @@ class RasterBase(object):
         else:
             self.data_path = path
             self.dataset = None  # for GDAL dataset obj
-            self._readonly = not os.access(path, os.R_OK | os.W_OK)
+            # VRTs of raw input files are never modified
+            self._readonly = not os.access(path, os.R_OK | os.W_OK) or str(path).endswith('.vrt')
 
             if self._readonly is None:
                 raise NotImplementedError  # os.access() has failed?
@@ -215,6 +230,15 @@ class RasterBase(object):
         """
         return self.dataset.RasterYSize, self.dataset.RasterXSize
 
+    @property
+    def block_shape(self):
+        """
+        Returns tuple of (Y,X) shape of the blocks in which the first band
+        of the raster is stored on disk.
+        """
+        xsize, ysize = self._get_band(1).GetBlockSize()
+        return ysize, xsize
+
     @property
     def num_cells(self):
         """
@@ -299,6 +323,8 @@ class Ifg(RasterBase):
         """
         self._init_dates()
         md = self.dataset.GetMetadata()
+        if _in_session(self.data_path):
+            md = _session.read_metadata(self.data_path, md)
         self.wavelength = float(md[ifc.PYRATE_WAVELENGTH_METRES])
         self.meta_data = md
         self.nan_converted = False # This flag set True after NaN conversion
@@ -331,7 +357,7 @@ class Ifg(RasterBase):
                   'Use ifg.nodata_value = NoDataValue to set nodata_value'
             log.warning(msg)
             raise RasterException(msg)
-        if ((self.dataset.GetMetadataItem(ifc.NAN_STATUS) == ifc.NAN_CONVERTED)
+        if ((self._metadata_item(ifc.NAN_STATUS) == ifc.NAN_CONVERTED)
                 or self.nan_converted):
             self.phase_data = self.phase_data
             self.nan_converted = True
@@ -347,6 +373,14 @@ class Ifg(RasterBase):
             self.meta_data[ifc.NAN_STATUS] = ifc.NAN_CONVERTED
             self.nan_converted = True
 
+    def _metadata_item(self, key):
+        """
+        Returns a metadata item, including updates not yet written to disk.
+        """
+        if self.meta_data is None:
+            return self.dataset.GetMetadataItem(key)
+        return self.meta_data.get(key)
+
     @property
     def phase_band(self):
         """
@@ -376,7 +410,10 @@ class Ifg(RasterBase):
         Returns phase band as an array.
         """
         if self._phase_data is None:
-            self._phase_data = self.phase_band.ReadAsArray()
+            if _in_session(self.data_path):
+                self._phase_data = _session.read_phase(self.data_path)
+            if self._phase_data is None:
+                self._phase_data = self.phase_band.ReadAsArray()
         return self._phase_data
 
     def convert_to_mm(self):
@@ -384,13 +421,13 @@ class Ifg(RasterBase):
         Convert phase data units from radians to millimetres.
         """
         self.mm_converted = True
-        if self.dataset.GetMetadataItem(ifc.DATA_UNITS) == MILLIMETRES:
+        if self._metadata_item(ifc.DATA_UNITS) == MILLIMETRES:
             msg = '{}: ignored as previous phase unit conversion ' \
                   'already applied'.format(self.data_path)
             log.debug(msg)
             self.phase_data = self.phase_data
             return
-        elif self.dataset.GetMetadataItem(ifc.DATA_UNITS) == RADIANS:
+        elif self._metadata_item(ifc.DATA_UNITS) == RADIANS:
             self.phase_data = convert_radians_to_mm(self.phase_data,
                                                     self.wavelength)
             self.meta_data[ifc.DATA_UNITS] = MILLIMETRES
@@ -404,6 +441,25 @@ class Ifg(RasterBase):
             msg = 'Phase units are not millimetres or radians'
             raise IfgException(msg)
 
+    def read_phase_window(self, r_start, r_end, c_start, c_end):
+        """
+        Returns a window of the phase band as an array. Only the window is
+        read from disk, unless the phase data is already held in memory.
+
+        :param int r_start: first row of the window
+        :param int r_end: row after the last row of the window
+        :param int c_start: first column of the window
+        :param int c_end: column after the last column of the window
+
+        :return: phase data of the window
+        :rtype: ndarray
+        """
+        if self._phase_data is not None:
+            return self._phase_data[r_start:r_end, c_start:c_end]
+        if _in_session(self.data_path) and self.data_path in _session.modified:
+            return self.phase_data[r_start:r_end, c_start:c_end]
+        return self.phase_band.ReadAsArray(c_start, r_start, c_end - c_start, r_end - r_start)
+
     @phase_data.setter
     def phase_data(self, data):
         """
@@ -464,6 +520,9 @@ class Ifg(RasterBase):
             data_r, data_c = data.shape
             assert data_r == self.nrows and data_c == self.ncols
             self.phase_data = data
+        if _in_session(self.data_path):
+            _session.write_phase(self.data_path, self.phase_data, self.meta_data)
+            return
         self.phase_band.WriteArray(self.phase_data)
         for k, v in self.meta_data.items():
             self.dataset.SetMetadataItem(k, v)
@@ -485,18 +544,29 @@ class IfgPart(object):
         self.r_end = self.tile.bottom_right_y
         self.c_start = self.tile.top_left_x
         self.c_end = self.tile.bottom_right_x
+        self.data_path = None
         if ifg_dict is not None:  # should be used with MPI
             ifg = ifg_dict[ifg_or_path]
             self.nan_fraction = ifg.nan_fraction
             self.master = ifg.master
             self.slave = ifg.slave
             self.time_span = ifg.time_span
-            phase_file = 'phase_data_{}_{}.npy'.format(basename(ifg_or_path).split('.')[0], tile.index)
-            self.phase_data = np.load(join(params[cf.TMPDIR], phase_file))
+            if ifg.index is None:
+                # header only; read just this tile from the geotiff
+                tif = Ifg(ifg_or_path)
+                tif.open(readonly=True)
+                self.phase_data = tif.read_phase_window(self.r_start, self.r_end,
+                                                        self.c_start, self.c_end)
+                tif.close()
+            else:
+                # zero-copy view of the tile in the memory-mapped phase store
+                self.phase_data = open_phase_stack(params)[ifg.index, self.r_start:self.r_end,
+                                                           self.c_start:self.c_end]
         else:
             # check if Ifg was sent.
             if isinstance(ifg_or_path, Ifg):
                 ifg = ifg_or_path
+                self.data_path = ifg.data_path
             else:
                 self.data_path = ifg_or_path
                 ifg = Ifg(ifg_or_path)
@@ -515,15 +585,39 @@ class IfgPart(object):
         if not ifg.is_open:
             ifg.open(readonly=True)
         ifg.nodata_value = 0
-        self.phase_data = ifg.phase_data[self.r_start:self.r_end,
-                                         self.c_start:self.c_end]
-        self.nan_fraction = ifg.nan_fraction
+        self.phase_data = ifg.read_phase_window(self.r_start, self.r_end,
+                                                self.c_start, self.c_end)
+        # the nan fraction of the whole ifg requires the full band, so it is
+        # only read from file when required, see nan_fraction
+        self.nan_fraction = None if ifg._phase_data is None else ifg.nan_fraction
         self.master = ifg.master
         self.slave = ifg.slave
         self.time_span = ifg.time_span
         ifg.phase_data = None
         ifg.close()  # close base ifg
 
+    @property
+    def nan_fraction(self):
+        """
+        Returns decimal fraction of NaN cells in the phase band of the whole
+        interferogram. If not known from the header it is calculated from
+        the interferogram file when first required.
+        """
+        if self._nan_fraction is None and self.data_path is not None:
+            ifg = Ifg(self.data_path)
+            ifg.open(readonly=True)
+            ifg.nodata_value = 0
+            self._nan_fraction = ifg.nan_fraction
+            ifg.close()
+        return self._nan_fraction
+
+    @nan_fraction.setter
+    def nan_fraction(self, val):
+        """
+        Set the decimal fraction of NaN cells.
+        """
+        self._nan_fraction = val
+
     @property
     def nrows(self):
         """
@@ -660,22 +754,40 @@ def convert_radians_to_mm(data, wavelength):
     return data * ifc.MM_PER_METRE * (wavelength / (4 * math.pi))
 
 
-def nanmedian(x):
+def nanmedian(x, bins=None):
     """
-    Determine the median of values excluding nan values.
-    Use different numpy algorithm dependent on numpy version.
+    Determine the median of values excluding nan values. NaNs are removed
+    with a single compaction and the median is found by selection with
+    np.partition rather than by sorting.
+
+    If bins is given, the median is instead approximated from a histogram
+    of the valid values with that many equal width bins. The absolute error
+    of the approximation is no greater than half a bin width, i.e.
+    (max(x) - min(x)) / (2 * bins).
 
     :param ndarray x: array of numeric data.
+    :param int bins: number of histogram bins for the approximate median
+        (optional, default exact median)
 
     :return: y: median value
     :rtype: float
     """
-    # pylint: disable=no-member
-    version = [int(i) for i in pkg_resources.get_distribution("numpy").version.split('.')[:2]]
-    if version[0] == 1 and version[1] > 9:
-        return np.nanmedian(x)
-    else:   # pragma: no cover
-        return np.median(x[~np.isnan(x)])
+    v = np.ravel(x)
+    v = v[~np.isnan(v)]
+    n = v.size
+    if n == 0:
+        return np.nan
+    lower, upper = (n - 1) // 2, n // 2  # indices of the middle value(s)
+    if bins:
+        low, high = v.min(), v.max()
+        if low == high:
+            return low
+        counts, edges = np.histogram(v, bins=bins, range=(low, high))
+        centres = (edges[:-1] + edges[1:]) / 2
+        idx = np.searchsorted(np.cumsum(counts), [lower, upper], side='right')
+        return np.mean(centres[idx])
+    v.partition([lower, upper])
+    return (v[lower] + v[upper]) / 2
 
 
 def _is_interferogram(hdr):
@@ -707,28 +819,10 @@ def write_fullres_geotiff(header, data_path, dest, nodata):
     """
     # pylint: disable=too-many-branches
     # pylint: disable=too-many-locals
-    ifg_proc = header[ifc.PYRATE_INSAR_PROCESSOR]
     ncols = header[ifc.PYRATE_NCOLS]
     nrows = header[ifc.PYRATE_NROWS]
-    bytes_per_col, fmtstr = _data_format(ifg_proc, _is_interferogram(header), ncols)
-    if _is_interferogram(header) and ifg_proc == ROIPAC:
-        # roipac ifg has 2 bands
-        _check_raw_data(bytes_per_col*2, data_path, ncols, nrows)
-    else:
-        _check_raw_data(bytes_per_col, data_path, ncols, nrows)
-
-    _check_pixel_res_mismatch(header)
-
-    # position and projection data
-    gt = [header[ifc.PYRATE_LONG], header[ifc.PYRATE_X_STEP], 0, header[ifc.PYRATE_LAT], 0, header[ifc.PYRATE_Y_STEP]]
-    srs = osr.SpatialReference()
-    res = srs.SetWellKnownGeogCS(header[ifc.PYRATE_DATUM])
-    if res:
-        msg = 'Unrecognised projection: %s' % header[ifc.PYRATE_DATUM]
-        raise GeotiffException(msg)
-
-    wkt = srs.ExportToWkt()
-    dtype = 'float32' if (_is_interferogram(header) or _is_incidence(header)) else 'int16'
+    raw_dtype, nbands, gt, wkt = _raw_data_setup(header, data_path)
+    dtype = _output_dtype(header)
 
     # get subset of metadata relevant to PyRate
     md = collate_metadata(header)
@@ -743,21 +837,103 @@ def write_fullres_geotiff(header, data_path, dest, nodata):
     band = ds.GetRasterBand(1)
     band.SetNoDataValue(nodata)
 
-    row_bytes = ncols * bytes_per_col
+    # the raw file as an array of rows, without reading it
+    raw = np.memmap(data_path, dtype=raw_dtype, mode='r', shape=(nrows, nbands * ncols))
+    if nbands == 2:
+        raw = raw[:, ncols:]  # skip interleaved band 1
 
-    with open(data_path, 'rb') as f:
-        for y in range(nrows):
-            if ifg_proc == ROIPAC:
-                if _is_interferogram(header):
-                    f.seek(row_bytes, 1)  # skip interleaved band 1
-
-            data = struct.unpack(fmtstr, f.read(row_bytes))
-            band.WriteArray(np.array(data).reshape(1, ncols), yoff=y)
+    # convert blocks of rows to native byte order, GDAL converts to the output type
+    block_rows = max(1, CONVERSION_BLOCK_CELLS // max(1, ncols))
+    for y in range(0, nrows, block_rows):
+        band.WriteArray(raw[y:y + block_rows].astype(raw_dtype.newbyteorder('=')), yoff=y)
+    del raw
 
     ds = None  # manual close
     del ds
 
 
+def write_fullres_vrt(header, data_path, dest, nodata):
+    """
+    Creates a GDAL VRT with PyRate metadata reading the input image data
+    (interferograms, DEM, incidence maps etc) in place, instead of a GeoTIFF
+    copy. The data type is the same as that of write_fullres_geotiff. Where
+    it differs from the raw data type, e.g. for GAMMA DEMs, the raw data is
+    read through a second VRT, saved next to dest, and converted on read.
+
+    :param dict header: Interferogram metadata dictionary
+    :param str data_path: Input file
+    :param str dest: Output destination VRT file
+    :param float nodata: No-data value
+
+    :return: None, file saved to disk
+    """
+    ncols = header[ifc.PYRATE_NCOLS]
+    nrows = header[ifc.PYRATE_NROWS]
+    raw_dtype, nbands, gt, wkt = _raw_data_setup(header, data_path)
+    dtype = _output_dtype(header)
+    raw_gdal_dtype = gdal.GDT_Float32 if raw_dtype.kind == 'f' else gdal.GDT_Int16
+    gdal_dtype = gdal.GDT_Float32 if dtype == 'float32' else gdal.GDT_Int16
+    raw_dest = dest if raw_gdal_dtype == gdal_dtype else os.path.splitext(dest)[0] + '_raw.vrt'
+
+    ds = gdal_dataset(raw_dest, ncols, nrows, driver="VRT", bands=0,
+                      metadata=collate_metadata(header), crs=wkt, geotransform=gt)
+    # the last of the interleaved bands, see write_fullres_geotiff
+    options = [
+        'subClass=VRTRawRasterBand',
+        'SourceFilename={}'.format(os.path.abspath(data_path)),
+        'relativeToVRT=0',
+        'ImageOffset={}'.format((nbands - 1) * ncols * raw_dtype.itemsize),
+        'PixelOffset={}'.format(raw_dtype.itemsize),
+        'LineOffset={}'.format(nbands * ncols * raw_dtype.itemsize),
+        'ByteOrder={}'.format('MSB' if raw_dtype.str[0] == '>' else 'LSB')
+    ]
+    ds.AddBand(raw_gdal_dtype, options)
+    ds.GetRasterBand(1).SetNoDataValue(nodata)
+    ds.FlushCache()
+    ds = None  # manual close
+
+    if raw_dest != dest:
+        ds = gdal_dataset(dest, ncols, nrows, driver="VRT", bands=1, dtype=dtype,
+                          metadata=collate_metadata(header), crs=wkt, geotransform=gt)
+        band = ds.GetRasterBand(1)
+        band.SetMetadataItem('source_0', VRT_SIMPLE_SOURCE.format(os.path.abspath(raw_dest)), 'new_vrt_sources')
+        band.SetNoDataValue(nodata)
+        ds.FlushCache()
+        ds = None  # manual close
+
+
+def _output_dtype(header):
+    """
+    Data type of the converted image data: float32 for interferograms and
+    incidence maps, int16 for DEMs.
+    """
+    return 'float32' if (_is_interferogram(header) or _is_incidence(header)) else 'int16'
+
+
+def _raw_data_setup(header, data_path):
+    """
+    Convenience function checking a raw input file and returning its numpy
+    data type, number of interleaved bands, geotransform and projection
+    """
+    ifg_proc = header[ifc.PYRATE_INSAR_PROCESSOR]
+    raw_dtype = _data_format(ifg_proc, _is_interferogram(header))
+    # roipac ifg has 2 bands
+    nbands = 2 if (_is_interferogram(header) and ifg_proc == ROIPAC) else 1
+    _check_raw_data(raw_dtype.itemsize * nbands, data_path, header[ifc.PYRATE_NCOLS], header[ifc.PYRATE_NROWS])
+
+    _check_pixel_res_mismatch(header)
+
+    # position and projection data
+    gt = [header[ifc.PYRATE_LONG], header[ifc.PYRATE_X_STEP], 0, header[ifc.PYRATE_LAT], 0, header[ifc.PYRATE_Y_STEP]]
+    srs = osr.SpatialReference()
+    res = srs.SetWellKnownGeogCS(header[ifc.PYRATE_DATUM])
+    if res:
+        msg = 'Unrecognised projection: %s' % header[ifc.PYRATE_DATUM]
+        raise GeotiffException(msg)
+
+    return raw_dtype, nbands, gt, srs.ExportToWkt()
+
+
 def gdal_dataset(out_fname, columns, rows, driver="GTiff", bands=1,
                  dtype='float32', metadata=None, crs=None,
                  geotransform=None, creation_opts=None):
@@ -814,24 +990,20 @@ def collate_metadata(header):
     return md
 
 
-def _data_format(ifg_proc, is_ifg, ncols):
+def _data_format(ifg_proc, is_ifg):
     """
-    Convenience function to determine the bytesize and format of input files
+    Convenience function to determine the numpy data type of input files
     """
     if ifg_proc == GAMMA:
-        fmtstr = '!' + ('f' * ncols)  # data format is big endian float32s
-        bytes_per_col = 4
+        return np.dtype('>f4')  # data format is big endian float32s
     elif ifg_proc == ROIPAC:
         if is_ifg:
-            fmtstr = '<' + ('f' * ncols)  # roipac ifgs are little endian float32s
-            bytes_per_col = 4
+            return np.dtype('<f4')  # roipac ifgs are little endian float32s
         else:
-            fmtstr = '<' + ('h' * ncols)  # roipac DEM is little endian signed int16
-            bytes_per_col = 2
+            return np.dtype('<i2')  # roipac DEM is little endian signed int16
     else:  # pragma: no cover
         msg = 'Unrecognised InSAR Processor: %s' % ifg_proc
         raise GeotiffException(msg)
-    return bytes_per_col, fmtstr
 
 
 def _check_raw_data(bytes_per_col, data_path, ncols, nrows):
@@ -973,18 +1145,20 @@ class GeotiffException(Exception):
     Geotiff exception class
     """
 
-def create_tiles(shape, nrows=2, ncols=2):
+def create_tiles(shape, nrows=2, ncols=2, block_shape=None):
     """
     Return a list of tiles containing nrows x ncols with each tile preserving
     the physical layout of original array. The number of rows can be changed
     (increased) such that the resulting tiles with float32's do not exceed
     500MB in memory. When the array shape (rows, columns) are not divisible
     by (nrows, ncols) then some of the array dimensions can change according
-    to numpy.array_split.
+    to numpy.array_split. If the block shape of the raster on disk is given,
+    tile boundaries are moved down to a block boundary where possible.
 
     :param tuple shape: Shape tuple (2-element) of interferogram.
     :param int nrows: Number of rows of tiles
     :param int ncols: Number of columns of tiles
+    :param tuple block_shape: Shape tuple (2-element) of raster blocks (optional)
 
     :return: List of Tile class instances.
     :rtype: list
@@ -997,15 +1171,176 @@ def create_tiles(shape, nrows=2, ncols=2):
 
     if ncols > no_x or nrows > no_y:
         raise ValueError('nrows/cols must be greater than ifg dimensions')
-    col_arr = np.array_split(range(no_x), ncols)
-    row_arr = np.array_split(range(no_y), nrows)
-    return [Tile(i, (r[0], c[0]), (r[-1]+1, c[-1]+1)) for i, (r, c) in enumerate(product(row_arr, col_arr))]
+    block_y, block_x = block_shape if block_shape is not None else (None, None)
+    row_edges = _tile_edges(no_y, nrows, block_y)
+    col_edges = _tile_edges(no_x, ncols, block_x)
+    rows = zip(row_edges[:-1], row_edges[1:])
+    cols = zip(col_edges[:-1], col_edges[1:])
+    return [Tile(i, (r[0], c[0]), (r[1], c[1])) for i, (r, c) in enumerate(product(rows, cols))]
+
+
+def _tile_edges(dim, parts, block=None):
+    """
+    Split an axis of length dim into parts as numpy.array_split, moving
+    the interior edges down to multiples of block if no part becomes empty.
+    """
+    size, extra = divmod(dim, parts)
+    edges = [i * size + min(i, extra) for i in range(parts)] + [dim]
+    if block and block < dim:
+        snapped = [0] + [e // block * block for e in edges[1:-1]] + [dim]
+        if all(a < b for a, b in zip(snapped[:-1], snapped[1:])):
+            edges = snapped
+    return [int(e) for e in edges]
+
+
+def tile_footprints(nifgs, nepochs=None):
+    """
+    Approximate memory required per pixel of a tile by each tile stage.
+
+    :param int nifgs: Number of interferograms
+    :param int nepochs: Number of epochs; at most nifgs + 1 if not given
+
+    :return: footprints: Dictionary of bytes per pixel for each stage
+    :rtype: dict
+    """
+    nvel = nifgs if nepochs is None else nepochs - 1
+    phase = 4 * nifgs  # float32 phase data of all ifgs
+    mask = nifgs  # boolean mst or nan mask
+    ts = 16 * nvel  # float32 velocities, increments, cumulative and nan check
+    return {
+        'mst': phase + 2 * mask,
+        'aps': phase + mask + ts,
+        'timeseries': phase + mask + ts,
+        'stack': phase + 2 * mask + 12,
+        'fused': phase + 2 * mask + ts + 12,
+    }
+
+
+def auto_tile_layout(shape, nifgs, budget, block_shape=None, min_tiles=1):
+    """
+    Choose the number of rows and columns of tiles such that every tile
+    stage of a single process stays within a memory budget. All tile stages
+    share the same tiling, since their products are exchanged per tile, so
+    the stage with the largest footprint determines the tile size. Tiles
+    are row bands if the raster is stored in strips, or as square as
+    possible otherwise. The tile sizes are those of create_tiles, including
+    tile edges moved to block boundaries. At least min_tiles tiles are made,
+    so that tiles can be balanced between processes.
+
+    :param tuple shape: Shape tuple (2-element) of interferogram
+    :param int nifgs: Number of interferograms
+    :param int budget: Memory budget in bytes
+    :param tuple block_shape: Shape tuple (2-element) of raster blocks (optional)
+    :param int min_tiles: Minimum number of tiles (optional)
+
+    :return: rows: Number of rows of tiles
+    :rtype: int
+    :return: cols: Number of columns of tiles
+    :rtype: int
+    """
+    no_y, no_x = shape
+    footprint = max(tile_footprints(nifgs).values())
+    available = budget - 8 * nifgs ** 2  # float64 vcmt
+    tile_pixels = available // footprint
+    if tile_pixels < 1:
+        log.warning('Memory budget of {} bytes is too small for {} interferograms'.format(budget, nifgs))
+        tile_pixels = 1
+    striped = block_shape is None or block_shape[1] >= no_x
+    block_y, block_x = block_shape if block_shape is not None else (None, None)
+    rows, cols = 1, 1
+    while True:
+        height, width = math.ceil(no_y / rows), math.ceil(no_x / cols)
+        if height * width <= tile_pixels and block_shape is not None:
+            # largest tile after moving the edges to block boundaries
+            height = max(np.diff(_tile_edges(no_y, rows, block_y)))
+            width = max(np.diff(_tile_edges(no_x, cols, block_x)))
+        if (height * width <= tile_pixels and rows * cols >= min_tiles) or (rows == no_y and cols == no_x):
+            return rows, cols
+        if cols == no_x or (rows < no_y and (striped or height >= width)):
+            rows += 1
+        else:
+            cols += 1
+
+
+def tile_layout(ifg_paths, params):
+    """
+    Number of rows and columns of tiles, either from the configuration or
+    chosen automatically if a memory budget per process is configured. Tiles
+    chosen automatically are also small enough that every MPI process gets
+    TILES_PER_PROCESS tiles, for the dynamic scheduling of tiles. The
+    automatic layout is saved in the temporary directory and reused while
+    the raster shape, number of interferograms and budget are unchanged, so
+    process reruns and merge use the same tiles whatever the number of
+    processes.
+
+    :param list ifg_paths: List of interferogram paths
+    :param dict params: Dictionary of configuration parameters
+
+    :return: rows: Number of rows of tiles
+    :rtype: int
+    :return: cols: Number of columns of tiles
+    :rtype: int
+    """
+    if not params[cf.TILE_MEMORY]:
+        return params["rows"], params["cols"]
+    rows, cols = mpiops.run_once(_saved_tile_layout, ifg_paths, params)
+    log.info('Using {} x {} tiles for a memory budget of {} MB per process'.format(
+        rows, cols, params[cf.TILE_MEMORY]))
+    return rows, cols
+
+
+def _saved_tile_layout(ifg_paths, params):
+    """
+    Automatic tile layout saved by a previous run with the same inputs,
+    otherwise a new layout which is saved.
+    """
+    ifg = Ifg(ifg_paths[0])
+    ifg.open(readonly=True)
+    inputs = {'shape': list(ifg.shape), 'nifgs': len(ifg_paths), 'budget': params[cf.TILE_MEMORY],
+              'block_shape': list(ifg.block_shape)}
+    ifg.close()
+
+    path = join(params[cf.TMPDIR], TILE_LAYOUT_FILE)
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['inputs'] == inputs:
+                return tuple(saved['layout'])
+        except (ValueError, KeyError):
+            log.warning('Ignoring unreadable tile layout {}'.format(path))
+
+    rows, cols = auto_tile_layout(inputs['shape'], inputs['nifgs'], params[cf.TILE_MEMORY] * 2 ** 20,
+                                  inputs['block_shape'], min_tiles=TILES_PER_PROCESS * mpiops.size)
+    mkdir_p(params[cf.TMPDIR])
+    with open(path, 'w') as f:
+        json.dump({'inputs': inputs, 'layout': [rows, cols]}, f)
+    return rows, cols
+
+
+def tile_costs(tiles, preread_ifgs):
+    """
+    Estimate the relative processing cost of each tile as the total number
+    of valid pixels of all interferograms in the tile, or the number of
+    pixels in the tile if the valid pixels have not been counted.
+
+    :param list tiles: List of Tile instances
+    :param dict preread_ifgs: Dictionary of PrereadIfg instances
+
+    :return: costs: estimated cost of each tile
+    :rtype: list
+    """
+    counts = [p.valid_pixels for p in preread_ifgs.values()
+              if isinstance(p, PrereadIfg)]
+    if counts and all(c is not None for c in counts):
+        return [sum(c[t.index] for c in counts) for t in tiles]
+    return [(t.bottom_right_y - t.top_left_y) * (t.bottom_right_x - t.top_left_x) for t in tiles]
 
 
 def get_tiles(ifg_path, rows, cols):
     """
     Break up the interferograms into smaller tiles based on user supplied
-    rows and columns.
+    rows and columns, aligned with the block layout of the geotiff.
 
     :param list ifg_path: List of destination geotiff file names
     :param int rows: Number of rows to break each interferogram into
@@ -1016,7 +1351,7 @@ def get_tiles(ifg_path, rows, cols):
     """
     ifg = Ifg(ifg_path)
     ifg.open(readonly=True)
-    tiles = create_tiles(ifg.shape, nrows=rows, ncols=cols)
+    tiles = create_tiles(ifg.shape, nrows=rows, ncols=cols, block_shape=ifg.block_shape)
     ifg.close()
     return tiles
 
@@ -1112,8 +1447,12 @@ class PrereadIfg():
     # pylint: disable=too-many-arguments
     # pylint: disable=too-many-instance-attributes
     def __init__(self, path, nan_fraction, master, slave, time_span,
-                 nrows, ncols, metadata):
+                 nrows, ncols, metadata, index=None, signature=None,
+                 valid_pixels=None):
         self.path = path
+        self.index = index  # position of the ifg in the phase data store
+        self.signature = signature  # see ifg_signature
+        self.valid_pixels = valid_pixels  # number of valid pixels per tile
         self.nan_fraction = nan_fraction
         self.master = master
         self.slave = slave
@@ -1141,35 +1480,235 @@ def _prep_ifg(ifg_path, params):
     return ifg
 
 
-def save_numpy_phase(ifg_paths, tiles, params):
+def phase_stack_path(params):
+    """
+    Path of the phase data store in the temporary directory.
+
+    :param dict params: Dictionary of configuration parameters
+
+    :return: path of the numpy array file
+    :rtype: str
+    """
+    return join(params[cf.TMPDIR], 'phase_data_stack.npy')
+
+
+# memory-mapped phase data stores opened in this process, keyed by path
+_phase_stacks = {}
+
+
+def open_phase_stack(params, mode='r'):
+    """
+    Open the phase data store as a memory-mapped array of shape
+    (nifgs, nrows, ncols). Stores are cached per process and reopened
+    only if the file on disk has been replaced or modified.
+
+    :param dict params: Dictionary of configuration parameters
+    :param str mode: numpy memmap mode; 'r' or 'r+'
+
+    :return: phase data store
+    :rtype: numpy.memmap
+    """
+    path = phase_stack_path(params)
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    cached = _phase_stacks.get((path, mode))
+    if cached is None or cached[0] != key:
+        cached = (key, np.load(path, mmap_mode=mode))
+        _phase_stacks[(path, mode)] = cached
+    return cached[1]
+
+
+def _create_phase_stack(path, shape):
+    """
+    Create the phase data store, reusing an existing file of the same shape.
+    """
+    if os.path.exists(path):
+        existing = np.load(path, mmap_mode='r')
+        if existing.shape == shape and existing.dtype == np.float32:
+            return
+    stack = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+    stack.flush()
+
+
+def init_phase_stack(ifg_paths, params):
+    """
+    Create the phase data store for the interferograms on the master
+    process and open it for writing in all processes.
+
+    :param list ifg_paths: List of strings for interferogram paths
+    :param dict params: Dictionary of configuration parameters
+
+    :return: writable phase data store
+    :rtype: numpy.memmap
+    """
+    path = phase_stack_path(params)
+    if mpiops.rank == 0:
+        mkdir_p(params[cf.TMPDIR])
+        head = Ifg(ifg_paths[0])
+        head.open(readonly=True)
+        _create_phase_stack(path, (len(ifg_paths),) + head.shape)
+        head.close()
+    mpiops.comm.barrier()
+    return np.load(path, mmap_mode='r+')
+
+
+def ifg_signature(ifg):
     """
-    Save interferogram phase data as numpy array file on disk.
+    Signature of an open interferogram file, used to detect whether the
+    file has been modified since it was read.
+
+    :param Ifg ifg: open interferogram
+
+    :return: file size, modification time and metadata
+    :rtype: tuple
+    """
+    stat = os.stat(ifg.data_path)
+    return stat.st_size, stat.st_mtime_ns, ifg.dataset.GetMetadata()
+
+
+def save_numpy_phase(ifg_paths, params, preread_ifgs=None):
+    """
+    Save interferogram phase data to the memory-mapped phase data store on
+    disk. The store is a single numpy array file laid out as
+    ifg x row x col, with ifgs in the order of ifg_paths. If preread_ifgs
+    is given, only ifgs whose files have changed since they were ingested,
+    or whose phase is held by an active correction session, are written
+    again.
 
     :param list ifg_paths: List of strings for interferogram paths
-    :param list tiles: List of pyrate.shared.Tile instances
     :param dict params: Dictionary of configuration parameters
+    :param dict preread_ifgs: Dictionary of PrereadIfg instances (optional)
 
     :return: None, file saved to disk
     """
-    process_ifgs = mpiops.array_split(ifg_paths)
-    outdir = params[cf.TMPDIR]
-    if not os.path.exists(outdir):
-        mkdir_p(outdir)
-    for ifg_path in process_ifgs:
-        ifg = Ifg(ifg_path)
-        ifg.open()
-        phase_data = ifg.phase_data
-        bname = basename(ifg_path).split('.')[0]
-        for t in tiles:
-            p_data = phase_data[t.top_left_y:t.bottom_right_y,
-                                t.top_left_x:t.bottom_right_x]
-            phase_file = 'phase_data_{}_{}.npy'.format(bname, t.index)
-            np.save(file=join(outdir, phase_file),
-                    arr=p_data)
+    stack = init_phase_stack(ifg_paths, params)
+    for i in mpiops.array_split(range(len(ifg_paths))):
+        ifg = Ifg(ifg_paths[i])
+        ifg.open(readonly=True)
+        if preread_ifgs is None or ifg_signature(ifg) != preread_ifgs[ifg_paths[i]].signature \
+                or (_in_session(ifg_paths[i]) and ifg_paths[i] in _session.modified):
+            stack[i] = ifg.phase_data
         ifg.close()
+    stack.flush()
+    del stack
     mpiops.comm.barrier()
 
 
+# active correction session of this process, see correction_session
+_session = None
+
+
+def _in_session(path):
+    """
+    True if updates of the interferogram at path are deferred by an active
+    correction session.
+    """
+    return _session is not None and isinstance(path, str) and path in _session.index
+
+
+class CorrectionSession:
+    """
+    Deferred write-back of interferogram corrections. While the session is
+    active, Ifg.write_modified_phase saves phase data to a memory-mapped
+    buffer in the temporary directory and records metadata in memory,
+    instead of rewriting the geotiff. Interferograms opened during the
+    session see these updates. Each modified geotiff is written once when
+    the session is flushed, after which the buffer is deleted.
+    """
+    def __init__(self, ifg_paths, params):
+        self.index = {p: i for i, p in enumerate(ifg_paths)}
+        self.path = join(params[cf.TMPDIR], 'corrected_phase.npy')
+        self.metadata = {}  # full metadata of modified ifgs
+        self.modified = set()  # ifgs with phase data in the buffer
+        self._updates = {}  # this process's updates since the last sync
+        if mpiops.rank == 0:
+            mkdir_p(params[cf.TMPDIR])
+            head = Ifg(ifg_paths[0])
+            head.open(readonly=True)
+            _create_phase_stack(self.path, (len(ifg_paths),) + head.shape)
+            head.close()
+        mpiops.comm.barrier()
+        self.buffer = np.load(self.path, mmap_mode='r+')
+
+    def read_phase(self, path):
+        """
+        Returns a copy of the buffered phase data, or None if not modified.
+        """
+        if path in self.modified:
+            return np.array(self.buffer[self.index[path]])
+
+    def read_metadata(self, path, default):
+        """
+        Returns a copy of the updated metadata, or default if not updated.
+        """
+        return dict(self.metadata.get(path, default))
+
+    def write_phase(self, path, data, metadata):
+        """
+        Buffer phase data and metadata of an interferogram.
+        """
+        self.buffer[self.index[path]] = data
+        self.modified.add(path)
+        self.metadata[path] = dict(metadata)
+        self._updates[path] = self.metadata[path]
+
+    def sync(self):
+        """
+        Share updates between MPI processes. Must be called by all
+        processes between stages that update the same interferograms.
+        """
+        self.buffer.flush()
+        for updates in mpiops.comm.allgather(self._updates):
+            for path, metadata in updates.items():
+                self.metadata[path] = metadata
+                self.modified.add(path)
+        self._updates = {}
+
+    def flush(self):
+        """
+        Write each modified interferogram to disk once.
+        """
+        self.sync()
+        paths = sorted(self.modified)
+        for path in mpiops.array_split(paths):
+            ifg = Ifg(path)
+            ifg.open(readonly=False)
+            ifg.meta_data = dict(self.metadata[path])
+            ifg.phase_data = np.array(self.buffer[self.index[path]])
+            ifg.write_modified_phase()
+            ifg.close()
+        log.debug('Wrote {} corrected interferograms'.format(len(paths)))
+        mpiops.comm.barrier()
+
+
+@contextmanager
+def correction_session(ifg_paths, params):
+    """
+    Context manager deferring all interferogram updates to a
+    CorrectionSession, which is flushed to disk on leaving the context and
+    its buffer deleted. If an exception is raised the interferograms on disk
+    are not modified.
+
+    :param list ifg_paths: List of strings for interferogram paths
+    :param dict params: Dictionary of configuration parameters
+
+    :return: the active session
+    :rtype: CorrectionSession
+    """
+    global _session
+    session = CorrectionSession(ifg_paths, params)
+    _session = session
+    try:
+        yield session
+        _session = None
+        session.flush()
+    finally:
+        _session = None
+        del session.buffer
+    if mpiops.rank == 0:
+        os.remove(session.path)
+
+
 def get_geotiff_header_info(ifg_path):
     """
     Return information from a geotiff interferogram header using GDAL methods.
@@ -1211,7 +1750,8 @@ def warp_required(xlooks, ylooks, crop):
 
 def output_tiff_filename(inpath, outpath):
     """
-    Output geotiff filename for a given input filename.
+    Output geotiff filename for a given input filename. The output of a
+    geotiff or of a VRT converted by conv2tif keeps its name.
 
     :param str inpath: path of input file location
     :param str outpath: path of output file location
@@ -1221,7 +1761,7 @@ def output_tiff_filename(inpath, outpath):
     """
     fname, ext = os.path.basename(inpath).split('.')
     outpath = os.path.dirname(inpath) if outpath is None else outpath
-    if ext == 'tif':
+    if ext in ('tif', 'vrt'):
         name = os.path.join(outpath, fname + '.tif')
     else:
         name = os.path.join(outpath, fname + '_' + ext + '.tif')
@@ -1294,6 +1834,23 @@ def mpi_vs_multiprocess_logging(step, params):
             log.info(f"Running {step} serially")
 
 
+def set_numexpr_threads(params):
+    """
+    Set the number of numexpr threads of this process to its share of the
+    CPUs among the workers of a step: the processes of the MPI job, else
+    the joblib processes if parallel.
+
+    :param dict params: Dictionary of configuration parameters
+
+    :return: number of threads
+    :rtype: int
+    """
+    workers = mpiops.size if mpiops.size > 1 else (params[cf.PROCESSES] if params[cf.PARALLEL] else 1)
+    threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+    ne.set_num_threads(threads)
+    return threads
+
+
 def dem_or_ifg(data_path):
     """
     Returns an Ifg or DEM class object from input geotiff file.
@@ -24,12 +24,12 @@ from scipy.linalg import solve, cholesky, qr, inv
 from numpy import nan, isnan, sqrt, diag, delete, array, float32
 import numpy as np
 from joblib import Parallel, delayed
-from pyrate.core import config as cf
+from pyrate.core import config as cf, instrument
 from pyrate.core.shared import joblib_log_level
 from pyrate.core.logger import pyratelogger as log
 
 
-def stack_rate(ifgs, params, vcmt, mst=None):
+def stack_rate(ifgs, params, vcmt, mst=None, obs=None):
     """
     Pixel-by-pixel rate (velocity) estimation using iterative
     weighted least-squares stacking method.
@@ -38,6 +38,8 @@ def stack_rate(ifgs, params, vcmt, mst=None):
     :param dict params: Configuration parameters
     :param ndarray vcmt: Derived positive definite temporal variance covariance matrix
     :param ndarray mst: Pixel-wise matrix describing the minimum spanning tree network
+    :param ndarray obs: [optional] 3D array of the phase data of ifgs, used
+        instead of copying it from the ifgs. NaNs are set to zero in place.
 
     :return: rate: Rate (velocity) map
     :rtype: ndarray
@@ -46,7 +48,7 @@ def stack_rate(ifgs, params, vcmt, mst=None):
     :return: samples: Number of observations used in rate calculation per pixel
     :rtype: ndarray
     """
-    maxsig, nsig, pthresh, cols, error, mst, obs, parallel, _, rate, rows, samples, span = _stack_setup(ifgs, mst, params)
+    maxsig, nsig, pthresh, cols, error, mst, obs, parallel, _, rate, rows, samples, span = _stack_setup(ifgs, mst, params, obs)
 
     # pixel-by-pixel calculation.
     # nested loops to loop over the 2 image dimensions
@@ -77,7 +79,7 @@ def stack_rate(ifgs, params, vcmt, mst=None):
     return rate, error, samples
 
 
-def _stack_setup(ifgs, mst, params):
+def _stack_setup(ifgs, mst, params, obs=None):
     """
     Convenience function for stack rate setup
     """
@@ -91,15 +93,15 @@ def _stack_setup(ifgs, mst, params):
     maxsig = params[cf.LR_MAXSIG]
     # Pixel threshold; minimum number of coherent observations for a pixel
     pthresh = params[cf.LR_PTHRESH]
-    rows, cols = ifgs[0].phase_data.shape
     # make 3D block of observations
-    obs = array([np.where(isnan(x.phase_data), 0, x.phase_data) for x in ifgs])
+    if obs is None:
+        obs = array([x.phase_data for x in ifgs])
+    rows, cols = obs.shape[1:]
+    nans = isnan(obs)
+    obs[nans] = 0
     span = array([[x.time_span for x in ifgs]])
-    # Update MST in case additional NaNs generated by APS filtering
     if mst is None:  # dummy mst if none is passed in
         mst = ~isnan(obs)
-    else:
-        mst[isnan(obs)] = 0
 
     # preallocate empty arrays. No need to preallocation NaNs with new code
     error = np.empty([rows, cols], dtype=float32)
@@ -115,6 +117,12 @@ def _stack_rate_by_pixel(row, col, mst, nsig, obs, pthresh, span, vcmt):
     ind = np.nonzero(mst[:, row, col])[0]  # only True's in mst are chosen
     # iterative loop to calculate 'robust' velocity for pixel
     default_no_samples = len(ind)
+    counters = instrument.counters()
+    if counters is not None:
+        counters.add('stack.pixels')
+        counters.pattern('stack.patterns', ind)
+        if len(ind) < pthresh:
+            counters.add('stack.skipped')
 
     while len(ind) >= pthresh:
         # make vector of selected ifg observations
@@ -160,6 +168,8 @@ def _stack_rate_by_pixel(row, col, mst, nsig, obs, pthresh, span, vcmt):
         if max_val > nsig:
             # if yes, discard and re-do the calculation.
             ind = delete(ind, wr.argmax())
+            if counters is not None:
+                counters.add('stack.outliers')
         else:
             # if no, save estimate, exit the while loop and go to next pixel
             return v[0], err[0], ifgv.shape[0]
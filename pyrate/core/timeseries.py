@@ -29,12 +29,12 @@ from scipy.linalg import qr
 from joblib import Parallel, delayed
 from pyrate.core.shared import joblib_log_level
 from pyrate.core.algorithm import master_slave_ids, get_epochs
-from pyrate.core import config as cf, mst as mst_module
+from pyrate.core import config as cf, mst as mst_module, instrument
 from pyrate.core.config import ConfigException
 from pyrate.core.logger import pyratelogger as log
 
 
-def _time_series_setup(ifgs, mst, params):
+def _time_series_setup(ifgs, mst, params, ifg_data=None):
     """
     Convenience function for setting up time series computation parameters
     """
@@ -74,9 +74,10 @@ def _time_series_setup(ifgs, mst, params):
     b0_mat[isign[0], :] = -b0_mat[isign[0], :]
     tsvel_matrix = np.empty(shape=(nrows, ncols, nvelpar),
                             dtype=float32)
-    ifg_data = np.zeros((nifgs, nrows, ncols), dtype=float32)
-    for ifg_num in range(nifgs):
-        ifg_data[ifg_num] = ifgs[ifg_num].phase_data
+    if ifg_data is None:
+        ifg_data = np.zeros((nifgs, nrows, ncols), dtype=float32)
+        for ifg_num in range(nifgs):
+            ifg_data[ifg_num] = ifgs[ifg_num].phase_data
     if mst is None:
         mst = ~isnan(ifg_data)
     return b0_mat, interp, pthresh, smfactor, smorder, tsmethod, ifg_data, \
@@ -107,7 +108,7 @@ def _validate_params(params, tsmethod):
     return pthresh, smfactor, smorder
 
 
-def time_series(ifgs, params, vcmt=None, mst=None):
+def time_series(ifgs, params, vcmt=None, mst=None, ifg_data=None):
     """
     Calculates the displacement time series from the given interferogram
     network. Solves the linear least squares system using either the SVD
@@ -119,6 +120,8 @@ def time_series(ifgs, params, vcmt=None, mst=None):
     :param dict params: Dictionary of configuration parameters
     :param ndarray vcmt: Positive definite temporal variance covariance matrix
     :param ndarray mst: [optional] Minimum spanning tree array.
+    :param ndarray ifg_data: [optional] 3D array of the phase data of ifgs,
+        used instead of copying it from the ifgs.
 
     :return: Tuple with the elements:
 
@@ -137,7 +140,7 @@ def time_series(ifgs, params, vcmt=None, mst=None):
 
     b0_mat, interp, p_thresh, sm_factor, sm_order, ts_method, ifg_data, mst, \
         ncols, nrows, nvelpar, parallel, span, tsvel_matrix = \
-        _time_series_setup(ifgs, mst, params)
+        _time_series_setup(ifgs, mst, params, ifg_data)
 
     if parallel:
         log.info('Calculating timeseries in parallel')
@@ -187,6 +190,12 @@ def _time_series_by_pixel(row, col, b0_mat, sm_factor, sm_order, ifg_data, mst,
     """
     # check pixel for non-redundant ifgs
     sel = np.nonzero(mst[:, row, col])[0]  # trues in mst are chosen
+    counters = instrument.counters()
+    if counters is not None:
+        counters.add('timeseries.pixels')
+        counters.pattern('timeseries.patterns', sel)
+        if len(sel) < p_thresh:
+            counters.add('timeseries.skipped')
     if len(sel) >= p_thresh:
         ifgv = ifg_data[sel, row, col]
         # make design matrix, b_mat
@@ -200,6 +209,8 @@ def _time_series_by_pixel(row, col, b0_mat, sm_factor, sm_order, ifg_data, mst,
                 if b_mat.shape[0] > 1:
                     b_mat, ifgv, sel, rmrow = _remove_rank_def_rows(
                         b_mat, nvelpar, ifgv, sel)
+                    if counters is not None:
+                        counters.add('timeseries.rank_deficient_rows', len(rmrow))
                 else:
                     return np.empty(nvelpar) * np.nan
 
@@ -124,6 +124,30 @@ PYRATE_DEFAULT_CONFIGURATION = {
         "PossibleValues": None,
         "Required": False
     },
+    "tilemem": {
+        "DataType": int,
+        "DefaultValue": 0,
+        "MinValue": 0,
+        "MaxValue": None,
+        "PossibleValues": None,
+        "Required": False
+    },
+    "kernelcounters": {
+        "DataType": int,
+        "DefaultValue": 0,
+        "MinValue": None,
+        "MaxValue": None,
+        "PossibleValues": [0, 1],
+        "Required": False
+    },
+    "conv2vrt": {
+        "DataType": int,
+        "DefaultValue": 0,
+        "MinValue": None,
+        "MaxValue": None,
+        "PossibleValues": [0, 1],
+        "Required": False
+    },
     "cohmask": {
         "DataType": int,
         "DefaultValue": 0,
@@ -253,6 +277,14 @@ PYRATE_DEFAULT_CONFIGURATION = {
         "PossibleValues": [1, 2],
         "Required": False
     },
+    "refsearchlks": {
+        "DataType": int,
+        "DefaultValue": 1,
+        "MinValue": 1,
+        "MaxValue": None,
+        "PossibleValues": None,
+        "Required": False
+    },
     "orbfit": {
         "DataType": int,
         "DefaultValue": 0,
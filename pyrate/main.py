@@ -27,7 +27,7 @@ from pyrate.constants import CLI_DESCRIPTION
 from pyrate import conv2tif, prepifg, process, merge
 from pyrate.core.logger import pyratelogger as log, configure_stage_log
 from pyrate.core import config as cf
-from pyrate.core import mpiops
+from pyrate.core import mpiops, instrument
 from pyrate.configuration import Configuration
 
 
@@ -87,6 +87,17 @@ def main():
         log.setLevel(args.verbosity)
         log.info("Verbosity set to " + str(args.verbosity) + ".")
 
+    with instrument.stage(args.command):
+        _run(args, params)
+    instrument.write_report(args.command)
+
+    log.debug("--- %s seconds ---" % (time.time() - start_time))
+
+
+def _run(args, params):
+    """
+    Run the PyRate step selected on the command line
+    """
     if args.command == "conv2tif":
         conv2tif.main(params)
 
@@ -101,23 +112,25 @@ def main():
 
     if args.command == "workflow":
         log.info("***********CONV2TIF**************")
-        conv2tif.main(params)
+        with instrument.stage("conv2tif"):
+            conv2tif.main(params)
 
         log.info("***********PREPIFG**************")
         params = mpiops.run_once(_params_from_conf, args.config_file)
-        prepifg.main(params)
+        with instrument.stage("prepifg"):
+            prepifg.main(params)
 
         log.info("***********PROCESS**************")
         # reset params as prepifg modifies params
         params = mpiops.run_once(_params_from_conf, args.config_file)
-        process.main(params)
+        with instrument.stage("process"):
+            process.main(params)
 
         # process might modify params too
         params = mpiops.run_once(_params_from_conf, args.config_file)
         log.info("***********MERGE**************")
-        merge.main(params)
-
-    log.debug("--- %s seconds ---" % (time.time() - start_time))
+        with instrument.stage("merge"):
+            merge.main(params)
 
 
 if __name__ == "__main__":
@@ -25,7 +25,7 @@ from osgeo import gdal
 import subprocess
 from pathlib import Path
 
-from pyrate.core import shared, ifgconstants as ifc, mpiops, config as cf
+from pyrate.core import shared, ifgconstants as ifc, mpiops, config as cf, instrument
 from pyrate.core.shared import PrereadIfg
 from pyrate.constants import REF_COLOR_MAP_PATH
 from pyrate.core.config import OBS_DIR, OUT_DIR, ConfigException
@@ -44,7 +44,8 @@ def main(params):
     single geotiff files
     """
     # setup paths
-    rows, cols = params["rows"], params["cols"]
+    ifg_paths = [ifg_path.sampled_path for ifg_path in params[cf.INTERFEROGRAM_FILES]]
+    rows, cols = shared.tile_layout(ifg_paths, params)
     _merge_stack(rows, cols, params)
 
     if params[cf.TIME_SERIES_CAL]:
@@ -126,6 +127,7 @@ def create_png_from_tif(output_folder_path):
                            color_map_path, output_png_path, "-nearest_color_entry"])
 
 
+@instrument.timed('stack')
 def _merge_stack(rows, cols, params):
     """
     Merge stacking outputs
@@ -196,6 +198,7 @@ def _save_stack(ifgs_dict, params, tiles, out_type):
     log.debug('Finished PyRate merging {}'.format(out_type))
 
 
+@instrument.timed('timeseries')
 def _merge_timeseries(rows, cols, params):
     """
     Merge time series output
@@ -27,7 +27,7 @@ import numpy as np
 from pyrate.core import (shared, algorithm, orbital, ref_phs_est as rpe, 
                          ifgconstants as ifc, mpiops, config as cf, 
                          timeseries, mst, covariance as vcm_module, 
-                         stack, refpixel)
+                         stack, refpixel, checkpoint, instrument)
 from pyrate.core.aps import wrap_spatio_temporal_filter
 from pyrate.core.shared import Ifg, PrereadIfg, get_tiles, mpi_vs_multiprocess_logging
 from pyrate.core.logger import pyratelogger as log
@@ -45,10 +45,13 @@ def _join_dicts(dicts):
     return assembled_dict
 
 
+@instrument.timed('ingest')
 def _create_ifg_dict(dest_tifs, params, tiles):
     """
-    1. Convert ifg phase data into numpy binary files.
-    2. Save the preread_ifgs dict with information about the ifgs that are
+    Single pass over the interferograms, reading the phase band of each once:
+    1. Save ifg phase data to the memory-mapped phase data store.
+    2. Count the valid (non-NaN) pixels of each ifg in each tile.
+    3. Save the preread_ifgs dict with information about the ifgs that are
     later used for fast loading of Ifg files in IfgPart class
 
     :param list dest_tifs: List of destination tifs
@@ -61,10 +64,15 @@ def _create_ifg_dict(dest_tifs, params, tiles):
     """
     ifgs_dict = {}
     nifgs = len(dest_tifs)
-    process_tifs = mpiops.array_split(dest_tifs)
-    shared.save_numpy_phase(dest_tifs, tiles, params)
-    for d in process_tifs:
-        ifg = shared._prep_ifg(d, params)
+    stack = shared.init_phase_stack(dest_tifs, params)
+    for i in mpiops.array_split(range(nifgs)):
+        d = dest_tifs[i]
+        ifg = Ifg(d)
+        ifg.open()
+        signature = shared.ifg_signature(ifg)
+        stack[i] = ifg.phase_data
+        shared.nan_and_mm_convert(ifg, params)
+        valid = ~np.isnan(ifg.phase_data)
         ifgs_dict[d] = PrereadIfg(path=d,
                                   nan_fraction=ifg.nan_fraction,
                                   master=ifg.master,
@@ -72,8 +80,16 @@ def _create_ifg_dict(dest_tifs, params, tiles):
                                   time_span=ifg.time_span,
                                   nrows=ifg.nrows,
                                   ncols=ifg.ncols,
-                                  metadata=ifg.meta_data)
+                                  metadata=ifg.meta_data,
+                                  index=i,
+                                  signature=signature,
+                                  valid_pixels=[int(np.sum(valid[t.top_left_y:t.bottom_right_y,
+                                                                 t.top_left_x:t.bottom_right_x]))
+                                                for t in tiles])
+        instrument.add_pixels(ifg.num_cells)
         ifg.close()
+    stack.flush()
+    del stack
     ifgs_dict = _join_dicts(mpiops.comm.allgather(ifgs_dict))
 
     preread_ifgs_file = join(params[cf.TMPDIR], 'preread_ifgs.pk')
@@ -81,7 +97,7 @@ def _create_ifg_dict(dest_tifs, params, tiles):
     if mpiops.rank == MASTER_PROCESS:
 
         # add some extra information that's also useful later
-        gt, md, wkt = shared.get_geotiff_header_info(process_tifs[0])
+        gt, md, wkt = shared.get_geotiff_header_info(dest_tifs[0])
         epochlist = algorithm.get_epochs(ifgs_dict)[0]
         log.info('Found {} unique epochs in the {} interferogram network'.format(len(epochlist.dates), nifgs))
         ifgs_dict['epochlist'] = epochlist
@@ -97,11 +113,15 @@ def _create_ifg_dict(dest_tifs, params, tiles):
     return preread_ifgs
 
 
-def _mst_calc(dest_tifs, params, tiles, preread_ifgs):
+@instrument.timed('mst')
+def _mst_calc(dest_tifs, params, tiles, preread_ifgs, journal):
     """
-    MPI wrapper function for MST calculation
+    MPI wrapper function for MST calculation. Tiles completed according to
+    the journal are not calculated again.
     """
-    process_tiles = mpiops.array_split(tiles)
+    tiles = journal.remaining(tiles)
+    counter = mpiops.SharedCounter()
+    process_tiles = mpiops.dynamic_split(tiles, shared.tile_costs(tiles, preread_ifgs), counter)
     log.info('Calculating minimum spanning tree matrix')
 
     def _save_mst_tile(tile, i, preread_ifgs):
@@ -109,16 +129,20 @@ def _mst_calc(dest_tifs, params, tiles, preread_ifgs):
         Convenient inner loop for mst tile saving
         """
         mst_tile = mst.mst_multiprocessing(tile, dest_tifs, preread_ifgs, params)
+        instrument.add_pixels(mst_tile.size)
         # locally save the mst_mat
         mst_file_process_n = join(params[cf.TMPDIR], 'mst_mat_{}.npy'.format(i))
-        np.save(file=mst_file_process_n, arr=mst_tile)
+        journal.save(tile, {mst_file_process_n: mst_tile})
 
     for t in process_tiles:
-        _save_mst_tile(t, t.index, preread_ifgs)
+        with instrument.tile_counters(t.index):
+            _save_mst_tile(t, t.index, preread_ifgs)
+    counter.free()
     log.debug('Finished mst calculation for process {}'.format(mpiops.rank))
     mpiops.comm.barrier()
 
 
+@instrument.timed('refpixel')
 def _ref_pixel_calc(ifg_paths, params):
     """
     Wrapper for reference pixel calculation
@@ -133,15 +157,12 @@ def _ref_pixel_calc(ifg_paths, params):
 
         log.info('Searching for best reference pixel location')
 
-        half_patch_size, thresh, grid = refpixel.ref_pixel_setup(ifg_paths, params)
-        process_grid = mpiops.array_split(grid)
-        refpixel.save_ref_pixel_blocks(process_grid, half_patch_size, ifg_paths, params)
-        mean_sds = refpixel._ref_pixel_mpi(process_grid, half_patch_size, ifg_paths, thresh, params)
-        mean_sds = mpiops.comm.gather(mean_sds, root=0)
-        if mpiops.rank == MASTER_PROCESS:
-            mean_sds = np.hstack(mean_sds)
-
-        refpixel_returned = mpiops.run_once(refpixel.find_min_mean, mean_sds, grid)
+        if params[cf.REF_SEARCH_LOOKS] > 1:
+            refpixel_returned = refpixel.ref_pixel_coarse_to_fine(ifg_paths, params)
+        else:
+            half_patch_size, thresh, grid = refpixel.ref_pixel_setup(ifg_paths, params)
+            mean_sds = refpixel.ref_pixel_mean_sds(ifg_paths, grid, half_patch_size, thresh, params)
+            refpixel_returned = mpiops.run_once(refpixel.find_min_mean, mean_sds, grid)
 
         if isinstance(refpixel_returned, ValueError):
             from pyrate.core.refpixel import RefPixelError
@@ -159,6 +180,7 @@ def _ref_pixel_calc(ifg_paths, params):
     return refx, refy
 
 
+@instrument.timed('orbfit')
 def _orb_fit_calc(ifg_paths, params, preread_ifgs=None):
     """
     MPI wrapper for orbital fit correction
@@ -191,6 +213,7 @@ def _orb_fit_calc(ifg_paths, params, preread_ifgs=None):
     log.debug('Finished Orbital error correction')
 
 
+@instrument.timed('refphase')
 def _ref_phase_estimation(ifg_paths, params, refpx, refpy):
     """
     Wrapper for reference phase estimation.
@@ -251,12 +274,13 @@ def main(params):
     :rtype: ndarray
     """
     mpi_vs_multiprocess_logging("process", params)
+    instrument.enable_counters(params[cf.KERNEL_COUNTERS])
 
     ifg_paths = []
     for ifg_path in params[cf.INTERFEROGRAM_FILES]:
         ifg_paths.append(ifg_path.sampled_path)
 
-    rows, cols = params["rows"], params["cols"]
+    rows, cols = shared.tile_layout(ifg_paths, params)
 
     return process_ifgs(ifg_paths, params, rows, cols)
 
@@ -281,60 +305,76 @@ def process_ifgs(ifg_paths, params, rows, cols):
     if mpiops.size > 1:  # turn of multiprocessing during mpi jobs
         params[cf.PARALLEL] = False
 
+    # completed stages of a previous run with the same inputs are skipped
+    manifest = checkpoint.Manifest(params)
+    key = manifest.inputs_key(ifg_paths)
+
     tiles = mpiops.run_once(get_tiles, ifg_paths[0], rows, cols)
 
     preread_ifgs = _create_ifg_dict(ifg_paths, params=params, tiles=tiles)
     # _mst_calc(ifg_paths, params, tiles, preread_ifgs)
 
-    refpx, refpy = _ref_pixel_calc(ifg_paths, params)
+    key = checkpoint.stage_key(key, params, checkpoint.REF_PIXEL_PARAMS)
+    if manifest.complete('refpixel', key):
+        refpx, refpy = manifest.outputs('refpixel')['refpt']
+    else:
+        refpx, refpy = _ref_pixel_calc(ifg_paths, params)
+        manifest.record('refpixel', key, refpt=[int(refpx), int(refpy)])
 
     log.debug("refpx, refpy: "+str(refpx) + " " + str(refpy))
 
     # remove non ifg keys
     _ = [preread_ifgs.pop(k) for k in ['gt', 'epochlist', 'md', 'wkt']]
 
-    _orb_fit_calc(ifg_paths, params, preread_ifgs)
-
-    _ref_phase_estimation(ifg_paths, params, refpx, refpy)
-
-    _mst_calc(ifg_paths, params, tiles, preread_ifgs)
-
-    # spatio-temporal aps filter
-    wrap_spatio_temporal_filter(ifg_paths, params, tiles, preread_ifgs)
-
-    maxvar, vcmt = _maxvar_vcm_calc(ifg_paths, params, preread_ifgs)
-    # save phase data tiles as numpy array for timeseries and stackrate calc
-
-    shared.save_numpy_phase(ifg_paths, tiles, params)
-
-    _timeseries_calc(ifg_paths, params, vcmt, tiles, preread_ifgs)
-
-    _stack_calc(ifg_paths, params, vcmt, tiles, preread_ifgs)
+    key = checkpoint.stage_key(key, params, checkpoint.CORRECTION_PARAMS, rows, cols)
+    maxvar_file = join(params[cf.TMPDIR], 'maxvar.npy')
+    vcmt_file = join(params[cf.TMPDIR], 'vcmt.npy')
+    if manifest.complete(checkpoint.CORRECTIONS, key):
+        maxvar, vcmt = np.load(maxvar_file), np.load(vcmt_file)
+    else:
+        manifest.check_corrections(key)
+        # corrected interferograms are written to disk once, after maxvar/vcm
+        with shared.correction_session(ifg_paths, params) as session:
+            _orb_fit_calc(ifg_paths, params, preread_ifgs)
+            session.sync()
+
+            _ref_phase_estimation(ifg_paths, params, refpx, refpy)
+            session.sync()
+
+            if params[cf.APSEST]:  # otherwise calculated with the time series
+                _mst_calc(ifg_paths, params, tiles, preread_ifgs,
+                          checkpoint.TileJournal(params, 'mst', key))
+
+            # spatio-temporal aps filter
+            wrap_spatio_temporal_filter(ifg_paths, params, tiles, preread_ifgs)
+            session.sync()
+
+            maxvar, vcmt = _maxvar_vcm_calc(ifg_paths, params, preread_ifgs)
+            session.sync()
+
+            # save phase data tiles as numpy array for timeseries and stackrate calc
+            with instrument.stage('phase_store'):
+                shared.save_numpy_phase(ifg_paths, params, preread_ifgs)
+
+        mpiops.run_once(np.save, maxvar_file, maxvar)
+        mpiops.run_once(np.save, vcmt_file, vcmt)
+        files = [maxvar_file, vcmt_file, shared.phase_stack_path(params)]
+        if params[cf.APSEST]:
+            files += [join(params[cf.TMPDIR], 'mst_mat_{}.npy'.format(t.index)) for t in tiles]
+        manifest.corrected(ifg_paths)
+        manifest.record(checkpoint.CORRECTIONS, key, files)
+
+    key = checkpoint.stage_key(key, params, checkpoint.TILE_PARAMS)
+    if not manifest.complete('tiles', key):
+        _tile_calc(ifg_paths, params, vcmt, tiles, preread_ifgs,
+                   checkpoint.TileJournal(params, 'tiles', key))
+        manifest.record('tiles', key, _tile_files(params, tiles))
 
     log.info('PyRate workflow completed')
     return (refpx, refpy), maxvar, vcmt
 
 
-def _stack_calc(ifg_paths, params, vcmt, tiles, preread_ifgs):
-    """
-    MPI wrapper for stacking calculation
-    """
-    process_tiles = mpiops.array_split(tiles)
-    log.info('Calculating rate map from stacking')
-    output_dir = params[cf.TMPDIR]
-    for t in process_tiles:
-        log.info('Stacking of tile {}'.format(t.index))
-        ifg_parts = [shared.IfgPart(p, t, preread_ifgs, params) for p in ifg_paths]
-        mst_grid_n = np.load(os.path.join(output_dir, 'mst_mat_{}.npy'.format(t.index)))
-        rate, error, samples = stack.stack_rate(ifg_parts, params, vcmt, mst_grid_n)
-        # declare file names
-        np.save(file=os.path.join(output_dir, 'stack_rate_{}.npy'.format(t.index)), arr=rate)
-        np.save(file=os.path.join(output_dir, 'stack_error_{}.npy'.format(t.index)), arr=error)
-        np.save(file=os.path.join(output_dir, 'stack_samples_{}.npy'.format(t.index)), arr=samples)
-    mpiops.comm.barrier()
-    log.debug("Finished stack rate calc!")
-
-
+@instrument.timed('maxvar_vcm')
 def _maxvar_vcm_calc(ifg_paths, params, preread_ifgs):
     """
     MPI wrapper for maxvar and vcmt computation
@@ -377,29 +417,64 @@ def _maxvar_vcm_calc(ifg_paths, params, preread_ifgs):
     return maxvar, vcmt
 
 
-def _timeseries_calc(ifg_paths, params, vcmt, tiles, preread_ifgs):
+def _tile_files(params, tiles):
     """
-    MPI wrapper for time series calculation.
+    Files saved by _tile_calc
+    """
+    names = ['mst_mat', 'stack_rate', 'stack_error', 'stack_samples']
+    if params[cf.TIME_SERIES_CAL]:
+        names += ['tsincr', 'tscuml']
+    return [join(params[cf.TMPDIR], '{}_{}.npy'.format(n, t.index)) for n in names for t in tiles]
+
+
+@instrument.timed('tiles')
+def _tile_calc(ifg_paths, params, vcmt, tiles, preread_ifgs, journal):
+    """
+    MPI wrapper for the per-tile MST, time series and stacking calculations.
+    The phase data of each tile is read once and shared by all three steps.
+    Tiles completed according to the journal are not calculated again.
     """
     if params[cf.TIME_SERIES_CAL] == 0:
         log.info('Time Series Calculation not required')
-        return
-
-    if params[cf.TIME_SERIES_METHOD] == 1:
+    elif params[cf.TIME_SERIES_METHOD] == 1:
         log.info('Calculating time series using Laplacian Smoothing method')
     elif params[cf.TIME_SERIES_METHOD] == 2:
         log.info('Calculating time series using SVD method')
+    log.info('Calculating rate map from stacking')
 
     output_dir = params[cf.TMPDIR]
     total_tiles = len(tiles)
-    process_tiles = mpiops.array_split(tiles)
+    tiles = journal.remaining(tiles)
+    counter = mpiops.SharedCounter()
+    process_tiles = mpiops.dynamic_split(tiles, shared.tile_costs(tiles, preread_ifgs), counter)
     for t in process_tiles:
-        log.debug("Calculating time series for tile "+str(t.index)+" out of "+str(total_tiles))
-        ifg_parts = [shared.IfgPart(p, t, preread_ifgs, params) for p in ifg_paths]
-        mst_tile = np.load(os.path.join(output_dir, 'mst_mat_{}.npy'.format(t.index)))
-        res = timeseries.time_series(ifg_parts, params, vcmt, mst_tile)
-        tsincr, tscum, _ = res
-        np.save(file=os.path.join(output_dir, 'tsincr_{}.npy'.format(t.index)), arr=tsincr)
-        np.save(file=os.path.join(output_dir, 'tscuml_{}.npy'.format(t.index)), arr=tscum)
+        with instrument.tile_counters(t.index):
+            log.debug("Calculating tile "+str(t.index)+" out of "+str(total_tiles))
+            ifg_parts = [shared.IfgPart(p, t, preread_ifgs, params) for p in ifg_paths]
+            phase_data = np.array([i.phase_data for i in ifg_parts], dtype=np.float32)
+            instrument.add_pixels(phase_data.size)
+            for i, data in zip(ifg_parts, phase_data):
+                i.phase_data = data
+
+            out = {}  # products of the tile, saved once all are calculated
+            mst_file = join(output_dir, 'mst_mat_{}.npy'.format(t.index))
+            if params[cf.APSEST]:  # calculated before the aps correction
+                mst_tile = np.load(mst_file)
+            else:
+                mst_tile = mst.mst_boolean_array(ifg_parts)
+                out[mst_file] = mst_tile.copy()
+
+            if params[cf.TIME_SERIES_CAL]:
+                tsincr, tscum, _ = timeseries.time_series(ifg_parts, params, vcmt, mst_tile, ifg_data=phase_data)
+                out[join(output_dir, 'tsincr_{}.npy'.format(t.index))] = tsincr
+                out[join(output_dir, 'tscuml_{}.npy'.format(t.index))] = tscum
+
+            # stacking sets the nans of phase_data to zero, so comes last
+            rate, error, samples = stack.stack_rate(ifg_parts, params, vcmt, mst_tile, obs=phase_data)
+            out[join(output_dir, 'stack_rate_{}.npy'.format(t.index))] = rate
+            out[join(output_dir, 'stack_error_{}.npy'.format(t.index))] = error
+            out[join(output_dir, 'stack_samples_{}.npy'.format(t.index))] = samples
+        journal.save(t, out)
+    counter.free()
     mpiops.comm.barrier()
-    log.debug("Finished timeseries calc!")
+    log.debug("Finished mst, timeseries and stack rate calc!")
@@ -0,0 +1,152 @@
+#   This Python module is part of the PyRate software package.
+#
+#   Copyright 2020 Geoscience Australia
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+This Python module contains tests for the checkpoint.py PyRate module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+import numpy as np
+
+from pyrate.core import checkpoint, config as cf, ifgconstants as ifc
+from pyrate.core.shared import Ifg, create_tiles, CorrectionStatusError
+from tests import common
+
+
+class StageKeyTests(unittest.TestCase):
+
+    def test_key_depends_on_params(self):
+        params = {cf.LR_NSIG: 3, cf.LR_MAXSIG: 2}
+        key = checkpoint.stage_key('a', params, [cf.LR_NSIG])
+        self.assertEqual(key, checkpoint.stage_key('a', dict(params), [cf.LR_NSIG]))
+        self.assertNotEqual(key, checkpoint.stage_key('b', params, [cf.LR_NSIG]))
+        self.assertNotEqual(key, checkpoint.stage_key('a', {cf.LR_NSIG: 2}, [cf.LR_NSIG]))
+        self.assertNotEqual(key, checkpoint.stage_key('a', params, [cf.LR_NSIG], 3, 2))
+        # parameters not relevant to the stage do not change the key
+        self.assertEqual(key, checkpoint.stage_key('a', {cf.LR_NSIG: 3}, [cf.LR_NSIG]))
+
+
+class ManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {cf.TMPDIR: tempfile.mkdtemp()}
+        self.ifg_paths = []
+        for p in common.small_ifg_file_list()[:3]:
+            dest = join(self.params[cf.TMPDIR], os.path.basename(p))
+            shutil.copy(p, dest)
+            self.ifg_paths.append(dest)
+        self.output = join(self.params[cf.TMPDIR], 'out.npy')
+        open(self.output, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.params[cf.TMPDIR])
+
+    def _correct(self):
+        ifg = Ifg(self.ifg_paths[0])
+        ifg.open(readonly=False)
+        ifg.meta_data[ifc.PYRATE_ORBITAL_ERROR] = ifc.ORB_REMOVED
+        ifg.write_modified_phase()
+        ifg.close()
+
+    def test_completed_stage_skipped_on_rerun(self):
+        manifest = checkpoint.Manifest(self.params)
+        key = manifest.inputs_key(self.ifg_paths)
+        manifest.record('refpixel', key, [self.output], refpt=[3, 4])
+        manifest = checkpoint.Manifest(self.params)
+        self.assertEqual(manifest.inputs_key(self.ifg_paths), key)
+        self.assertTrue(manifest.complete('refpixel', key))
+        self.assertFalse(manifest.complete('refpixel', 'other'))
+        self.assertEqual(manifest.outputs('refpixel')['refpt'], [3, 4])
+        os.remove(self.output)
+        self.assertFalse(manifest.complete('refpixel', key))
+
+    def test_corrected_inputs(self):
+        manifest = checkpoint.Manifest(self.params)
+        key = manifest.inputs_key(self.ifg_paths)
+        self._correct()
+        manifest.corrected(self.ifg_paths)
+        manifest.record(checkpoint.CORRECTIONS, key)
+        manifest = checkpoint.Manifest(self.params)
+        self.assertEqual(manifest.inputs_key(self.ifg_paths), key)
+        self.assertTrue(manifest.complete(checkpoint.CORRECTIONS, key))
+
+    def test_changed_correction_params(self):
+        manifest = checkpoint.Manifest(self.params)
+        key = manifest.inputs_key(self.ifg_paths)
+        self._correct()
+        manifest.corrected(self.ifg_paths)
+        manifest.record(checkpoint.CORRECTIONS, 'corrections key')
+        manifest = checkpoint.Manifest(self.params)
+        self.assertEqual(manifest.inputs_key(self.ifg_paths), key)
+        manifest.check_corrections('corrections key')
+        with self.assertRaises(CorrectionStatusError):
+            manifest.check_corrections('other corrections key')
+
+    def test_changed_inputs(self):
+        manifest = checkpoint.Manifest(self.params)
+        key = manifest.inputs_key(self.ifg_paths)
+        manifest.record('refpixel', key, refpt=[3, 4])
+        self._correct()
+        manifest = checkpoint.Manifest(self.params)
+        self.assertNotEqual(manifest.inputs_key(self.ifg_paths), key)
+        self.assertFalse(manifest.complete('refpixel', key))
+
+
+class TileJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {cf.TMPDIR: tempfile.mkdtemp()}
+        self.tiles = create_tiles((10, 12), nrows=2, ncols=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.params[cf.TMPDIR])
+
+    def _file(self, tile):
+        return join(self.params[cf.TMPDIR], 'out_{}.npy'.format(tile.index))
+
+    def _save(self, journal, tiles):
+        for t in tiles:
+            journal.save(t, {self._file(t): np.full((2, 3), t.index)})
+
+    def test_remaining_tiles(self):
+        journal = checkpoint.TileJournal(self.params, 'stage', 'key')
+        self.assertEqual(journal.remaining(self.tiles), self.tiles)
+        self._save(journal, self.tiles[:2])
+        journal = checkpoint.TileJournal(self.params, 'stage', 'key')
+        self.assertEqual(journal.remaining(self.tiles), self.tiles[2:])
+        np.testing.assert_array_equal(np.load(self._file(self.tiles[1])), 1)
+        journal = checkpoint.TileJournal(self.params, 'stage', 'other key')
+        self.assertEqual(journal.remaining(self.tiles), self.tiles)
+
+    def test_corrupt_tile_recomputed(self):
+        journal = checkpoint.TileJournal(self.params, 'stage', 'key')
+        self._save(journal, self.tiles)
+        with open(self._file(self.tiles[3]), 'ab') as f:
+            f.write(b'x')
+        os.remove(self._file(self.tiles[0]))
+        with open(journal.path, 'a') as f:
+            f.write('{"key": "ke')  # interrupted write
+        journal = checkpoint.TileJournal(self.params, 'stage', 'key')
+        self.assertEqual(journal.remaining(self.tiles), [self.tiles[0], self.tiles[3]])
+
+    def test_save_atomic(self):
+        path = join(self.params[cf.TMPDIR], 'a.npy')
+        crc = checkpoint.save_atomic(path, np.arange(5))
+        self.assertEqual(crc, checkpoint.checksum(path))
+        self.assertEqual(os.listdir(self.params[cf.TMPDIR]), ['a.npy'])
@@ -46,6 +46,14 @@ def test_small_data_coherence(gamma_params):
         np.testing.assert_array_equal(nans, cifg_below_thrhold)
 
 
+def test_mask_coherence_in_place():
+    src = np.arange(6, dtype=np.float32).reshape(2, 3)
+    coherence = np.array([[0.1, 0.5, np.nan], [0.9, 0.2, 0.6]], dtype=np.float32)
+    masked = gdal_python.mask_coherence(src, coherence, 0.5)
+    assert masked is src
+    np.testing.assert_array_equal(src, [[np.nan, 1, np.nan], [3, np.nan, 5]])
+
+
 def test_coherence_files_not_converted():
     # define constants
     NO_DATA_VALUE = 0
@@ -51,6 +51,14 @@ def test_conversion_not_recomputed(gamma_params):
     assert all([not b for gt, b in gtifs_and_conversion_bool])
 
 
+def test_conversion_recomputed_when_input_changes(gamma_params):
+    conv2tif.main(copy.deepcopy(gamma_params))
+    changed = gamma_params[cf.INTERFEROGRAM_FILES][0].unwrapped_path
+    os.utime(changed, ns=(os.stat(changed).st_atime_ns, os.stat(changed).st_mtime_ns + 10 ** 9))
+    gtifs_and_conversion_bool = conv2tif.main(copy.deepcopy(gamma_params))
+    assert [gt for gt, b in gtifs_and_conversion_bool if b] == [gamma_params[cf.INTERFEROGRAM_FILES][0].converted_path]
+
+
 def test_no_tifs_exits(gamma_params):
     with pytest.raises(Exception):
         prepifg.main(gamma_params)
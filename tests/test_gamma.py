@@ -17,6 +17,7 @@
 This Python module contains tests for the gamma.py PyRate module.
 """
 import os
+import pickle
 import shutil
 import tempfile
 import unittest
@@ -25,11 +26,11 @@ from os.path import join
 import pytest
 from pathlib import Path
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 from osgeo import gdal
 
 import pyrate.core.ifgconstants as ifc
-from pyrate.core import shared, config as cf, gamma
+from pyrate.core import shared, config as cf, gamma, prepifg_helper
 from pyrate.core.config import (
     DEM_HEADER_FILE,
     NO_DATA_VALUE,
@@ -39,10 +40,10 @@ from pyrate.core.config import (
     OUT_DIR,
     SLC_DIR)
 from pyrate import prepifg, conv2tif
-from pyrate.core.shared import write_fullres_geotiff, GeotiffException
+from pyrate.core.shared import write_fullres_geotiff, write_fullres_vrt, GeotiffException
 from pyrate.constants import PYRATEPATH
 
-from tests.common import manipulate_test_conf
+from tests.common import manipulate_test_conf, TEST_CONF_GAMMA
 from pyrate.configuration import Configuration
 from tests.common import GAMMA_TEST_DIR
 from tests.common import TEMPDIR
@@ -148,6 +149,35 @@ class GammaToGeoTiffTests(unittest.TestCase):
         wavelen = float(md[ifc.PYRATE_WAVELENGTH_METRES])
         self.assertAlmostEqual(wavelen, 0.05627457792190739)
 
+    def test_to_vrt_ifg(self):
+        self.dest = os.path.join(TEMPDIR, 'tmp_gamma_ifg.vrt')
+        data_path = join(GAMMA_TEST_DIR, '16x20_20090713-20090817_VV_4rlks_utm.unw')
+        write_fullres_vrt(self.COMBINED, data_path, self.dest, nodata=0)
+
+        ds = gdal.Open(self.dest)
+        exp_ds = gdal.Open(join(GAMMA_TEST_DIR, '16x20_20090713-20090817_VV_4rlks_utm.tif'))
+        assert_array_almost_equal(exp_ds.ReadAsArray(), ds.ReadAsArray())
+        self.compare_rasters(ds, exp_ds)
+        self.assertEqual(ds.GetMetadata()[ifc.MASTER_DATE], str(date(2009, 7, 13)))
+
+    def test_to_vrt_dem(self):
+        hdr = gamma.parse_dem_header(join(GAMMA_TEST_DIR, 'dem16x20raw.dem.par'))
+        data_path = join(GAMMA_TEST_DIR, 'dem16x20raw.dem')
+        self.dest = os.path.join(TEMPDIR, 'tmp_gamma_dem.vrt')
+        tif = os.path.join(TEMPDIR, 'tmp_gamma_dem2.tif')
+        write_fullres_vrt(hdr, data_path, self.dest, nodata=0)
+        write_fullres_geotiff(hdr, data_path, tif, nodata=0)
+
+        # same data type and values as the geotiff, i.e. rounded to int16
+        ds = gdal.Open(self.dest)
+        exp_ds = gdal.Open(tif)
+        self.assertEqual(ds.GetRasterBand(1).DataType, gdal.GDT_Int16)
+        assert_array_equal(exp_ds.ReadAsArray(), ds.ReadAsArray())
+        self.compare_rasters(ds, exp_ds)
+        ds, exp_ds = None, None
+        os.remove(tif)
+        os.remove(os.path.join(TEMPDIR, 'tmp_gamma_dem_raw.vrt'))
+
     def test_to_geotiff_wrong_input_data(self):
         # use TIF, not UNW for data
         self.dest = os.path.join(TEMPDIR, 'tmp_gamma_ifg.tif')
@@ -364,5 +394,62 @@ def test_meta_data_exist(series_ifgs, parallel_ifgs):
 
     assert i == 16
 
+
+def _multilooked_outputs(conv2vrt):
+    """conv2tif and prepifg of the gamma test data, multilooked data by file name"""
+    tdir = Path(tempfile.mkdtemp())
+    params = manipulate_test_conf(TEST_CONF_GAMMA, tdir)
+    params[cf.CONV2VRT] = conv2vrt
+    params[cf.PARALLEL] = 0
+    output_conf = tdir.joinpath('conf.conf')
+    cf.write_config_file(params=params, output_conf_file=output_conf)
+    params = Configuration(output_conf).__dict__
+
+    converted = [p for p, _ in conv2tif.main(params)]
+    prepifg.main(params)
+    outputs = {}
+    for p in Path(params[cf.OUT_DIR]).glob('*cr.tif'):
+        ds = gdal.Open(p.as_posix())
+        outputs[p.name] = (ds.GetRasterBand(1).DataType, ds.ReadAsArray(), ds.GetMetadata())
+        ds = None
+    shutil.rmtree(tdir)
+    return converted, outputs
+
+
+def test_prepifg_vrt_same_as_geotiff():
+    tifs, exp = _multilooked_outputs(conv2vrt=0)
+    vrts, outputs = _multilooked_outputs(conv2vrt=1)
+    assert all(p.endswith('.tif') for p in tifs)
+    assert all(p.endswith('.vrt') for p in vrts)
+    # 17 ifgs + dem
+    assert len(outputs) == 18
+    assert sorted(outputs) == sorted(exp)
+    for name, (dtype, data, md) in outputs.items():
+        exp_dtype, exp_data, exp_md = exp[name]
+        assert dtype == exp_dtype
+        assert_array_equal(data, exp_data)
+        assert md == exp_md
+
+
+def test_header_index_same_as_parsed_headers(gamma_params):
+    paths = [p.unwrapped_path for p in gamma_params[cf.INTERFEROGRAM_FILES]] + [gamma_params[cf.DEM_FILE]]
+    expected = [gamma.gamma_header(p, gamma_params) for p in paths]
+    index = prepifg_helper.header_index(gamma_params)
+    # the index is pickled to the workers in the parameters
+    gamma_params[cf.HEADER_INDEX] = pickle.loads(pickle.dumps(index))
+    assert [gamma.gamma_header(p, gamma_params) for p in paths] == expected
+
+
+def test_header_index_duplicate_epoch(gamma_params, tmp_path):
+    headers = list(cf.parse_namelist(gamma_params[cf.HDR_FILE_LIST]))
+    duplicate = tmp_path.joinpath(Path(headers[0]).name)
+    shutil.copy(headers[0], duplicate)
+    hdr_list = tmp_path.joinpath('headers.list')
+    hdr_list.write_text('\n'.join(headers + [duplicate.as_posix()]))
+    gamma_params[cf.HDR_FILE_LIST] = hdr_list.as_posix()
+    with pytest.raises(gamma.GammaException):
+        gamma.HeaderIndex(gamma_params)
+
+
 if __name__ == "__main__":
     unittest.main()
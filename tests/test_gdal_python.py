@@ -22,9 +22,10 @@ import tempfile
 import unittest
 
 import numpy as np
+import pytest
 from osgeo import gdal, gdalconst
 
-from pyrate.core import gdal_python
+from pyrate.core import gdal_python, prepifg_helper, shared
 from tests import common
 
 
@@ -392,5 +393,91 @@ class TestMEMVsGTiff(unittest.TestCase):
         self.check('GTiff')
 
 
+class TestStreamCropResampleAverage(unittest.TestCase):
+
+    def test_same_as_crop_resample_average(self):
+        small_test_ifgs = common.small_data_setup()
+        for looks in [1, 2, 3]:
+            extents = prepifg_helper.get_analysis_extent(prepifg_helper.MAXIMUM_CROP, small_test_ifgs, looks,
+                                                         looks, None)
+            for s in small_test_ifgs:
+                res = [looks * s.x_step, looks * s.y_step] if looks > 1 else [None, None]
+                expected, _ = gdal_python.crop_resample_average(s.data_path, extents, res, '', 0.5,
+                                                                out_driver_type='MEM')
+                temp_tif = tempfile.mktemp(suffix='.tif')
+                gdal_python.stream_crop_resample_average(s.data_path, extents, res, temp_tif, 0.5, band_rows=2)
+                ds = gdal.Open(temp_tif)
+                np.testing.assert_array_almost_equal(ds.GetRasterBand(1).ReadAsArray(), expected, decimal=4)
+                ds = None
+                os.remove(temp_tif)
+
+    def test_output_independent_of_band_rows(self):
+        small_test_ifgs = common.small_data_setup()
+        extents = prepifg_helper.get_analysis_extent(prepifg_helper.MAXIMUM_CROP, small_test_ifgs, 3, 3, None)
+        for s in small_test_ifgs:
+            res = [3 * s.x_step, 3 * s.y_step]
+            for match_pyrate in [False, True]:
+                expected, _ = gdal_python.crop_resample_average(s.data_path, extents, res, '', 0.5, 'MEM',
+                                                                match_pyrate=match_pyrate)
+                for band_rows in [1, 4]:
+                    resampled, _ = gdal_python.crop_resample_average(s.data_path, extents, res, '', 0.5, 'MEM',
+                                                                     match_pyrate=match_pyrate, band_rows=band_rows)
+                    np.testing.assert_array_equal(resampled, expected)
+
+    def test_nan_fraction_average(self):
+        data = np.array([[1, np.nan, 3, 5, np.nan, np.nan],
+                         [1, 1, np.nan, 4, np.nan, 2.]])
+        inside = np.ones(data.shape, dtype=bool)
+        inside[:, 4] = False  # outside the source, not counted as NaN
+        average = gdal_python._nan_fraction_average
+        np.testing.assert_array_equal(average(data, inside, 2, 2, 0.6), [[1, 4, 2]])
+        np.testing.assert_array_equal(average(data, inside, 2, 2, 0.5), [[1, 4, np.nan]])
+        np.testing.assert_array_equal(average(data, inside, 2, 2, 0.25), [[np.nan, np.nan, np.nan]])
+
+
+def _coherence_tif(ifg, path):
+    """Random coherence geotiff on the grid of an interferogram"""
+    src_ds = gdal.Open(ifg.data_path)
+    ds = shared.gdal_dataset(path, src_ds.RasterXSize, src_ds.RasterYSize, crs=src_ds.GetProjection(),
+                             geotransform=src_ds.GetGeoTransform())
+    coherence = np.random.default_rng(0).random((src_ds.RasterYSize, src_ds.RasterXSize))
+    ds.GetRasterBand(1).WriteArray(coherence.astype(np.float32))
+    ds.FlushCache()
+    return path
+
+
+@pytest.mark.parametrize('looks', [2, 3])
+@pytest.mark.parametrize('thresh', [0.25, 0.5, 0.75])
+@pytest.mark.parametrize('coh_mask', [False, True])
+@pytest.mark.parametrize('band_rows', [1, 2, None])
+def test_stream_same_as_crop_resample_average(tmp_path, looks, thresh, coh_mask, band_rows):
+    small_test_ifgs = common.small_data_setup()
+    xmin, ymin, xmax, ymax = prepifg_helper.get_analysis_extent(prepifg_helper.MAXIMUM_CROP, small_test_ifgs,
+                                                                looks, looks, None)
+    for i, s in enumerate(small_test_ifgs[:4]):
+        # extents two multilooked cells past the source on every side
+        dx, dy = 2 * looks * s.x_step, 2 * looks * s.y_step  # y_step < 0
+        extents = (xmin - dx, ymin + dy, xmax + dx, ymax - dy)
+        res = [looks * s.x_step, looks * s.y_step]
+        coherence_path = _coherence_tif(s, str(tmp_path / f'coherence_{i}.tif')) if coh_mask else None
+        coherence_thresh = 0.3 if coh_mask else None
+
+        expected, exp_ds = gdal_python.crop_resample_average(
+            s.data_path, extents, res, '', thresh, out_driver_type='MEM', coherence_path=coherence_path,
+            coherence_thresh=coherence_thresh)
+        out_tif = str(tmp_path / f'stream_{i}.tif')
+        gdal_python.stream_crop_resample_average(
+            s.data_path, extents, res, out_tif, thresh, coherence_path=coherence_path,
+            coherence_thresh=coherence_thresh, band_rows=band_rows)
+        ds = gdal.Open(out_tif)
+        np.testing.assert_array_equal(ds.GetRasterBand(1).ReadAsArray(), expected)
+        np.testing.assert_array_almost_equal(ds.GetGeoTransform(), exp_ds.GetGeoTransform())
+        assert ds.GetMetadata() == exp_ds.GetMetadata()
+        # the cells past the source are NaN, and some cells inside are not
+        assert np.isnan(expected[:2]).all() and np.isnan(expected[:, :2]).all()
+        assert not np.isnan(expected).all()
+        ds = None
+
+
 if __name__ == '__main__':
     unittest.main()
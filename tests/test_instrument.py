@@ -0,0 +1,152 @@
+#   This Python module is part of the PyRate software package.
+#
+#   Copyright 2020 Geoscience Australia
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+This Python module contains tests for the instrument.py PyRate module.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from pyrate.core import instrument, mpiops, stack
+from pyrate.core.logger import pyratelogger
+
+
+class InstrumentTests(unittest.TestCase):
+
+    def setUp(self):
+        instrument.reset()
+
+    def tearDown(self):
+        instrument.reset()
+        instrument.enable_counters(False)
+
+    def test_nested_stages(self):
+        @instrument.timed('inner')
+        def inner(n):
+            instrument.add_pixels(n)
+            return np.ones(n).sum()
+
+        with instrument.stage('outer'):
+            self.assertEqual(inner(10), 10)
+            inner(5)
+        rep = instrument.report()
+        if mpiops.rank != 0:
+            return
+        self.assertEqual(list(rep), ['outer/inner', 'outer'])
+        summary = rep['outer/inner']['summary']
+        self.assertEqual(summary['pixels'], 15 * mpiops.size)
+        self.assertEqual(summary['processes'], mpiops.size)
+        record = rep['outer/inner']['processes'][0]
+        self.assertEqual(record['calls'], 2)
+        self.assertGreaterEqual(rep['outer']['processes'][0]['wall'], record['wall'])
+        self.assertGreater(record['peak_rss'], 0)
+        self.assertIsNone(rep['outer']['summary']['pixels'])
+
+    @unittest.skipUnless(instrument._reset_rss_high_water_mark(), 'peak RSS cannot be reset')
+    def test_peak_rss_per_stage(self):
+        size = 200 * 2 ** 20
+        with instrument.stage('outer'):
+            with instrument.stage('heavy'):
+                a = np.ones(size // 8)
+                del a
+            with instrument.stage('light'):
+                np.ones(10).sum()
+        rep = instrument.report()
+        if mpiops.rank != 0:
+            return
+        heavy, light, outer = [rep[n]['processes'][0] for n in ['outer/heavy', 'outer/light', 'outer']]
+        self.assertGreater(heavy['peak_rss'] - light['peak_rss'], size // 2)
+        # the enclosing stage includes the peaks of its nested stages
+        self.assertGreaterEqual(outer['peak_rss'], heavy['peak_rss'])
+        self.assertGreater(light['process_peak_rss'], 0)
+
+    def test_stage_recorded_on_error(self):
+        with self.assertRaises(ValueError):
+            with instrument.stage('failing'):
+                raise ValueError
+        rep = instrument.report()
+        if mpiops.rank == 0:
+            self.assertEqual(rep['failing']['processes'][0]['calls'], 1)
+
+    def test_write_report(self):
+        outdir = mpiops.run_once(tempfile.mkdtemp)
+        handler = logging.FileHandler(os.path.join(outdir, 'pyrate.log.process'))
+        pyratelogger.addHandler(handler)
+        try:
+            with instrument.stage('process'):
+                instrument.add_pixels(3)
+            path = instrument.write_report('process')
+        finally:
+            pyratelogger.removeHandler(handler)
+            handler.close()
+        if mpiops.rank == 0:
+            # written next to the log, with a portable file name
+            self.assertEqual(os.path.dirname(path), outdir)
+            self.assertNotIn(':', os.path.basename(path))
+            with open(path) as f:
+                rep = json.load(f)
+            self.assertEqual(rep['command'], 'process')
+            self.assertEqual(rep['stages']['process']['summary']['pixels'], 3 * mpiops.size)
+            shutil.rmtree(outdir)
+
+    def test_kernel_counters(self):
+        nifgs = 5
+        mst = np.ones((nifgs, 1, 3), dtype=bool)
+        mst[:, 0, 2] = False  # too few observations
+        mst[0, 0, 1] = False
+        obs = np.arange(nifgs * 3, dtype=np.float64).reshape(nifgs, 1, 3)
+        span = np.ones((1, nifgs))
+        vcmt = np.eye(nifgs)
+
+        def run():
+            for col in range(3):
+                stack._stack_rate_by_pixel(0, col, mst, 2, obs, 3, span, vcmt)
+
+        run()  # not counting
+        with instrument.tile_counters(0):
+            self.assertIsNone(instrument.counters())
+            run()
+        instrument.enable_counters()
+        with instrument.stage('stack'):
+            for index in [1, 2, 1]:
+                with instrument.tile_counters(index):
+                    run()
+            self.assertIsNone(instrument.counters())
+        rep = instrument.report()
+        if mpiops.rank != 0:
+            return
+        tile = rep['stack']['tiles'][1]
+        self.assertEqual(tile['stack.pixels'], 6)
+        self.assertEqual(tile['stack.skipped'], 2)
+        self.assertEqual(tile['stack.patterns'], 3)
+        self.assertEqual(rep['stack']['summary']['counters']['stack.pixels'], 9 * mpiops.size)
+        # the same patterns in both tiles and all processes
+        self.assertEqual(rep['stack']['tiles'][2]['stack.patterns'], 3)
+        self.assertEqual(rep['stack']['summary']['counters']['stack.patterns'], 3)
+
+    def test_distinct_patterns_fixed_memory(self):
+        counters = instrument.KernelCounters()
+        patterns = np.random.default_rng(0).integers(0, 2, size=(20000, 40)).astype(bool)
+        for p in np.concatenate([patterns, patterns[:5000]]):
+            counters.pattern('patterns', p)
+        self.assertEqual(counters.patterns['patterns'].nbytes, instrument.PATTERN_REGISTERS)
+        distinct = len({p.tobytes() for p in patterns})
+        self.assertAlmostEqual(counters.result()['patterns'] / distinct, 1, delta=0.05)
@@ -59,3 +59,35 @@ def test_vcm_legacy_vs_mpi(mpisync, tempdir, roipac_or_gamma_conf):
     np.testing.assert_array_almost_equal(maxvar, legacy_maxvar, decimal=4)
     np.testing.assert_array_almost_equal(legacy_vcm, vcmt, decimal=3)
     mpiops.run_once(shutil.rmtree, tmpdir)
+
+
+def test_mask_or(mpisync):
+    shape = (7, 13)
+    mask = np.zeros(shape, dtype=bool)
+    mask.flat[mpiops.rank::mpiops.size + 3] = True
+    res = mpiops.mask_or(mask)
+    exp = np.zeros(shape, dtype=bool)
+    for r in range(mpiops.size):
+        exp.flat[r::mpiops.size + 3] = True
+    np.testing.assert_array_equal(res, exp)
+
+
+def test_dynamic_split(mpisync):
+    items = list(range(23))
+    costs = [i % 5 for i in items]
+    counter = mpiops.SharedCounter()
+    mine = list(mpiops.dynamic_split(items, costs, counter))
+    counter.free()
+    done = sorted(i for r in mpiops.comm.allgather(mine) for i in r)
+    assert done == items
+    # each process receives its elements in order of decreasing cost
+    assert [costs[i] for i in mine] == sorted([costs[i] for i in mine], reverse=True)
+
+
+def test_dynamic_split_stopped_early(mpisync):
+    # the counter is freed by all processes, also if one stops iterating
+    counter = mpiops.SharedCounter()
+    for _ in mpiops.dynamic_split(range(10), None, counter):
+        if mpiops.rank == 0:
+            break
+    counter.free()
@@ -17,6 +17,8 @@
 This module contains tests for the mst.py PyRate module.
 """
 
+import shutil
+import tempfile
 import unittest
 from itertools import product
 from numpy import empty, array, nan, isnan, sum as nsum
@@ -25,7 +27,7 @@ import numpy as np
 from tests.common import MockIfg, small5_mock_ifgs, small_data_setup
 
 from pyrate.core import algorithm, config as cf, mst
-from pyrate.core.shared import IfgPart, Tile
+from pyrate.core.shared import IfgPart, Tile, PrereadIfg, save_numpy_phase
 from tests import common
 
 
@@ -189,6 +191,36 @@ class IfgPartTest(unittest.TestCase):
             self.assertEqual(ifg_part.phase_data.shape, (r_end-r_start, i.phase_data.shape[1]))
             np.testing.assert_array_equal(ifg_part.phase_data, i.phase_data[r_start:r_end, :])
 
+    def test_ifg_part_nan_fraction_read_when_required(self):
+        tile = Tile(0, top_left=(0, 0), bottom_right=(10, 20))
+        for i in self.ifgs:
+            ifg_part = IfgPart(i.data_path, tile, params=self.params)
+            self.assertIsNone(ifg_part._nan_fraction)
+            i.nodata_value = 0
+            self.assertEqual(ifg_part.nan_fraction, i.nan_fraction)
+
+    def test_header_does_not_modify_ifg(self):
+        for i in self.ifgs:
+            i.nodata_value = None
+            header = mst._header(i)
+            self.assertIsNone(i.nodata_value)
+            i.nodata_value = 0
+            self.assertEqual(header.nan_fraction, i.nan_fraction)
+
+    def test_ifg_part_from_phase_stack(self):
+        self.params[cf.TMPDIR] = tempfile.mkdtemp()
+        paths = [i.data_path for i in self.ifgs]
+        save_numpy_phase(paths, self.params)
+        preread_ifgs = {p: PrereadIfg(p, 0.0, i.master, i.slave, i.time_span, i.nrows, i.ncols,
+                                      i.meta_data, index=n)
+                        for n, (p, i) in enumerate(zip(paths, self.ifgs))}
+        tile = Tile(1, top_left=(3, 4), bottom_right=(10, 20))
+        for p, i in zip(paths, self.ifgs):
+            ifg_part = IfgPart(p, tile, preread_ifgs, self.params)
+            self.assertEqual(ifg_part.phase_data.shape, (7, 16))
+            np.testing.assert_array_equal(ifg_part.phase_data, i.phase_data[3:10, 4:20])
+        shutil.rmtree(self.params[cf.TMPDIR])
+
     def test_mst_multiprocessing_serial(self):
         self.params[cf.PARALLEL] = False
         original_mst = mst.mst_boolean_array(self.ifgs)
@@ -16,11 +16,14 @@
 """
 This Python module contains tests for the prepifg.py PyRate module.
 """
+import copy
+import glob
 import os
 import shutil
 import sys
 import tempfile
 import unittest
+import pytest
 from math import floor
 from os.path import exists, join
 
@@ -421,6 +424,24 @@ class ThresholdTests(unittest.TestCase):
             res = _resample(data, xscale=3, yscale=3, thresh=thresh)
             assert_array_equal(res, reshape(exp, res.shape))
 
+    @staticmethod
+    def test_resample_matches_block_nanmean():
+        # partial blocks at the edges are dropped
+        rng = np.random.RandomState(0)
+        data = rng.normal(size=(23, 17)).astype(np.float32)
+        data[rng.random_sample(data.shape) < 0.3] = nan
+        for thresh in [0, 0.3, 1]:
+            exp = np.full((7, 4), nan, dtype=np.float32)
+            for y in range(7):
+                for x in range(4):
+                    block = data[y * 3: (y + 1) * 3, x * 4: (x + 1) * 4]
+                    frac = npsum(isnan(block)) / 12.0
+                    if frac < thresh or (frac == 0 and thresh == 0):
+                        exp[y, x] = nanmean(block)
+            for band_rows in [None, 1, 3]:
+                res = _resample(data, xscale=4, yscale=3, thresh=thresh, band_rows=band_rows)
+                assert_array_almost_equal(res, exp, decimal=6)
+
 
 class SameSizeTests(unittest.TestCase):
     """Tests aspects of the prepifg.py script, such as resampling."""
@@ -717,3 +738,36 @@ class TestOneIncidenceOrElevationMap(unittest.TestCase):
 
 if __name__ == "__main__":
     unittest.main()
+
+
+def _mlooked_mtimes(params):
+    mlooked = glob.glob(os.path.join(params[cf.OUT_DIR], '*cr.tif'))
+    return {p: os.stat(p).st_mtime_ns for p in mlooked}
+
+
+@pytest.mark.parametrize('largetifs', [0, 1])
+def test_prepifg_not_recomputed(gamma_params, largetifs):
+    gamma_params[cf.LARGE_TIFS] = largetifs
+    conv2tif.main(copy.deepcopy(gamma_params))
+    prepifg.main(copy.deepcopy(gamma_params))
+    mtimes = _mlooked_mtimes(gamma_params)
+    assert len(mtimes) == 18  # 17 ifgs + dem
+    prepifg.main(copy.deepcopy(gamma_params))
+    assert _mlooked_mtimes(gamma_params) == mtimes
+    gamma_params[cf.NO_DATA_AVERAGING_THRESHOLD] = 0.75
+    prepifg.main(copy.deepcopy(gamma_params))
+    assert all(t != mtimes[p] for p, t in _mlooked_mtimes(gamma_params).items())
+
+
+def test_prepifg_recomputed_when_coherence_changes(gamma_params):
+    gamma_params[cf.COH_MASK] = 1
+    conv2tif.main(copy.deepcopy(gamma_params))
+    prepifg.main(copy.deepcopy(gamma_params))
+    mtimes = _mlooked_mtimes(gamma_params)
+
+    ifg = gamma_params[cf.INTERFEROGRAM_FILES][0]
+    coh = cf.coherence_paths_for(ifg.converted_path, gamma_params, tif=True)
+    os.utime(coh, ns=(os.stat(coh).st_atime_ns, os.stat(coh).st_mtime_ns + 10 ** 9))
+    prepifg.main(copy.deepcopy(gamma_params))
+    recomputed = [p for p, t in _mlooked_mtimes(gamma_params).items() if t != mtimes[p]]
+    assert recomputed == [ifg.sampled_path]
@@ -26,7 +26,7 @@ from os.path import join
 import numpy as np
 
 import pyrate.core.shared
-from pyrate.core import shared, config as cf, config, prepifg_helper, mst
+from pyrate.core import shared, config as cf, config, prepifg_helper, mst, ifgconstants as ifc
 from pyrate import process, prepifg, conv2tif
 from pyrate.configuration import MultiplePaths
 from tests import common
@@ -184,6 +184,46 @@ class PyRateTests(unittest.TestCase):
             self.key_check(i, key, value)
 
 
+class PhaseStoreTests(unittest.TestCase):
+    # the phase data store used by the time series and stacking must hold
+    # the nan and millimetre converted phase, also without orbital fit
+
+    @classmethod
+    def setUpClass(cls):
+        cls.BASE_DIR = tempfile.mkdtemp()
+        cls.BASE_OUT_DIR = join(cls.BASE_DIR, 'out')
+        os.makedirs(cls.BASE_OUT_DIR)
+        for path in glob.glob(join(common.SML_TEST_TIF, '*')):
+            dest = join(cls.BASE_OUT_DIR, os.path.basename(path))
+            shutil.copy(path, dest)
+            os.chmod(dest, 0o660)
+        params = config.get_config_params(common.TEST_CONF_ROIPAC, validate=False)
+        params[cf.OUT_DIR] = cls.BASE_OUT_DIR
+        params[cf.TMPDIR] = join(cls.BASE_OUT_DIR, 'tmpdir')
+        params[cf.PROCESSOR] = 0  # roipac
+        params[cf.APS_CORRECTION] = 0
+        params[cf.ORBITAL_FIT] = 0
+        params[cf.REF_EST_METHOD] = 1
+        params[cf.PARALLEL] = False
+        cls.params = params
+        cls.paths = sorted(glob.glob(join(cls.BASE_OUT_DIR, 'geo_*-*.tif')))
+        process.process_ifgs(cls.paths, params, 2, 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.BASE_DIR, ignore_errors=True)
+
+    def test_phase_store_millimetres(self):
+        stack = shared.open_phase_stack(self.params)
+        for n, p in enumerate(self.paths):
+            ifg = shared.Ifg(p)
+            ifg.open(readonly=True)
+            self.assertEqual(ifg.dataset.GetMetadataItem(ifc.DATA_UNITS), shared.MILLIMETRES)
+            self.assertEqual(ifg.dataset.GetMetadataItem(ifc.NAN_STATUS), ifc.NAN_CONVERTED)
+            np.testing.assert_array_equal(stack[n], ifg.phase_data)
+            ifg.close()
+
+
 class ParallelPyRateTests(unittest.TestCase):
     """
     parallel vs serial pyrate tests verifying results from all steps equal
@@ -20,10 +20,14 @@ import copy
 import unittest
 import tempfile
 import shutil
+import numpy as np
 from numpy import nan, mean, std, isnan
+from numpy.testing import assert_array_almost_equal
 
 from pyrate.core import config as cf
-from pyrate.core.refpixel import ref_pixel, _step
+from pyrate.core.refpixel import ref_pixel, _step, ref_pixel_setup, \
+    ref_pixel_mean_sds, _ref_pixel_multi, ref_pixel_coarse_to_fine
+from pyrate.core.shared import Ifg
 from pyrate import process
 from tests.common import TEST_CONF_ROIPAC
 from tests.common import small_data_setup, MockIfg, small_ifg_file_list
@@ -220,6 +224,53 @@ def _expected_ref_pixel(ifgs, cs):
     mn = [ulm, urm, llm, lrm]
 
 
+class RefPixelMeanSdsTest(unittest.TestCase):
+    """
+    Verifies the integral image statistics against the chip by chip search
+    """
+
+    def setUp(self):
+        self.ifg_paths = small_ifg_file_list()
+        self.params = cf.get_config_params(TEST_CONF_ROIPAC)
+        self.params[cf.REFNX] = REFNX
+        self.params[cf.REFNY] = REFNY
+
+    def _phase_data(self):
+        phase_data = []
+        for p in self.ifg_paths:
+            ifg = Ifg(p)
+            ifg.open(readonly=True)
+            ifg.nodata_value = self.params[cf.NO_DATA_VALUE]
+            ifg.convert_to_nans()
+            ifg.convert_to_mm()
+            phase_data.append(ifg.phase_data)
+            ifg.close()
+        return phase_data
+
+    def test_mean_sds_equal_chip_by_chip(self):
+        for chipsize, min_frac in [(3, 0.7), (5, 0.8), (15, 0.5)]:
+            self.params[cf.REF_CHIP_SIZE] = chipsize
+            self.params[cf.REF_MIN_FRAC] = min_frac
+            half_patch_size, thresh, grid = ref_pixel_setup(self.ifg_paths, self.params)
+            phase_data = self._phase_data()
+            exp = [_ref_pixel_multi(g, half_patch_size, phase_data, thresh, self.params)
+                   for g in grid]
+            res = ref_pixel_mean_sds(self.ifg_paths, grid, half_patch_size, thresh, self.params)
+            assert_array_almost_equal(exp, res, decimal=3)
+
+    def test_coarse_to_fine_not_worse_than_grid(self):
+        self.params[cf.REF_CHIP_SIZE] = 5
+        self.params[cf.REF_MIN_FRAC] = 0.7
+        half_patch_size, thresh, grid = ref_pixel_setup(self.ifg_paths, self.params)
+        grid_best = np.nanmin(ref_pixel_mean_sds(self.ifg_paths, grid, half_patch_size, thresh, self.params))
+        phase_data = self._phase_data()
+        for looks in [2, 4]:
+            self.params[cf.REF_SEARCH_LOOKS] = looks
+            refpx = ref_pixel_coarse_to_fine(self.ifg_paths, self.params)
+            res = _ref_pixel_multi(refpx, half_patch_size, phase_data, thresh, self.params)
+            self.assertLessEqual(res, grid_best + 1e-6)
+
+
 class LegacyEqualityTest(unittest.TestCase):
 
     def setUp(self):
@@ -18,6 +18,7 @@ This Python module contains tests for the roipac.py PyRate module.
 """
 
 import os
+import pickle
 import shutil
 import sys
 import tempfile
@@ -29,7 +30,7 @@ from numpy.testing import assert_array_almost_equal
 from osgeo import gdal
 
 import pyrate.core.ifgconstants as ifc
-from pyrate.core import shared, roipac
+from pyrate.core import shared, roipac, prepifg_helper, config as cf
 from pyrate.core.config import (
     INPUT_IFG_PROJECTION,
     NO_DATA_VALUE,
@@ -41,7 +42,7 @@ from pyrate.core.config import (
 )
 # from pyrate.scripts.conv2tif import main as roipacMain
 from pyrate.core.shared import GeotiffException
-from pyrate.core.shared import write_fullres_geotiff
+from pyrate.core.shared import write_fullres_geotiff, write_fullres_vrt
 from tests.common import HEADERS_TEST_DIR, PREP_TEST_OBS, PREP_TEST_TIF
 from tests.common import SML_TEST_DEM_DIR, SML_TEST_OBS, TEMPDIR
 from tests.common import SML_TEST_DEM_ROIPAC, SML_TEST_DEM_HDR
@@ -149,6 +150,22 @@ class RoipacToGeoTiffTests(unittest.TestCase):
         wavelen = float(md[ifc.PYRATE_WAVELENGTH_METRES])
         self.assertAlmostEqual(wavelen, 0.0562356424)
 
+    def test_to_vrt_ifg(self):
+        hdrs = self.HDRS.copy()
+        hdrs[ifc.PYRATE_DATUM] = 'WGS84'
+        hdrs[ifc.DATA_TYPE] = ifc.ORIG
+
+        self.dest = os.path.join(TEMPDIR, 'tmp_roipac_ifg.vrt')
+        write_fullres_vrt(hdrs, join(PREP_TEST_OBS, 'geo_060619-061002.unw'), self.dest, nodata=0)
+
+        ds = gdal.Open(self.dest)
+        self.assertEqual(ds.RasterCount, 1)
+        exp_ds = gdal.Open(join(PREP_TEST_TIF, 'geo_060619-061002.tif'))
+        # the phase band of the interleaved raw file is read in place
+        assert_array_almost_equal(exp_ds.GetRasterBand(1).ReadAsArray(), ds.GetRasterBand(1).ReadAsArray())
+        self.compare_rasters(ds, exp_ds)
+        self.assertEqual(ds.GetMetadata()[ifc.MASTER_DATE], str(date(2006, 6, 19)))
+
     def test_to_geotiff_wrong_input_data(self):
         # ensure failure if TIF/other file used instead of binary UNW data
         self.dest = os.path.join(TEMPDIR, 'tmp_roipac_ifg.tif')
@@ -258,5 +275,16 @@ class HeaderParsingTests(unittest.TestCase):
         self.assertAlmostEqual(hdrs[roipac.X_LAST], 151.8519444445)
         self.assertAlmostEqual(hdrs[roipac.Y_LAST], -34.625)
 
+
+def test_header_index_same_as_parsed_headers(roipac_params):
+    paths = [p.unwrapped_path for p in roipac_params[cf.INTERFEROGRAM_FILES]] + \
+        [p.converted_path for p in roipac_params[cf.INTERFEROGRAM_FILES]] + [roipac_params[cf.DEM_FILE]]
+    expected = [roipac.roipac_header(p, roipac_params) for p in paths]
+    index = prepifg_helper.header_index(roipac_params)
+    # the index is pickled to the workers in the parameters
+    roipac_params[cf.HEADER_INDEX] = pickle.loads(pickle.dumps(index))
+    assert [roipac.roipac_header(p, roipac_params) for p in paths] == expected
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -23,6 +23,7 @@ import sys
 import tempfile
 import unittest
 from itertools import product
+from unittest import mock
 from numpy import isnan, where, nan
 from os.path import join, basename, exists
 from stat import S_IRGRP, S_IWGRP, S_IWOTH, S_IROTH, S_IRUSR, S_IWUSR
@@ -33,7 +34,7 @@ from osgeo import gdal
 from osgeo.gdal import Open, Dataset, UseExceptions
 
 from tests.common import SML_TEST_TIF, SML_TEST_DEM_TIF, TEMPDIR
-from pyrate.core import shared, ifgconstants as ifc, config as cf, prepifg_helper, gamma
+from pyrate.core import shared, ifgconstants as ifc, config as cf, prepifg_helper, gamma, mpiops
 from pyrate import prepifg, conv2tif
 from pyrate.configuration import Configuration, MultiplePaths
 from pyrate.core.shared import Ifg, DEM, RasterException
@@ -511,5 +512,192 @@ class GeodesyTests(unittest.TestCase):
                 self.assertTrue(s < exp_high, msg="size=%s" % s)
 
 
+class TileTests(unittest.TestCase):
+
+    def test_create_tiles_cover_shape(self):
+        for block_shape in [None, (8, 8), (1, 47), (16, 5)]:
+            tiles = shared.create_tiles((72, 47), nrows=3, ncols=2, block_shape=block_shape)
+            covered = np.zeros((72, 47), dtype=int)
+            for t in tiles:
+                covered[t.top_left_y:t.bottom_right_y, t.top_left_x:t.bottom_right_x] += 1
+            assert_array_equal(covered, 1)
+
+    def test_create_tiles_block_aligned(self):
+        tiles = shared.create_tiles((72, 47), nrows=3, ncols=2, block_shape=(16, 47))
+        self.assertEqual(sorted({t.top_left_y for t in tiles}), [0, 16, 48])
+        self.assertEqual(sorted({t.top_left_x for t in tiles}), [0, 24])
+
+    def test_create_tiles_unaligned_when_blocks_too_large(self):
+        exp = shared.create_tiles((10, 10), nrows=3, ncols=3)
+        res = shared.create_tiles((10, 10), nrows=3, ncols=3, block_shape=(8, 8))
+        self.assertEqual([(t.top_left, t.bottom_right) for t in exp],
+                         [(t.top_left, t.bottom_right) for t in res])
+
+    def test_auto_tile_layout_within_budget(self):
+        nifgs = 17
+        footprint = max(shared.tile_footprints(nifgs).values())
+        for shape, block_shape in [((100, 200), None), ((100, 200), (1, 200)), ((96, 200), (16, 16)),
+                                   ((1000, 1000), (256, 256))]:
+            for budget in [2 ** 18, 2 ** 20, 2 ** 22, 2 ** 26]:
+                rows, cols = shared.auto_tile_layout(shape, nifgs, budget, block_shape)
+                tiles = shared.create_tiles(shape, rows, cols, block_shape)
+                largest = max((t.bottom_right_y - t.top_left_y) * (t.bottom_right_x - t.top_left_x)
+                              for t in tiles)
+                self.assertLessEqual(largest * footprint + 8 * nifgs ** 2, budget)
+
+    def test_auto_tile_layout_striped(self):
+        rows, cols = shared.auto_tile_layout((100, 200), 17, 2 ** 20, (1, 200))
+        self.assertGreater(rows, 1)
+        self.assertEqual(cols, 1)
+
+    def test_auto_tile_layout_min_tiles(self):
+        self.assertEqual(shared.auto_tile_layout((100, 200), 17, 2 ** 30), (1, 1))
+        rows, cols = shared.auto_tile_layout((100, 200), 17, 2 ** 30, min_tiles=16)
+        self.assertGreaterEqual(rows * cols, 16)
+        self.assertEqual(shared.auto_tile_layout((3, 2), 17, 2 ** 30, min_tiles=16), (3, 2))
+
+    def test_tile_layout_independent_of_processes(self):
+        ifg_paths = [i.data_path for i in common.small_data_setup()]
+        params = {cf.TILE_MEMORY: 1, cf.TMPDIR: tempfile.mkdtemp()}
+        with mock.patch.object(mpiops, 'size', 1):
+            layout = shared.tile_layout(ifg_paths, params)
+        # a rerun or merge with more processes uses the same tiles
+        with mock.patch.object(mpiops, 'size', 4):
+            self.assertEqual(shared.tile_layout(ifg_paths, params), layout)
+            # unlike a new run with more processes
+            params[cf.TMPDIR] = tempfile.mkdtemp()
+            self.assertNotEqual(shared.tile_layout(ifg_paths, params), layout)
+
+    def test_read_phase_window(self):
+        ifg = Ifg(join(SML_TEST_TIF, 'geo_060619-061002_unw.tif'))
+        ifg.open(readonly=True)
+        window = ifg.read_phase_window(3, 10, 4, 20)
+        assert_array_equal(window, ifg.phase_data[3:10, 4:20])
+        ifg.close()
+
+
+class PhaseStackTests(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {cf.TMPDIR: tempfile.mkdtemp()}
+        self.ifg_paths = common.small_ifg_file_list()[:4]
+
+    def tearDown(self):
+        shutil.rmtree(self.params[cf.TMPDIR])
+
+    def _preread(self):
+        preread_ifgs = {}
+        for n, p in enumerate(self.ifg_paths):
+            ifg = Ifg(p)
+            ifg.open(readonly=True)
+            preread_ifgs[p] = shared.PrereadIfg(p, 0.0, ifg.master, ifg.slave, ifg.time_span, ifg.nrows,
+                                                ifg.ncols, ifg.meta_data, index=n,
+                                                signature=shared.ifg_signature(ifg))
+            ifg.close()
+        return preread_ifgs
+
+    def test_save_numpy_phase(self):
+        shared.save_numpy_phase(self.ifg_paths, self.params)
+        stack = shared.open_phase_stack(self.params)
+        for n, p in enumerate(self.ifg_paths):
+            ifg = Ifg(p)
+            ifg.open(readonly=True)
+            assert_array_equal(stack[n], ifg.phase_data)
+            ifg.close()
+
+    def test_save_numpy_phase_skips_unchanged(self):
+        shared.save_numpy_phase(self.ifg_paths, self.params)
+        stack = np.load(shared.phase_stack_path(self.params), mmap_mode='r+')
+        stack[:] = 1
+        stack.flush()
+        del stack
+        shared.save_numpy_phase(self.ifg_paths, self.params, self._preread())
+        assert_array_equal(shared.open_phase_stack(self.params), 1)
+
+
+class CorrectionSessionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {cf.TMPDIR: tempfile.mkdtemp()}
+        self.ifg_paths = []
+        for p in common.small_ifg_file_list()[:3]:
+            dest = join(self.params[cf.TMPDIR], os.path.basename(p))
+            shutil.copy(p, dest)
+            self.ifg_paths.append(dest)
+
+    def tearDown(self):
+        shutil.rmtree(self.params[cf.TMPDIR])
+
+    def _modify(self, path, value):
+        ifg = Ifg(path)
+        ifg.open(readonly=False)
+        ifg.phase_data[:] = value
+        ifg.meta_data[ifc.PYRATE_ORBITAL_ERROR] = ifc.ORB_REMOVED
+        ifg.write_modified_phase()
+        ifg.close()
+
+    def _read(self, path):
+        ifg = Ifg(path)
+        ifg.open(readonly=True)
+        data, md = ifg.phase_data, ifg.meta_data
+        ifg.close()
+        return data, md
+
+    def test_writes_deferred_until_flush(self):
+        orig, other = [self._read(p)[0] for p in self.ifg_paths[:2]]
+        with shared.correction_session(self.ifg_paths, self.params) as session:
+            self._modify(self.ifg_paths[0], 3.0)
+            data, md = self._read(self.ifg_paths[0])
+            assert_array_equal(data, 3.0)
+            self.assertEqual(md[ifc.PYRATE_ORBITAL_ERROR], ifc.ORB_REMOVED)
+            ds = gdal.Open(self.ifg_paths[0])
+            assert_array_equal(ds.GetRasterBand(1).ReadAsArray(), orig)
+            self.assertIsNone(ds.GetMetadataItem(ifc.PYRATE_ORBITAL_ERROR))
+            ds = None
+        data, md = self._read(self.ifg_paths[0])
+        assert_array_equal(data, 3.0)
+        self.assertEqual(md[ifc.PYRATE_ORBITAL_ERROR], ifc.ORB_REMOVED)
+        assert_array_equal(self._read(self.ifg_paths[1])[0], other)
+        # the buffer is removed once flushed
+        self.assertFalse(exists(session.path))
+
+    def test_no_write_on_error(self):
+        orig = self._read(self.ifg_paths[0])[0]
+        with self.assertRaises(ValueError):
+            with shared.correction_session(self.ifg_paths, self.params):
+                self._modify(self.ifg_paths[0], 3.0)
+                raise ValueError
+        data, md = self._read(self.ifg_paths[0])
+        assert_array_equal(data, orig)
+        self.assertNotIn(ifc.PYRATE_ORBITAL_ERROR, md)
+
+
+class NanMedianTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(10)
+
+    def test_nanmedian_equals_numpy(self):
+        for n in [1, 2, 3, 10, 11, 10000, 10001]:
+            x = self.rng.normal(size=n).astype(np.float32)
+            x[1::4] = nan
+            self.assertAlmostEqual(shared.nanmedian(x), np.nanmedian(x), places=6)
+
+    def test_nanmedian_2d(self):
+        x = self.rng.normal(size=(50, 41))
+        x[:10, :] = nan
+        self.assertAlmostEqual(shared.nanmedian(x), np.nanmedian(x))
+
+    def test_nanmedian_all_nan(self):
+        self.assertTrue(isnan(shared.nanmedian(np.array([nan, nan]))))
+
+    def test_nanmedian_approximate_error_bound(self):
+        x = self.rng.normal(size=100001) * 10
+        x[::7] = nan
+        for bins in [16, 256, 4096]:
+            bound = (np.nanmax(x) - np.nanmin(x)) / (2 * bins)
+            self.assertLessEqual(abs(shared.nanmedian(x, bins=bins) - np.nanmedian(x)), bound)
+
+
 if __name__ == "__main__":
     unittest.main()
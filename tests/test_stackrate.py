@@ -24,7 +24,7 @@ import unittest
 
 from numpy import eye, array, ones
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 
 import pyrate.core.orbital
 import tests.common
@@ -72,6 +72,24 @@ class StackRateTests(unittest.TestCase):
         assert_array_almost_equal(error, experr)
         assert_array_almost_equal(samples, expsamp)
 
+    def test_stack_rate_with_obs(self):
+        # observations passed in give the same result as the ifg phase data
+        vcmt = eye(6, 6)
+        mst = ones((6, 1, 1))
+        mst[4] = 0
+        params = default_params()
+        self.ifgs[3].phase_data = array([[np.nan]])
+        exp = stack_rate(self.ifgs, params, vcmt, mst.copy())
+        obs = array([i.phase_data for i in self.ifgs])
+        for i in self.ifgs:
+            i.phase_data = None
+        res = stack_rate(self.ifgs, params, vcmt, mst, obs=obs)
+        for r, e in zip(res, exp):
+            assert_array_almost_equal(r, e)
+        # nans of obs are set to zero, the mst is not modified
+        self.assertEqual(obs[3, 0, 0], 0)
+        assert_array_equal(mst, [[[1]], [[1]], [[1]], [[1]], [[0]], [[1]]])
+
 
 class LegacyEqualityTest(unittest.TestCase):
     """
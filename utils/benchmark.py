@@ -0,0 +1,436 @@
+# This Python module is part of the PyRate software package
+#
+# Copyright 2020 Geoscience Australia
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+End-to-end benchmark of the PyRate workflow on synthetic interferograms.
+
+A synthetic GAMMA (or GeoTIFF) interferogram network of configurable size is
+generated with a known deformation signal, orbital ramps, noise and missing
+data. The conv2tif, prepifg, process and merge steps are then run in serial,
+multiprocess (joblib) or MPI mode and the wall time of each step, with the
+stage timings of the PyRate run reports, is written as JSON. Results can be
+compared against a stored baseline.
+
+example usage:
+python utils/benchmark.py generate -d bench/medium --rows 1000 --cols 800 --epochs 30 --ifgs 60
+python utils/benchmark.py run -d bench/medium --mode mpi -n 4 -o results.json --baseline baseline.json
+python utils/benchmark.py scaling -d bench --scaling weak --mode mpi -n 1 2 4 8 -o weak.json
+python utils/benchmark.py compare results.json baseline.json
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+from os.path import join, abspath, getmtime
+
+import numpy as np
+
+STEPS = ['conv2tif', 'prepifg', 'process', 'merge']
+MODES = ['serial', 'multiprocess', 'mpi']
+RADAR_FREQUENCY = 5.331004416e+09  # Hz, C-band
+SPEED_OF_LIGHT = 299792458.0  # m/s
+EPOCH_INTERVAL = 24  # days
+CORNER_LAT, CORNER_LON, POST = -34.17, 150.91, 8.33333e-04  # decimal degrees
+
+CONFIG = OrderedDict([
+    ('processor', 1),
+    ('noDataAveragingThreshold', 0.5),
+    ('noDataValue', 0.0),
+    ('nan_conversion', 1),
+    ('ifgcropopt', 1), ('ifglksx', 1), ('ifglksy', 1),
+    ('refnx', 5), ('refny', 5), ('refchipsize', 5), ('refminfrac', 0.8),
+    ('orbfit', 1), ('orbfitmethod', 1), ('orbfitdegrees', 1), ('orbfitlksx', 1), ('orbfitlksy', 1),
+    ('refest', 2),
+    ('apsest', 0),
+    ('slpfmethod', 2), ('slpfcutoff', 0.001), ('slpforder', 1), ('slpnanfill', 1),
+    ('slpnanfill_method', 'cubic'), ('tlpfmethod', 3), ('tlpfcutoff', 0.25), ('tlpfpthr', 1),
+    ('cohmask', 0),
+    ('tscal', 1), ('tsmethod', 2), ('smorder', 2), ('smfactor', -0.25), ('ts_pthr', 3),
+    ('nsig', 3), ('pthr', 3), ('maxsig', 1000),
+])
+
+
+def _epoch_dates(nepochs):
+    return [date(2006, 1, 1) + timedelta(days=EPOCH_INTERVAL * i) for i in range(nepochs)]
+
+
+def network(nepochs, nifgs, seed=0):
+    """
+    Interferogram network connecting all epochs: consecutive pairs and
+    random short temporal baseline pairs.
+
+    :param int nepochs: Number of epochs
+    :param int nifgs: Number of interferograms, at least nepochs - 1
+    :param int seed: Random seed
+
+    :return: pairs: list of (master, slave) epoch indices
+    :rtype: list
+    """
+    nmax = nepochs * (nepochs - 1) // 2
+    if not nepochs - 1 <= nifgs <= nmax:
+        raise ValueError('Number of interferograms must be between {} and {}'.format(nepochs - 1, nmax))
+    pairs = [(i, i + 1) for i in range(nepochs - 1)]
+    candidates = sorted(set((i, j) for i in range(nepochs) for j in range(i + 2, nepochs)),
+                        key=lambda p: (p[1] - p[0], p))
+    rng = np.random.RandomState(seed)
+    # prefer short temporal baselines, as real networks do
+    weights = np.array([1.0 / (j - i) ** 2 for i, j in candidates])
+    extra = rng.choice(len(candidates), nifgs - len(pairs), replace=False, p=weights / weights.sum())
+    return sorted(pairs + [candidates[k] for k in extra])
+
+
+def velocity_field(rows, cols, signal):
+    """
+    Gaussian deformation bowl in mm/yr with maximum rate signal.
+    """
+    y, x = np.mgrid[0:rows, 0:cols]
+    sigma = min(rows, cols) / 6.0
+    return -signal * np.exp(-((y - rows / 2.0) ** 2 + (x - cols / 2.0) ** 2) / (2 * sigma ** 2))
+
+
+def _write_header(path, lines):
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def generate(datadir, rows, cols, nepochs, nifgs, nan_fraction=0.1, signal=20.0, seed=0):
+    """
+    Generate a synthetic GAMMA interferogram network: unwrapped phase files,
+    epoch and DEM headers, DEM and file lists.
+
+    :param str datadir: Output directory
+    :param int rows: Number of rows
+    :param int cols: Number of columns
+    :param int nepochs: Number of epochs
+    :param int nifgs: Number of interferograms
+    :param float nan_fraction: Fraction of missing pixels per interferogram
+    :param float signal: Maximum deformation rate in mm/yr
+    :param int seed: Random seed
+
+    :return: description of the data set
+    :rtype: dict
+    """
+    os.makedirs(datadir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    dates = _epoch_dates(nepochs)
+    wavelength = SPEED_OF_LIGHT / RADAR_FREQUENCY
+    rad_per_mm = 4 * math.pi / (wavelength * 1000)
+    years = np.array([(d - dates[0]).days / 365.25 for d in dates])
+    velocity = velocity_field(rows, cols, signal)
+    y, x = np.mgrid[0:rows, 0:cols] / float(max(rows, cols))
+
+    headers = []
+    for d in dates:
+        path = join(datadir, '{:%Y%m%d}_slc.par'.format(d))
+        _write_header(path, ['date: {:%Y %m %d} 0 0 0.0'.format(d),
+                             'radar_frequency: {:.9e} Hz'.format(RADAR_FREQUENCY),
+                             'incidence_angle: 23.0 degrees'])
+        headers.append(abspath(path))
+
+    dem_header = join(datadir, 'synthetic_dem.par')
+    _write_header(dem_header, [
+        'DEM_projection:     EQA', 'data_format:        REAL*4',
+        'width:                {}'.format(cols), 'nlines:               {}'.format(rows),
+        'corner_lat:    {}  decimal degrees'.format(CORNER_LAT),
+        'corner_lon:    {}  decimal degrees'.format(CORNER_LON),
+        'post_lat:   {}  decimal degrees'.format(-POST),
+        'post_lon:    {}  decimal degrees'.format(POST),
+        'ellipsoid_name: WGS 84'])
+    dem = join(datadir, 'synthetic_utm.dem')
+    (100 + 50 * x + 20 * y).astype('>f4').tofile(dem)
+
+    ifgs = []
+    for i, j in network(nepochs, nifgs, seed):
+        displacement = velocity * (years[j] - years[i])
+        ramp = rng.normal(scale=5.0, size=3)  # orbital error in mm
+        noise = rng.normal(scale=1.0, size=(rows, cols))
+        phase = ((displacement + ramp[0] + ramp[1] * x + ramp[2] * y + noise) * rad_per_mm).astype('>f4')
+        phase[rng.random_sample((rows, cols)) < nan_fraction] = 0  # no data value
+        path = join(datadir, '{:%Y%m%d}-{:%Y%m%d}_utm.unw'.format(dates[i], dates[j]))
+        phase.tofile(path)
+        ifgs.append(abspath(path))
+
+    _write_header(join(datadir, 'ifms'), ifgs)
+    _write_header(join(datadir, 'headers'), headers)
+    description = OrderedDict([('rows', rows), ('cols', cols), ('epochs', nepochs), ('ifgs', nifgs),
+                               ('nan_fraction', nan_fraction), ('signal', signal), ('seed', seed)])
+    with open(join(datadir, 'dataset.json'), 'w') as f:
+        json.dump(description, f, indent=2)
+    return description
+
+
+def write_config(datadir, name, parallel, processes, tiles, geotiff=False):
+    """
+    Write a PyRate configuration file for a benchmark run of the data set,
+    with its own output directory.
+
+    :return: paths of the configuration file and output directory
+    :rtype: tuple
+    """
+    datadir = abspath(datadir)
+    outdir = join(datadir, 'out_' + name)
+    config = OrderedDict(CONFIG)
+    config.update([
+        ('obsdir', datadir),
+        ('ifgfilelist', join(datadir, 'ifms')),
+        ('demfile', join(datadir, 'synthetic_utm.dem')),
+        ('demHeaderFile', join(datadir, 'synthetic_dem.par')),
+        ('hdrfilelist', join(datadir, 'headers')),
+        ('outdir', outdir),
+        ('parallel', parallel),
+        ('processes', processes),
+        ('rows', tiles[0]),
+        ('cols', tiles[1]),
+    ])
+    if geotiff:
+        config.update([
+            ('processor', 2),
+            ('ifgfilelist', join(datadir, 'tifs')),
+            ('demfile', join(datadir, 'tif', 'synthetic_utm_dem.tif')),
+        ])
+    path = join(datadir, 'pyrate_{}.conf'.format(name))
+    with open(path, 'w') as f:
+        for k, v in config.items():
+            f.write('{}: {}\n'.format(k, v))
+    return path, outdir
+
+
+def convert_geotiff(datadir):
+    """
+    Convert the GAMMA data set to GeoTIFF once, for benchmarking the
+    workflow on GeoTIFF inputs (processor = 2).
+    """
+    from pyrate.configuration import Configuration
+    from pyrate.core import config as cf
+    from pyrate import conv2tif
+    conf, _ = write_config(datadir, 'geotiff_conversion', 0, 1, (1, 1))
+    params = Configuration(conf).__dict__
+    params[cf.OUT_DIR] = join(abspath(datadir), 'tif')
+    for p in params[cf.INTERFEROGRAM_FILES] + [params[cf.DEM_FILE_PATH]]:
+        p.converted_path = join(params[cf.OUT_DIR], os.path.basename(p.converted_path))
+    os.makedirs(params[cf.OUT_DIR], exist_ok=True)
+    conv2tif.main(params)
+    _write_header(join(datadir, 'tifs'), [p.converted_path for p in params[cf.INTERFEROGRAM_FILES]])
+
+
+def _command(mode, processes, step, conf):
+    cmd = [sys.executable, '-m', 'pyrate.main', step, '-f', conf]
+    if mode == 'mpi':
+        cmd = ['mpirun', '-n', str(processes)] + cmd
+    return cmd
+
+
+def _stage_timings(outdir, step):
+    """
+    Wall time of the stages of the latest PyRate run report of a step.
+    """
+    reports = glob.glob(join(outdir, 'pyrate.report.{}.*.json'.format(step)))
+    if not reports:
+        return None
+    with open(max(reports, key=getmtime)) as f:
+        stages = json.load(f)['stages']
+    return OrderedDict((name, s['summary']['wall_max']) for name, s in stages.items())
+
+
+def run(datadir, mode, processes=1, tiles=(4, 4), steps=STEPS, geotiff=False):
+    """
+    Run the PyRate workflow on a data set and time each step.
+
+    :param str datadir: Directory of the generated data set
+    :param str mode: 'serial', 'multiprocess' or 'mpi'
+    :param int processes: Number of processes
+    :param tuple tiles: Number of tile rows and columns
+    :param list steps: PyRate steps to run
+    :param bool geotiff: Use GeoTIFF inputs
+
+    :return: name and result of the run
+    :rtype: tuple
+    """
+    if mode == 'serial':
+        processes = 1
+    with open(join(datadir, 'dataset.json')) as f:
+        dataset = json.load(f)
+    name = '{}-{}-{}x{}x{}'.format(mode, processes, dataset['rows'], dataset['cols'], dataset['ifgs'])
+    if geotiff:
+        name += '-geotiff'
+        steps = [s for s in steps if s != 'conv2tif']
+        if not os.path.exists(join(datadir, 'tifs')):
+            convert_geotiff(datadir)
+    conf, outdir = write_config(datadir, name, int(mode == 'multiprocess'), processes, tiles, geotiff)
+    shutil.rmtree(outdir, ignore_errors=True)
+
+    result = OrderedDict([('dataset', dataset), ('mode', mode), ('processes', processes),
+                          ('tiles', list(tiles)), ('steps', OrderedDict())])
+    for step in steps:
+        print('Running {} for {}'.format(step, name))
+        start = time.perf_counter()
+        subprocess.check_call(_command(mode, processes, step, conf))
+        result['steps'][step] = OrderedDict([('wall', time.perf_counter() - start),
+                                             ('stages', _stage_timings(outdir, step))])
+    result['wall'] = sum(s['wall'] for s in result['steps'].values())
+    return name, result
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare the wall time of each step of benchmark runs against a baseline.
+
+    :param dict results: Benchmark runs by name
+    :param dict baseline: Baseline benchmark runs by name
+    :param float tolerance: Allowed fractional slowdown
+
+    :return: regressions: list of (run, step, ratio)
+    :rtype: list
+    """
+    regressions = []
+    print('{:40s} {:10s} {:>10s} {:>10s} {:>8s}'.format('run', 'step', 'baseline', 'current', 'ratio'))
+    for name, result in results.items():
+        if name not in baseline:
+            print('{:40s} not in baseline'.format(name))
+            continue
+        base = baseline[name]['steps']
+        for step, timing in result['steps'].items():
+            if step not in base:
+                continue
+            ratio = timing['wall'] / base[step]['wall']
+            flag = ''
+            if ratio > 1 + tolerance:
+                regressions.append((name, step, ratio))
+                flag = ' slower'
+            print('{:40s} {:10s} {:10.2f} {:10.2f} {:8.2f}{}'.format(
+                name, step, base[step]['wall'], timing['wall'], ratio, flag))
+    return regressions
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save(results, path):
+    """
+    Add results to the JSON file of benchmark runs at path.
+    """
+    saved = _load(path) if os.path.exists(path) else OrderedDict()
+    saved.update(results)
+    with open(path, 'w') as f:
+        json.dump(saved, f, indent=2)
+    print('Wrote {}'.format(path))
+
+
+def _finish(results, args):
+    if args.output:
+        _save(results, args.output)
+    if args.baseline:
+        if compare(results, _load(args.baseline), args.tolerance):
+            sys.exit(1)
+
+
+def _add_size_arguments(parser):
+    parser.add_argument('--rows', type=int, default=500, help='number of rows')
+    parser.add_argument('--cols', type=int, default=500, help='number of columns')
+    parser.add_argument('--epochs', type=int, default=20, help='number of epochs')
+    parser.add_argument('--ifgs', type=int, default=40, help='number of interferograms')
+    parser.add_argument('--nan-fraction', type=float, default=0.1, help='fraction of missing pixels')
+    parser.add_argument('--signal', type=float, default=20.0, help='maximum deformation rate in mm/yr')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+
+
+def _add_run_arguments(parser):
+    parser.add_argument('--mode', choices=MODES, default='serial', help='how to run PyRate')
+    parser.add_argument('--tiles', type=int, nargs=2, default=[4, 4], help='number of tile rows and columns')
+    parser.add_argument('--steps', nargs='+', choices=STEPS, default=STEPS, help='PyRate steps to run')
+    parser.add_argument('--geotiff', action='store_true', help='use GeoTIFF instead of GAMMA inputs')
+    parser.add_argument('-o', '--output', help='JSON file the results are added to')
+    parser.add_argument('--baseline', help='JSON file of baseline results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed fractional slowdown')
+
+
+def _generate(args, datadir, rows):
+    return generate(datadir, rows, args.cols, args.epochs, args.ifgs, args.nan_fraction, args.signal, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the PyRate workflow on synthetic data')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parser_generate = subparsers.add_parser('generate', help='generate a synthetic data set')
+    parser_generate.add_argument('-d', '--datadir', required=True, help='directory of the data set')
+    _add_size_arguments(parser_generate)
+
+    parser_run = subparsers.add_parser('run', help='run the workflow on a generated data set')
+    parser_run.add_argument('-d', '--datadir', required=True, help='directory of the data set')
+    parser_run.add_argument('-n', '--processes', type=int, default=1, help='number of processes')
+    _add_run_arguments(parser_run)
+
+    parser_scaling = subparsers.add_parser(
+        'scaling', help='strong scaling: same data set for all process counts; '
+                        'weak scaling: rows proportional to the process count')
+    parser_scaling.add_argument('-d', '--datadir', required=True, help='directory for the data sets')
+    parser_scaling.add_argument('--scaling', choices=['strong', 'weak'], default='strong')
+    parser_scaling.add_argument('-n', '--processes', type=int, nargs='+', default=[1, 2, 4],
+                                help='numbers of processes')
+    _add_size_arguments(parser_scaling)
+    _add_run_arguments(parser_scaling)
+
+    parser_compare = subparsers.add_parser('compare', help='compare benchmark results against a baseline')
+    parser_compare.add_argument('results', help='JSON file of results')
+    parser_compare.add_argument('baseline', help='JSON file of baseline results')
+    parser_compare.add_argument('--tolerance', type=float, default=0.1, help='allowed fractional slowdown')
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        print(json.dumps(_generate(args, args.datadir, args.rows)))
+
+    elif args.command == 'run':
+        name, result = run(args.datadir, args.mode, args.processes, args.tiles, args.steps, args.geotiff)
+        _finish({name: result}, args)
+
+    elif args.command == 'scaling':
+        results = OrderedDict()
+        for n in args.processes:
+            if args.scaling == 'strong':
+                datadir = join(args.datadir, 'strong')
+                rows = args.rows
+            else:
+                datadir = join(args.datadir, 'weak_{}'.format(n))
+                rows = args.rows * n
+            if not os.path.exists(join(datadir, 'dataset.json')):
+                _generate(args, datadir, rows)
+            name, result = run(datadir, args.mode, n, args.tiles, args.steps, args.geotiff)
+            result['scaling'] = args.scaling
+            results[name] = result
+        first = next(iter(results.values()))
+        for result in results.values():
+            # speedup for strong scaling, efficiency for weak scaling
+            result['relative'] = first['wall'] / result['wall']
+        _finish(results, args)
+
+    elif args.command == 'compare':
+        if compare(_load(args.results), _load(args.baseline), args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+# This Python module is part of the PyRate software package
+#
+# Copyright 2020 Geoscience Australia
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Micro-benchmarks of the PyRate per-pixel and per-interferogram kernels.
+
+Each kernel is run in serial on in-memory synthetic interferograms of several
+sizes, without reading or writing files. The best time of several repeats is
+reported as throughput (pixels/s, ifgs/s or chips/s) and can be compared
+against a baseline, for before/after measurements of kernel optimisations.
+
+example usage, from the 'PyRate' directory:
+python -m utils.kernel_benchmark --sizes small medium -o kernels.json
+python -m utils.kernel_benchmark --kernels stack_rate timeseries_svd --baseline kernels.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+
+import numpy as np
+
+from pyrate.core import (config as cf, stack, timeseries, mst, covariance, aps, orbital, refpixel,
+                         prepifg_helper, ifgconstants as ifc)
+from utils.benchmark import network, velocity_field, EPOCH_INTERVAL
+
+# rows, cols, epochs, interferograms
+SIZES = OrderedDict([
+    ('small', (50, 50, 10, 20)),
+    ('medium', (200, 200, 20, 40)),
+    ('large', (500, 500, 30, 60)),
+])
+
+PARAMS = {
+    cf.PARALLEL: 0,
+    cf.PROCESSES: 1,
+    cf.LR_NSIG: 3,
+    cf.LR_MAXSIG: 1000,
+    cf.LR_PTHRESH: 3,
+    cf.TIME_SERIES_PTHRESH: 3,
+    cf.TIME_SERIES_SM_ORDER: 2,
+    cf.TIME_SERIES_SM_FACTOR: -0.25,
+    cf.SLPF_METHOD: 2,
+    cf.SLPF_ORDER: 1,
+    cf.REFNX: 10,
+    cf.REFNY: 10,
+    cf.REF_CHIP_SIZE: 21,
+    cf.REF_MIN_FRAC: 0.5,
+}
+
+
+class SyntheticIfg:
+    """
+    In-memory interferogram with the attributes used by the kernels.
+    """
+    def __init__(self, master, slave, phase_data, x_size=90.0, y_size=90.0):
+        self.master = master
+        self.slave = slave
+        self.phase_data = phase_data
+        self.nrows, self.ncols = phase_data.shape
+        self.num_cells = phase_data.size
+        self.x_size = x_size
+        self.y_size = y_size
+        self.x_centre = self.ncols // 2
+        self.y_centre = self.nrows // 2
+        self.time_span = (slave - master).days / ifc.DAYS_PER_YEAR
+        self.nan_fraction = np.isnan(phase_data).mean()
+        self.data_path = '{}-{}'.format(master, slave)
+        self.is_open = True
+
+    @property
+    def shape(self):
+        return self.nrows, self.ncols
+
+    @property
+    def nan_count(self):
+        return int(np.isnan(self.phase_data).sum())
+
+    def open(self, readonly=None):
+        pass
+
+    def close(self):
+        pass
+
+
+def synthetic_ifgs(rows, cols, nepochs, nifgs, nan_fraction=0.1, signal=20.0, seed=0):
+    """
+    Interferograms of a synthetic network with a deformation signal, noise
+    and missing data, in millimetres.
+
+    :return: ifgs: list of SyntheticIfg instances
+    :rtype: list
+    """
+    rng = np.random.RandomState(seed)
+    dates = [date(2006, 1, 1) + timedelta(days=EPOCH_INTERVAL * i) for i in range(nepochs)]
+    velocity = velocity_field(rows, cols, signal)
+    ifgs = []
+    for i, j in network(nepochs, nifgs, seed):
+        phase = velocity * (dates[j] - dates[i]).days / ifc.DAYS_PER_YEAR + rng.normal(size=(rows, cols))
+        phase[rng.random_sample((rows, cols)) < nan_fraction] = np.nan
+        ifgs.append(SyntheticIfg(dates[i], dates[j], phase.astype(np.float32)))
+    return ifgs
+
+
+def _vcmt(ifgs):
+    return covariance.get_vcmt(ifgs, np.full(len(ifgs), 5.0))
+
+
+def _chain_mst(ifgs):
+    """
+    Cheap stand-in for the MST: the interferograms between consecutive
+    epochs, where not NaN. As for the MST, the selected observations of a
+    pixel are independent, so their covariance matrix is positive definite.
+    """
+    chain = np.array([(i.slave - i.master).days == EPOCH_INTERVAL for i in ifgs])
+    return np.array([~np.isnan(i.phase_data) for i in ifgs]) & chain[:, np.newaxis, np.newaxis]
+
+
+def _stack_rate(ifgs):
+    vcmt = _vcmt(ifgs)
+    tree = _chain_mst(ifgs)
+
+    def run():
+        obs = np.array([i.phase_data for i in ifgs])
+        stack.stack_rate(ifgs, PARAMS, vcmt, tree.copy(), obs=obs)
+    return run, ifgs[0].num_cells, 'pixels/s'
+
+
+def _timeseries(method):
+    def setup(ifgs):
+        vcmt = _vcmt(ifgs)
+        tree = _chain_mst(ifgs)
+        params = dict(PARAMS)
+        params[cf.TIME_SERIES_METHOD] = method
+        return lambda: timeseries.time_series(ifgs, params, vcmt, tree), ifgs[0].num_cells, 'pixels/s'
+    return setup
+
+
+def _mst(ifgs):
+    return lambda: mst.mst_boolean_array(ifgs), ifgs[0].num_cells, 'pixels/s'
+
+
+def _cvd(ifgs):
+    r_dist = covariance.RDist(ifgs[0])()
+    phases = [np.nan_to_num(i.phase_data) for i in ifgs]
+
+    def run():
+        for ifg, phase in zip(ifgs, phases):
+            covariance.cvd_from_phase(phase, ifg, r_dist, calc_alpha=True)
+    return run, len(ifgs), 'ifgs/s'
+
+
+def _slp_filter(ifgs):
+    rows, cols = ifgs[0].shape
+    phases = [np.nan_to_num(i.phase_data) for i in ifgs]
+
+    def run():
+        for ifg, phase in zip(ifgs, phases):
+            aps._slp_filter(phase, 1.0, rows, cols, ifg.x_size, ifg.y_size, PARAMS)
+    return run, len(ifgs), 'ifgs/s'
+
+
+def _tlpfilter(ifgs):
+    tsincr = timeseries.time_series(ifgs, dict(PARAMS, **{cf.TIME_SERIES_METHOD: 2}), mst=_chain_mst(ifgs))[0]
+    rows, cols, nepochs = tsincr.shape
+    nanmat = ~np.isnan(tsincr)
+    span = np.arange(nepochs) * EPOCH_INTERVAL / ifc.DAYS_PER_YEAR
+    out = np.empty_like(tsincr)
+
+    def run():
+        aps._tlpfilter(cols, 0.25, nanmat, rows, span, 1, out, tsincr, aps.gauss)
+    return run, rows * cols, 'pixels/s'
+
+
+def _network_design_matrix(ifgs):
+    # the network method works on multilooked interferograms, so the
+    # matrix is built for a tenth of the rows and columns
+    small = [SyntheticIfg(i.master, i.slave, i.phase_data[::10, ::10]) for i in ifgs]
+    return lambda: orbital.get_network_design_matrix(small, orbital.PLANAR, True), len(ifgs), 'ifgs/s'
+
+
+def _ref_pixel_multi(ifgs):
+    half_patch_size, thresh, grid = refpixel.ref_pixel_setup(ifgs, PARAMS)
+    phase_data = [i.phase_data for i in ifgs]
+
+    def run():
+        for g in grid:
+            refpixel._ref_pixel_multi(g, half_patch_size, phase_data, thresh, PARAMS)
+    return run, len(grid) * len(ifgs), 'chips/s'
+
+
+def _chip_std(ifgs):
+    half_patch_size, thresh, grid = refpixel.ref_pixel_setup(ifgs, PARAMS)
+
+    def run():
+        for i in ifgs:
+            refpixel._chip_std(i.phase_data, grid, half_patch_size, thresh)
+    return run, len(grid) * len(ifgs), 'chips/s'
+
+
+def _resample(ifgs):
+    phases = [i.phase_data for i in ifgs]
+
+    def run():
+        for phase in phases:
+            prepifg_helper._resample(phase, 4, 4, 0.5)
+    return run, len(ifgs) * ifgs[0].num_cells, 'pixels/s'
+
+
+# setup functions by kernel name, returning the function to time, the units
+# of work per call and the throughput unit
+KERNELS = OrderedDict([
+    ('stack_rate', _stack_rate),
+    ('timeseries_svd', _timeseries(2)),
+    ('timeseries_laplacian', _timeseries(1)),
+    ('mst_boolean_array', _mst),
+    ('cvd_from_phase', _cvd),
+    ('slp_filter', _slp_filter),
+    ('tlpfilter', _tlpfilter),
+    ('network_design_matrix', _network_design_matrix),
+    ('ref_pixel_multi', _ref_pixel_multi),
+    ('chip_std', _chip_std),
+    ('resample', _resample),
+])
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """
+    Time a function after one warm-up call. The function is called at least
+    repeat times and for at least min_time seconds.
+
+    :return: best and median time per call in seconds
+    :rtype: tuple
+    """
+    func()
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeat or time.perf_counter() - start < min_time:
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return min(times), float(np.median(times))
+
+
+def run(kernels, sizes, repeat=5):
+    """
+    Benchmark kernels on synthetic interferograms of the given sizes.
+
+    :param list kernels: Names of the kernels, see KERNELS
+    :param list sizes: Names of the sizes, see SIZES
+    :param int repeat: Minimum number of timed calls
+
+    :return: results by kernel and size
+    :rtype: dict
+    """
+    results = OrderedDict((k, OrderedDict()) for k in kernels)
+    for size in sizes:
+        ifgs = synthetic_ifgs(*SIZES[size])
+        for kernel in kernels:
+            func, work, unit = KERNELS[kernel](ifgs)
+            best, median = measure(func, repeat)
+            results[kernel][size] = OrderedDict([('best', best), ('median', median),
+                                                 ('throughput', work / best), ('unit', unit)])
+            print('{:24s} {:8s} {:12.4f} s {:14.1f} {}'.format(kernel, size, best, work / best, unit))
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare kernel throughput against a baseline.
+
+    :param dict results: Results of run
+    :param dict baseline: Baseline results of run
+    :param float tolerance: Allowed fractional loss of throughput
+
+    :return: regressions: list of (kernel, size, speedup)
+    :rtype: list
+    """
+    regressions = []
+    print('{:24s} {:8s} {:>14s} {:>14s} {:>8s}'.format('kernel', 'size', 'baseline', 'current', 'speedup'))
+    for kernel, sizes in results.items():
+        for size, result in sizes.items():
+            base = baseline.get(kernel, {}).get(size)
+            if base is None:
+                continue
+            speedup = result['throughput'] / base['throughput']
+            flag = ''
+            if speedup < 1 - tolerance:
+                regressions.append((kernel, size, speedup))
+                flag = ' slower'
+            print('{:24s} {:8s} {:14.1f} {:14.1f} {:8.2f}{}'.format(
+                kernel, size, base['throughput'], result['throughput'], speedup, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PyRate kernels on synthetic data')
+    parser.add_argument('--kernels', nargs='+', choices=list(KERNELS), default=list(KERNELS))
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium'])
+    parser.add_argument('--repeat', type=int, default=5, help='minimum number of timed calls')
+    parser.add_argument('-o', '--output', help='JSON file to write the results to')
+    parser.add_argument('--baseline', help='JSON file of baseline results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed fractional loss of throughput')
+    args = parser.parse_args()
+
+    results = run(args.kernels, args.sizes, args.repeat)
+    if args.output:
+        saved = OrderedDict()
+        if os.path.exists(args.output):
+            with open(args.output) as f:
+                saved = json.load(f, object_pairs_hook=OrderedDict)
+        for kernel, sizes in results.items():
+            saved.setdefault(kernel, OrderedDict()).update(sizes)
+        with open(args.output, 'w') as f:
+            json.dump(saved, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,30 +14,33 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 """
-This script creates the pycallgraph file output_file='pyrate_with_roipac.png'.
+This script profiles a PyRate step with cProfile and writes the profile to
+pyrate_<step>.prof, for viewing with e.g. snakeviz, and prints the functions
+with the largest cumulative time.
 This script can be run from the 'PyRate' directory.
-Change the name of the config file as required.
+
+example usage:
+python utils/pyrate_profile.py process pyrate.conf
 """
 
+import cProfile
+import pstats
 import sys
-from pycallgraph import PyCallGraph
-from pycallgraph import Config
-from pycallgraph import GlobbingFilter
-from pycallgraph.output import GraphvizOutput
-from pyrate import process
 
-config = Config()
-config.trace_filter = GlobbingFilter(exclude=[
-    'pycallgraph.*',
-    '*.secret_function',
-])
+from pyrate import conv2tif, prepifg, process, merge
+from pyrate.configuration import Configuration
 
-graphviz = GraphvizOutput(output_file='pyrate_with_roipac.png')
-config = Config(max_depth=6, groups=False, threaded=True)
+STEPS = {'conv2tif': conv2tif.main, 'prepifg': prepifg.main, 'process': process.main, 'merge': merge.main}
 
-# sys.argv[0]: name of this script
-# sys.argv[1]: name of the config file
-sys.argv = ['pyrate_profile.py', 'pyrate.conf']
+# sys.argv[1]: name of the PyRate step
+# sys.argv[2]: name of the config file
+if len(sys.argv) != 3 or sys.argv[1] not in STEPS:
+    sys.exit('usage: python pyrate_profile.py {} config_file'.format('|'.join(STEPS)))
+step, config_file = sys.argv[1:]
+params = Configuration(config_file).__dict__
 
-with PyCallGraph(output=graphviz, config=config):
-    process.main()
+output_file = 'pyrate_{}.prof'.format(step)
+profiler = cProfile.Profile()
+profiler.runcall(STEPS[step], params)
+profiler.dump_stats(output_file)
+pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)